@@ -1,8 +1,14 @@
 import os
+import sys
 import numpy as np
 import faiss
 from openai import OpenAI
 
+# 添加项目根目录到Python路径，以便导入共享的services包
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+from services.embedding_cache import cached_embedding_function
+from services.vector_index import build_index, compare_with_flat, print_index_report
+
 # Step1. 初始化 API 客户端
 try:
     client = OpenAI(
@@ -14,6 +20,19 @@ except Exception as e:
     print(f"错误信息: {e}")
     exit()
 
+def request_text_embedding(text):
+    """调用API生成文本向量"""
+    completion = client.embeddings.create(
+        model="text-embedding-v4",
+        input=text,
+        dimensions=1024,
+        encoding_format="float"
+    )
+    return completion.data[0].embedding
+
+# 相同文本的向量缓存在本地磁盘，重复运行时直接读取，不再调用API
+get_text_embedding = cached_embedding_function(request_text_embedding, "text-embedding-v4", 1024)
+
 # Step2. 准备示例文本和元数据
 # 在实际应用中，这些数据可能来自数据库、文件等
 documents = [
@@ -50,16 +69,8 @@ vector_ids = []
 print("正在为文档生成向量...")
 for i, doc in enumerate(documents):
     try:
-        # 调用API生成向量
-        completion = client.embeddings.create(
-            model="text-embedding-v4",
-            input=doc["text"],
-            dimensions=1024,
-            encoding_format="float"
-        )
-        
-        # 获取向量
-        vector = completion.data[0].embedding
+        # 生成向量（优先读取缓存）
+        vector = get_text_embedding(doc["text"])
         vectors_list.append(vector)
         
         # 存储元数据，并使用列表索引作为唯一ID
@@ -80,15 +91,24 @@ vector_ids_np = np.array(vector_ids)
 dimension = 1024  # 向量维度
 k = 3             # 查找最近的3个邻居
 
-# 创建一个基础的L2距离索引
-index_flat_l2 = faiss.IndexFlatL2(dimension)
+# 索引类型: flat（精确检索）/ ivf_flat / ivf_pq / hnsw（近似检索，适合大规模语料）
+index_type = os.getenv("INDEX_TYPE", "flat")
+
+if index_type == "flat":
+    # 创建一个基础的L2距离索引
+    index_flat_l2 = faiss.IndexFlatL2(dimension)
 
-# 使用IndexIDMap来包装基础索引，能够映射我们自定义的ID
-# 这就是关联向量和元数据的关键！
-index = faiss.IndexIDMap(index_flat_l2)
+    # 使用IndexIDMap来包装基础索引，能够映射我们自定义的ID
+    # 这就是关联向量和元数据的关键！
+    index = faiss.IndexIDMap(index_flat_l2)
 
-# 将向量和它们对应的ID添加到索引中
-index.add_with_ids(vectors_np, vector_ids_np)
+    # 将向量和它们对应的ID添加到索引中
+    index.add_with_ids(vectors_np, vector_ids_np)
+else:
+    # 近似索引会在采样数据上自动训练，并同样用IndexIDMap包装以保留自定义ID
+    index = build_index(vectors_np, ids=vector_ids_np, index_type=index_type)
+    # 与flat精确检索对比召回率和延迟
+    print_index_report(compare_with_flat(index, vectors_np, ids=vector_ids_np, k=k))
 
 print(f"\nFAISS 索引已成功创建，共包含 {index.ntotal} 个向量。")
 
@@ -99,13 +119,7 @@ print(f"\n正在为查询文本生成向量: '{query_text}'")
 
 try:
     # 为查询文本生成向量
-    query_completion = client.embeddings.create(
-        model="text-embedding-v4",
-        input=query_text,
-        dimensions=1024,
-        encoding_format="float"
-    )
-    query_vector = np.array([query_completion.data[0].embedding]).astype('float32')
+    query_vector = np.array([get_text_embedding(query_text)]).astype('float32')
 
     # 在FAISS索引中执行搜索
     # search方法返回两个NumPy数组：
@@ -2,6 +2,7 @@
 交互式查询脚本，使用知识库管理器
 """
 from knowledge_base_manager import KnowledgeBaseManager
+from services.vector_index import langchain_similarity
 from langchain_core.prompts import ChatPromptTemplate
 from langchain_community.callbacks.manager import get_openai_callback
 from langchain_ollama import ChatOllama
@@ -16,7 +17,7 @@ def interactive_query():
     # 创建知识库管理器实例
     kb_manager = KnowledgeBaseManager(
         pdf_path='./浦发上海浦东发展银行西安分行个金客户经理考核办法.pdf',
-        vector_store_path='./vector_db',
+        vector_store_path='./vector_db_mmap',
         embeddings_model='qwen3-embedding:4b'
     )
     
@@ -58,15 +59,15 @@ def interactive_query():
         # 展示每个文档片段的详细信息
         for i, (doc, score) in enumerate(docs_with_scores, 1):
             content = getattr(doc, "page_content", "")
-            source_page = knowledge_base.page_info.get(content.strip(), "未知")
+            source_page = doc.metadata.get("page", "未知")
             
-            # 计算相似度百分比
-            max_score = max(doc_tuple[1] for doc_tuple in docs_with_scores) if docs_with_scores else 1
-            similarity_percentage = max(0, min(100, (1 - score / (max_score + 0.001)) * 100))
+            # 按索引实际的度量把得分换算为余弦相似度，不同查询之间可直接比较
+            similarity = langchain_similarity(knowledge_base, score)
+            similarity_text = f"{max(0.0, similarity) * 100:.2f}%" if similarity is not None else "无法换算（索引向量未归一化）"
             
             print(f"\n文档片段 {i}:")
-            print(f"  相似度得分: {score:.4f}")
-            print(f"  估算相似度: {similarity_percentage:.2f}%")
+            print(f"  检索得分: {score:.4f}")
+            print(f"  估算相似度: {similarity_text}")
             print(f"  来源页码: {source_page}")
             # 只显示第一行，如果超过50个字符则截断并显示...
             first_line = content.split('\n')[0] if content.split('\n') else ""
@@ -74,7 +75,7 @@ def interactive_query():
             print(f"  内容预览: {preview}")
             
             # 添加到上下文
-            context_parts.append(f"文档片段 {i} (相似度: {similarity_percentage:.2f}%, 来源页码: {source_page}): {content}")
+            context_parts.append(f"文档片段 {i} (相似度: {similarity_text}, 来源页码: {source_page}): {content}")
         
         # 构建最终的上下文
         context = "\\n\\n".join(context_parts)
@@ -101,7 +102,7 @@ def interactive_query():
             else:
                 print(f"AI回答: {response}")
                 
-        print(f"\n来源页码: {[knowledge_base.page_info.get(getattr(doc[0], 'page_content', '').strip(), '未知') for doc in docs_with_scores]}")
+        print(f"\n来源页码: {[doc.metadata.get('page', '未知') for doc, _ in docs_with_scores]}")
 
 
 if __name__ == "__main__":
@@ -1,17 +1,38 @@
 """
 知识库管理器，用于创建和重用知识库
 """
-from PyPDF2 import PdfReader
-from langchain.text_splitter import RecursiveCharacterTextSplitter
 from langchain_ollama import OllamaEmbeddings
 from langchain_community.vectorstores import FAISS
-from typing import List, Tuple
+from langchain_community.vectorstores.utils import DistanceStrategy
+from typing import Dict, Iterable, List, Optional, Tuple
+import hashlib
+import json
 import os
-import pickle
+import shutil
 import time
+import sys
+
+# 添加项目根目录到Python路径，以便导入共享的services包
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+from services.bm25_index import BM25Index
+from services.embedding_cache import CachedEmbeddings
+from services.hybrid_retrieval import HybridRetriever, bm25_stage, vectorstore_stage
+from services.mmap_store import is_mmap_knowledge_base, load_knowledge_base, save_knowledge_base
+from services.pdf_pages import backfill_legacy_pages, iter_chunks_with_pages, iter_pdf_pages
+from services.segmentation import SegmentationService
+
+MANIFEST_FILE = "manifest.json"
+# mmap格式知识库的默认目录；./vector_db 是其他脚本通过 FAISS.load_local 读取的旧版pickle格式，不能混用
+DEFAULT_VECTOR_STORE_PATH = "./vector_db_mmap"
+# BM25词法索引的保存目录（位于向量存储目录下），知识库重建时删除并在下次混合检索时重建
+LEXICAL_INDEX_DIR = "bm25"
+LEXICAL_IDS_FILE = "chunk_ids.json"
+# 词法索引只去掉空白和标点，保留单字和数字串，产品编号、保单号等可以精确命中
+LEXICAL_STOPWORDS = set(" \t\r\n　，。、；：？！“”‘’（）《》【】,.;:?!\"'()[]<>")
 
 class KnowledgeBaseManager:
-    def __init__(self, pdf_path: str, vector_store_path: str = "./vector_db", embeddings_model: str = "qwen3-embedding:4b"):
+    def __init__(self, pdf_path: str, vector_store_path: str = DEFAULT_VECTOR_STORE_PATH, embeddings_model: str = "qwen3-embedding:4b",
+                 extract_workers: Optional[int] = None, embed_batch_size: int = 32):
         """
         初始化知识库管理器
         
@@ -19,152 +40,251 @@ class KnowledgeBaseManager:
             pdf_path: PDF文件路径
             vector_store_path: 向量存储路径
             embeddings_model: 嵌入模型名称
+            extract_workers: 提取PDF文本的进程数，默认为CPU核数
+            embed_batch_size: 每凑够多少个新文本块就提交一次嵌入
         """
         self.pdf_path = pdf_path
         self.vector_store_path = vector_store_path
         self.embeddings_model = embeddings_model
-        self.embeddings = OllamaEmbeddings(model=embeddings_model)
+        self.embeddings = CachedEmbeddings(OllamaEmbeddings(model=embeddings_model), normalize=True)
         self.knowledge_base = None
-        
-    def extract_text_with_page_numbers(self, pdf) -> Tuple[str, List[int]]:
+        self.chunk_size = 1000
+        self.chunk_overlap = 200
+        # 余弦相似度模式：嵌入时归一化向量并使用内积索引，检索得分即余弦相似度
+        self.metric = "cosine"
+        self.manifest_path = os.path.join(vector_store_path, MANIFEST_FILE)
+        self.extract_workers = extract_workers
+        self.embed_batch_size = embed_batch_size
+        self.lexical_index_path = os.path.join(vector_store_path, LEXICAL_INDEX_DIR)
+        self.segmenter = None
+        self.hybrid_retriever = None
+        # 词法索引行号 -> 文本块ID；文本块ID -> FAISS行号
+        self.lexical_ids = []
+        self.lexical_rows = {}
+
+    @staticmethod
+    def hash_chunk(chunk: str) -> str:
         """
-        从PDF中提取文本并记录每行文本对应的页码
-        
-        参数:
-            pdf: PDF文件对象
-        
-        返回:
-            text: 提取的文本内容
-            page_numbers: 每行文本对应的页码列表
+        计算文本块的内容哈希，同时作为该块在向量库docstore中的ID
         """
-        text = ""
-        page_numbers = []
+        return hashlib.sha256(chunk.encode("utf-8")).hexdigest()
 
-        for page_number, page in enumerate(pdf.pages, start=1):
-            extracted_text = page.extract_text()
-            if extracted_text:
-                text += extracted_text
-                page_numbers.extend([page_number] * len(extracted_text.split("\n")))
+    @staticmethod
+    def hash_file(file_path: str) -> str:
+        """
+        分块读取文件并计算SHA256，避免一次性读入大文件
+        """
+        sha256 = hashlib.sha256()
+        with open(file_path, "rb") as f:
+            for block in iter(lambda: f.read(1024 * 1024), b""):
+                sha256.update(block)
+        return sha256.hexdigest()
 
-        return text, page_numbers
+    def load_manifest(self) -> Optional[Dict]:
+        """
+        读取知识库清单（manifest），不存在或损坏时返回None
 
-    def process_text_with_splitter(self, text: str, page_numbers: List[int]) -> FAISS:
+        清单记录了源PDF的哈希、嵌入模型、分块参数，以及每个文本块的哈希与其页码。
+        文本块哈希同时是该块嵌入向量在FAISS docstore中的ID。
         """
-        处理文本并创建向量存储
+        if not os.path.exists(self.manifest_path):
+            return None
+        try:
+            with open(self.manifest_path, "r", encoding="utf-8") as f:
+                return json.load(f)
+        except (OSError, json.JSONDecodeError) as e:
+            print(f"警告: 读取知识库清单失败: {e}")
+            return None
+
+    def save_manifest(self, pdf_hash: str, chunk_pages: Dict[str, int]) -> None:
+        """
+        保存知识库清单
+
+        参数:
+            pdf_hash: 源PDF文件的SHA256
+            chunk_pages: 文本块哈希 -> 页码
+        """
+        manifest = {
+            "pdf_path": self.pdf_path,
+            "pdf_sha256": pdf_hash,
+            "embeddings_model": self.embeddings_model,
+            "chunk_size": self.chunk_size,
+            "chunk_overlap": self.chunk_overlap,
+            "metric": self.metric,
+            "updated_at": time.strftime("%Y-%m-%dT%H:%M:%S"),
+            "chunks": chunk_pages,
+        }
+        os.makedirs(self.vector_store_path, exist_ok=True)
+        with open(self.manifest_path, "w", encoding="utf-8") as f:
+            json.dump(manifest, f, ensure_ascii=False, indent=2)
+
+    def is_manifest_compatible(self, manifest: Optional[Dict]) -> bool:
+        """
+        判断已有索引是否可以增量更新：嵌入模型、分块参数和相似度度量必须一致，否则向量不可复用
+        """
+        return (
+            manifest is not None
+            and manifest.get("embeddings_model") == self.embeddings_model
+            and manifest.get("chunk_size") == self.chunk_size
+            and manifest.get("chunk_overlap") == self.chunk_overlap
+            and manifest.get("metric") == self.metric
+        )
+        
+    def process_chunks(self, chunks: Iterable[Tuple[str, Dict]], pdf_hash: str = "",
+                       existing: Optional[FAISS] = None) -> FAISS:
+        """
+        由文本块流创建（或增量更新）向量存储
+        
+        每个文本块以其内容哈希作为docstore ID，页码作为文档元数据保存在docstore中。
+        文本块每凑够一批就立即嵌入，PDF后面的页面仍在后台提取时嵌入已经开始。
+        传入已有知识库时，只对新增或修改的文本块计算嵌入，并从索引中删除已不存在的文本块。
         
         参数:
-            text: 提取的文本内容
-            page_numbers: 每行文本对应的页码列表
+            chunks: (文本块, 元数据) 序列，如 iter_chunks_with_pages 的输出
+            pdf_hash: 源PDF文件的SHA256，写入清单
+            existing: 可选，已加载的知识库，用于增量更新
         
         返回:
             knowledgeBase: 基于FAISS的向量存储对象
         """
-        # 创建文本分割器，用于将长文本分割成小块
-        text_splitter = RecursiveCharacterTextSplitter(
-            separators=["\n\n", "\n", ".", " ", ""],
-            chunk_size=1000,
-            chunk_overlap=200,
-            length_function=len,
-        )
+        knowledgeBase = existing
+        # 以索引中实际存储的ID为准对比，清单与索引不一致时也能正确收敛
+        stored_ids = set(existing.index_to_docstore_id.values()) if existing is not None else set()
+        chunk_pages = {}
+        batch = []
+        added = 0
 
-        # 分割文本
-        chunks = text_splitter.split_text(text)
-        print(f"文本被分割成 {len(chunks)} 个块。")
-            
-        # 从文本块创建知识库
-        knowledgeBase = FAISS.from_texts(chunks, self.embeddings)
-        print("已从文本块创建知识库。")
-        
-        # 改进：存储每个文本块对应的页码信息
-        # 创建原始文本的行列表和对应的页码列表
-        lines = text.split("\n")
-        
-        # 为每个chunk找到最匹配的页码
-        page_info = {}
-        for chunk in chunks:
-            # 查找chunk在原始文本中的开始位置
-            start_idx = text.find(chunk[:100])  # 使用chunk的前100个字符作为定位点
-            if start_idx == -1:
-                # 如果找不到精确匹配，则使用模糊匹配
-                for i, line in enumerate(lines):
-                    if chunk.startswith(line[:min(50, len(line))]):
-                        start_idx = i
-                        break
-                
-                # 如果仍然找不到，尝试另一种匹配方式
-                if start_idx == -1:
-                    for i, line in enumerate(lines):
-                        if line and line in chunk:
-                            start_idx = text.find(line)
-                            break
-            
-            # 如果找到了起始位置，确定对应的页码
-            if start_idx != -1:
-                # 计算这个位置对应原文中的哪一行
-                line_count = text[:start_idx].count("\n")
-                # 确保不超出页码列表长度
-                if line_count < len(page_numbers):
-                    page_info[chunk] = page_numbers[line_count]
-                else:
-                    # 如果超出范围，使用最后一个页码
-                    page_info[chunk] = page_numbers[-1] if page_numbers else 1
-            else:
-                # 如果无法匹配，使用默认页码-1（这里应该根据实际情况设置一个合理的默认值）
-                page_info[chunk] = -1
-        
-        knowledgeBase.page_info = page_info
-        
-        # 保存向量数据库和页码信息
-        os.makedirs(self.vector_store_path, exist_ok=True)
+        for chunk, metadata in chunks:
+            chunk_hash = self.hash_chunk(chunk)
+            # 按内容哈希去重，相同内容的文本块只嵌入一次（保留第一次出现的页码）
+            if chunk_hash in chunk_pages:
+                continue
+            chunk_pages[chunk_hash] = metadata["page"]
+            if chunk_hash in stored_ids:
+                # 内容未变的块可能因前文增删而换页，直接更新其元数据，无需重新嵌入
+                existing.docstore.search(chunk_hash).metadata = metadata
+                continue
+            batch.append((chunk_hash, chunk, metadata))
+            if len(batch) >= self.embed_batch_size:
+                knowledgeBase = self._add_batch(knowledgeBase, batch)
+                added += len(batch)
+                batch = []
+
+        if batch:
+            knowledgeBase = self._add_batch(knowledgeBase, batch)
+            added += len(batch)
+        if knowledgeBase is None:
+            raise ValueError(f"未能从PDF中提取到任何文本: {self.pdf_path}")
+
+        removed = [h for h in stored_ids if h not in chunk_pages]
+        if removed:
+            knowledgeBase.delete(removed)
+        print(f"文本被分割成 {len(chunk_pages)} 个块。")
+        if existing is not None:
+            print(f"增量更新: 新增 {added} 个块，删除 {len(removed)} 个块，"
+                  f"复用 {len(chunk_pages) - added} 个块。")
+        else:
+            print("已从文本块创建知识库。")
         
-        # 保存FAISS向量数据库
-        knowledgeBase.save_local(self.vector_store_path)
+        # 以零pickle的列式格式保存，查询进程可通过mmap共享加载；
+        # 数据写入独立的子目录，目录中已有的旧版pickle文件保持不变，其他脚本仍可照常加载
+        save_knowledge_base(knowledgeBase, self.vector_store_path)
         print(f"向量数据库已保存到: {self.vector_store_path}")
-        
-        # 保存页码信息到同一目录
-        with open(os.path.join(self.vector_store_path, "page_info.pkl"), "wb") as f:
-            pickle.dump(page_info, f)
-        print(f"页码信息已保存到: {os.path.join(self.vector_store_path, 'page_info.pkl')}")
+        # 文本块已变化，旧的词法索引作废
+        if os.path.exists(self.lexical_index_path):
+            shutil.rmtree(self.lexical_index_path)
+        self.hybrid_retriever = None
+
+        # 最后写清单：中途失败时清单仍指向旧状态，下次运行会重新对比
+        self.save_manifest(pdf_hash, chunk_pages)
+        print(f"知识库清单已保存到: {self.manifest_path}")
 
         return knowledgeBase
 
+    def _add_batch(self, knowledge_base: Optional[FAISS], batch: List[Tuple[str, str, Dict]]) -> FAISS:
+        """
+        嵌入一批文本块并写入知识库，知识库尚不存在时用这一批创建
+        """
+        ids = [chunk_hash for chunk_hash, _, _ in batch]
+        texts = [chunk for _, chunk, _ in batch]
+        metadatas = [metadata for _, _, metadata in batch]
+        if knowledge_base is None:
+            return FAISS.from_texts(
+                texts, self.embeddings, metadatas=metadatas, ids=ids,
+                distance_strategy=DistanceStrategy.MAX_INNER_PRODUCT,
+            )
+        knowledge_base.add_texts(texts, metadatas=metadatas, ids=ids)
+        return knowledge_base
+
+    def _load_local(self, mmap: bool = True) -> FAISS:
+        """
+        从磁盘加载向量数据库
+        
+        参数:
+            mmap: True时只读mmap加载，多个查询进程共享同一份页缓存；
+                  增量更新需要可修改的知识库，传False
+        
+        旧版本使用FAISS.save_local（pickle）保存，并把页码单独保存在page_info.pkl中，
+        仍按旧方式加载，并为缺少页码元数据的文档补齐。
+        """
+        if is_mmap_knowledge_base(self.vector_store_path):
+            return load_knowledge_base(self.vector_store_path, self.embeddings, mmap=mmap)
+
+        print("警告: 向量数据库为旧版pickle格式，下次重建后将另存为mmap格式（旧文件保留）。")
+        knowledge_base = FAISS.load_local(self.vector_store_path, self.embeddings, allow_dangerous_deserialization=True)
+        
+        if backfill_legacy_pages(knowledge_base, self.vector_store_path):
+            print("已从旧版页码信息文件补齐页码。")
+        return knowledge_base
+
     def load_or_create_knowledge_base(self) -> FAISS:
         """
         加载已存在的知识库或创建新的知识库
         
+        通过清单中记录的PDF哈希判断知识库是否过期：未变化时直接加载；
+        PDF变化时只重新嵌入新增或修改的文本块。
+        
         返回:
             knowledge_base: 知识库对象
         """
-        # 检查向量数据库是否已存在
-        if os.path.exists(self.vector_store_path) and os.path.exists(os.path.join(self.vector_store_path, "index.faiss")):
+        index_exists = (is_mmap_knowledge_base(self.vector_store_path)
+                        or os.path.exists(os.path.join(self.vector_store_path, "index.faiss")))
+
+        if not os.path.exists(self.pdf_path):
+            if not index_exists:
+                raise FileNotFoundError(f"未找到PDF文件: {self.pdf_path}")
+            # 源文件不可用时无法校验，只能使用已有索引
+            print(f"警告: 未找到PDF文件 {self.pdf_path}，直接加载已有向量数据库。")
+            self.knowledge_base = self._load_local()
+            return self.knowledge_base
+
+        pdf_hash = self.hash_file(self.pdf_path)
+        manifest = self.load_manifest() if index_exists else None
+
+        # 检查向量数据库是否已存在且与当前PDF一致
+        if self.is_manifest_compatible(manifest) and manifest.get("pdf_sha256") == pdf_hash:
             print(f"从 {self.vector_store_path} 加载已存在的向量数据库...")
-            knowledge_base = FAISS.load_local(self.vector_store_path, self.embeddings, allow_dangerous_deserialization=True)
-            
-            # 加载页码信息
-            page_info_path = os.path.join(self.vector_store_path, "page_info.pkl")
-            if os.path.exists(page_info_path):
-                with open(page_info_path, "rb") as f:
-                    page_info = pickle.load(f)
-                knowledge_base.page_info = page_info
-                print("页码信息已加载。")
-            else:
-                print("警告: 未找到页码信息文件。")
-            
-            self.knowledge_base = knowledge_base
-            return knowledge_base
+            self.knowledge_base = self._load_local()
+            return self.knowledge_base
+
+        existing = None
+        if self.is_manifest_compatible(manifest):
+            print(f"检测到PDF已变化，正在增量更新 {self.vector_store_path} 中的知识库...")
+            existing = self._load_local(mmap=False)
         else:
-            print(f"未找到已保存的向量数据库，正在从PDF创建新的知识库...")
-            # 读取PDF文件
-            pdf_reader = PdfReader(self.pdf_path)
-            # 提取文本和页码信息
-            text, page_numbers = self.extract_text_with_page_numbers(pdf_reader)
+            if index_exists:
+                print("已有向量数据库缺少清单或嵌入配置已变化，正在重新创建知识库...")
+            else:
+                print(f"未找到已保存的向量数据库，正在从PDF创建新的知识库...")
+
+        # 多进程按页提取文本，边提取边分块、嵌入
+        pages = iter_pdf_pages(self.pdf_path, max_workers=self.extract_workers)
+        chunks = iter_chunks_with_pages(pages, chunk_size=self.chunk_size, chunk_overlap=self.chunk_overlap)
             
-            print(f"提取的文本长度: {len(text)} 个字符。")
-                
-            # 处理文本并创建知识库，同时保存到磁盘
-            knowledge_base = self.process_text_with_splitter(text, page_numbers)
-            self.knowledge_base = knowledge_base
-            return knowledge_base
+        # 处理文本并创建（或增量更新）知识库，同时保存到磁盘
+        knowledge_base = self.process_chunks(chunks, pdf_hash=pdf_hash, existing=existing)
+        self.knowledge_base = knowledge_base
+        return knowledge_base
 
     def query_knowledge_base(self, query: str, k: int = 3):
         """
@@ -182,4 +302,90 @@ class KnowledgeBaseManager:
         
         # 执行相似度搜索
         docs = self.knowledge_base.similarity_search_with_score(query, k=k)
-        return docs
\ No newline at end of file
+        return docs
+
+    def get_segmenter(self) -> SegmentationService:
+        """词法检索使用的分词服务，建索引和查询时必须一致"""
+        if self.segmenter is None:
+            self.segmenter = SegmentationService(stopwords=LEXICAL_STOPWORDS)
+        return self.segmenter
+
+    def tokenize(self, text: str) -> List[str]:
+        return self.get_segmenter().segment(text)
+
+    def load_or_build_lexical_index(self) -> BM25Index:
+        """
+        加载或构建与向量库使用相同文本块ID的BM25索引，索引行号与FAISS行号一致
+
+        返回:
+            BM25索引，行号与 self.lexical_ids 一一对应
+        """
+        if self.knowledge_base is None:
+            self.load_or_create_knowledge_base()
+
+        # 按FAISS行号顺序取文本块ID：docstore键随加载方式（mmap/内存）而不同，行号则保持不变
+        ids, texts = [], []
+        for row in range(self.knowledge_base.index.ntotal):
+            doc = self.knowledge_base.docstore.search(self.knowledge_base.index_to_docstore_id[row])
+            ids.append(doc.id or self.hash_chunk(doc.page_content))
+            texts.append(doc.page_content)
+
+        ids_path = os.path.join(self.lexical_index_path, LEXICAL_IDS_FILE)
+        if os.path.exists(ids_path):
+            with open(ids_path, "r", encoding="utf-8") as f:
+                saved = json.load(f)
+            # 仅比较数量不够：删一块再加一块后数量不变，必须逐行核对ID
+            if saved["ids"] == ids:
+                self.lexical_ids = ids
+                self.lexical_rows = {chunk_id: row for row, chunk_id in enumerate(ids)}
+                return BM25Index.load(self.lexical_index_path)
+
+        print("正在构建BM25词法索引...")
+        index = BM25Index().fit(self.get_segmenter().segment_many(texts))
+
+        index.save(self.lexical_index_path)
+        with open(ids_path, "w", encoding="utf-8") as f:
+            json.dump({"ids": ids}, f, ensure_ascii=False)
+        self.lexical_ids = ids
+        self.lexical_rows = {chunk_id: row for row, chunk_id in enumerate(ids)}
+        print(f"BM25词法索引已保存到: {self.lexical_index_path}")
+        return index
+
+    def hybrid_query_knowledge_base(self, query: str, k: int = 3, dense_k: int = 20, lexical_k: int = 20,
+                                    fusion: str = "rrf", timeouts: Optional[Dict[str, float]] = None):
+        """
+        混合检索：向量检索与BM25检索并发执行，按文本块ID用RRF（或加权得分）融合
+        
+        参数:
+            query: 查询字符串
+            k: 返回的文档数量
+            dense_k: 向量检索召回的候选数
+            lexical_k: BM25检索召回的候选数
+            fusion: rrf 或 weighted
+            timeouts: 各阶段的最长等待秒数，如 {"dense": 2.0, "bm25": 0.2}
+        
+        返回:
+            [(文档, HybridHit)]，HybridHit 包含融合得分及各阶段的排名和得分
+        """
+        if self.knowledge_base is None:
+            self.load_or_create_knowledge_base()
+        if self.hybrid_retriever is None:
+            lexical_index = self.load_or_build_lexical_index()
+            self.hybrid_retriever = HybridRetriever(
+                {
+                    "dense": vectorstore_stage(self.knowledge_base, id_of=lambda doc: doc.id or self.hash_chunk(doc.page_content)),
+                    "bm25": bm25_stage(lexical_index, self.lexical_ids, self.tokenize),
+                },
+                fusion=fusion,
+            )
+        retriever = self.hybrid_retriever
+        retriever.candidates = {"dense": dense_k, "bm25": lexical_k}
+        retriever.timeouts = timeouts or {}
+        retriever.fusion = fusion
+
+        results = []
+        for hit in retriever.retrieve(query, k=k):
+            row = self.lexical_rows[hit.chunk_id]
+            doc = self.knowledge_base.docstore.search(self.knowledge_base.index_to_docstore_id[row])
+            results.append((doc, hit))
+        return results
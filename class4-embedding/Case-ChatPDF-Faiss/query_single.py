@@ -5,12 +5,27 @@ from langchain_community.callbacks.manager import get_openai_callback
 from langchain.text_splitter import RecursiveCharacterTextSplitter
 from langchain_ollama import OllamaEmbeddings
 from langchain_community.vectorstores import FAISS
+from langchain_community.vectorstores.utils import DistanceStrategy
 from langchain_ollama import ChatOllama
-from typing import List, Tuple
 import os
-import pickle
 from metadata_store.metadata_store import MetadataStore
 import time
+import sys
+
+# 添加项目根目录到Python路径，以便导入共享的services包
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+from services.embedding_cache import CachedEmbeddings
+from services.pdf_pages import backfill_legacy_pages
+from services.vector_index import langchain_similarity, saved_index_metric
+
+# 余弦相似度模式：嵌入时归一化向量（CachedEmbeddings(normalize=True)）并使用内积索引，检索得分即余弦相似度
+COSINE_FAISS_KWARGS = {"distance_strategy": DistanceStrategy.MAX_INNER_PRODUCT}
+
+def vector_db_faiss_kwargs(path: str) -> dict:
+    """按已保存索引的实际度量选择距离策略：内积索引按余弦相似度检索，旧版L2索引仍按欧氏距离检索"""
+    if saved_index_metric(os.path.join(path, "index.faiss")) == "ip":
+        return COSINE_FAISS_KWARGS
+    return {}
 
 def query_with_accuracy_and_metadata_single(knowledge_base, query: str, k: int = 3):
     """
@@ -38,16 +53,15 @@ def query_with_accuracy_and_metadata_single(knowledge_base, query: str, k: int =
     # 首先展示每个文档片段的详细信息
     for i, (doc, score) in enumerate(docs_with_scores, 1):
         content = getattr(doc, "page_content", "")
-        source_page = knowledge_base.page_info.get(content.strip(), "未知")
+        source_page = doc.metadata.get("page", "未知")
         
-        # 计算相似度百分比（分数越小越相似，所以我们用一个转换公式）
-        # FAISS的相似度分数通常是距离，分数越小表示越相似
-        max_score = max(doc_tuple[1] for doc_tuple in docs_with_scores) if docs_with_scores else 1  # 获取最大分数用于归一化
-        similarity_percentage = max(0, min(100, (1 - score / (max_score + 0.001)) * 100))
+        # 按索引实际的度量把得分换算为余弦相似度，不同查询之间可直接比较
+        similarity = langchain_similarity(knowledge_base, score)
+        similarity_text = f"{max(0.0, similarity) * 100:.2f}%" if similarity is not None else "无法换算（索引向量未归一化）"
         
         print(f"\n文档片段 {i}:")
-        print(f"  相似度得分: {score:.4f}")
-        print(f"  估算相似度: {similarity_percentage:.2f}%")
+        print(f"  检索得分: {score:.4f}")
+        print(f"  估算相似度: {similarity_text}")
         print(f"  来源页码: {source_page}")
         # 只显示第一行，如果超过50个字符则截断并显示...
         first_line = content.split('\n')[0] if content.split('\n') else ""
@@ -55,7 +69,7 @@ def query_with_accuracy_and_metadata_single(knowledge_base, query: str, k: int =
         print(f"  内容预览: {preview}")
         
         # 添加到上下文，以便AI能参考这些内容，并包含元数据信息
-        context_parts.append(f"文档片段 {i} (相似度: {similarity_percentage:.2f}%, 来源页码: {source_page}): {content}")
+        context_parts.append(f"文档片段 {i} (相似度: {similarity_text}, 来源页码: {source_page}): {content}")
     
     # 构建最终的上下文
     context = "\\n\\n".join(context_parts)
@@ -85,7 +99,7 @@ def query_with_accuracy_and_metadata_single(knowledge_base, query: str, k: int =
         else:
             print(f"AI回答: {response}")
             
-    print(f"\n来源页码: {[knowledge_base.page_info.get(getattr(doc[0], 'page_content', '').strip(), '未知') for doc in docs_with_scores]}")
+    print(f"\n来源页码: {[doc.metadata.get('page', '未知') for doc, _ in docs_with_scores]}")
     
     # 获取存储的元数据
     metadata_store = MetadataStore()
@@ -105,16 +119,12 @@ def query_with_accuracy_and_metadata_single(knowledge_base, query: str, k: int =
 
 
 # 从向量数据库加载
-embeddings = OllamaEmbeddings(model="qwen3-embedding:4b")
-knowledgeBase = FAISS.load_local("./vector_db", embeddings, allow_dangerous_deserialization=True)
-
-# 加载页码信息
-page_info_path = os.path.join("./vector_db", "page_info.pkl")
-if os.path.exists(page_info_path):
-    with open(page_info_path, "rb") as f:
-        page_info = pickle.load(f)
-    knowledgeBase.page_info = page_info
-    print("页码信息已加载。")
+embeddings = CachedEmbeddings(OllamaEmbeddings(model="qwen3-embedding:4b"), normalize=True)
+knowledgeBase = FAISS.load_local("./vector_db", embeddings, allow_dangerous_deserialization=True,
+                                 **vector_db_faiss_kwargs("./vector_db"))
+# 旧版向量数据库的页码保存在page_info.pkl中，为缺少页码元数据的文本块补齐
+if backfill_legacy_pages(knowledgeBase, "./vector_db"):
+    print("已从旧版页码信息文件补齐页码。")
 
 # 执行单个查询示例
 query_with_accuracy_and_metadata_single(knowledgeBase, "客户经理被投诉了，投诉一次扣多少分")
\ No newline at end of file
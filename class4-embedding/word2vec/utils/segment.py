@@ -13,8 +13,12 @@ import os
 import io
 import math
 import re
+import sys
 from utils import files_processing
 
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__))))))
+from services.segmentation import SegmentationService
+
 '''
 read() 每次读取整个文件，它通常将读取到底文件内容放到一个字符串变量中，也就是说 .read() 生成文件内容是一个字符串类型。
 readline()每只读取文件的一行，通常也是读取到的一行内容放到一个字符串变量中，返回str类型。
@@ -112,6 +116,21 @@ def save_content_list(file,content_list,mode='wb'):
         content+='\n'
         save_content(file, content, mode=mode)
 
+# 分词服务按 (停用词, 用户词典) 复用：词典和停用词只加载一次，进程池在多批文件间复用
+_segmenters = {}
+
+def get_segmenter(stopwords=[], user_dict=None):
+    '''
+    获取分词服务，分词结果缓存到磁盘，大批量文本自动多进程并行分词
+    :param stopwords: 停用词
+    :param user_dict: jieba用户词典路径
+    :return: SegmentationService
+    '''
+    key = (frozenset(stopwords), user_dict)
+    if key not in _segmenters:
+        _segmenters[key] = SegmentationService(user_dict=user_dict, stopwords=stopwords)
+    return _segmenters[key]
+
 def cut_content_jieba(content):
     '''
     按字词word进行分割
@@ -139,9 +158,7 @@ def delete_stopwords(lines_list, stopwords= []):
     return sentence_segment
 
 def segment_content_word(content,stopwords=[]):
-    lines_cut_list=cut_content_jieba(content)
-    segment_list=delete_stopwords(lines_cut_list,stopwords)
-    return segment_list
+    return get_segmenter(stopwords).segment(content)
 
 def segment_content_char(content,stopwords=[]):
     lines_cut_str=cut_content_char(content)
@@ -172,6 +189,10 @@ def segment_files_list(files_list,stopwords=[],segment_type='word'):
     :param segment_type: word or char，选择分割类型，按照字符char，还是字词word分割
     :return:
     '''
+    if segment_type=='word' or segment_type is None:
+        # 按字词分割时整批交给分词服务，多进程并行并命中已缓存的结果
+        contents = read_files_list_content(files_list, mode='r')
+        return get_segmenter(stopwords).segment_many(contents)
     content_list=[]
     for i, file in enumerate(files_list):
         segment_content=segment_file(file,stopwords,segment_type)
@@ -246,11 +267,10 @@ def batch_processing_files(files_list,segment_out_dir,batchSize,stopwords=[]):
 
 
 if __name__=='__main__':
-    # 多线程分词
-    # jieba.enable_parallel()
+    # 多进程分词与分词结果缓存由 SegmentationService 负责（见 get_segmenter）
     # 加载自定义词典
     # user_path = '../data/user_dict.txt'
-    # jieba.load_userdict(user_path)
+    # get_segmenter(common_stopwords(), user_dict=user_path)
 
     # stopwords_path='data/stop_words.txt'
     # stopwords=load_stopwords(stopwords_path)
@@ -12,10 +12,12 @@ model_dir = snapshot_download('BAAI/bge-m3', cache_dir='/root/autodl-tmp/models'
 # In[1]:
 
 
+import torch
 from FlagEmbedding import BGEM3FlagModel
 
+# fp16 只在GPU上有加速效果，CPU上半精度矩阵乘法反而更慢，因此仅在有GPU时开启
 model = BGEM3FlagModel('/root/autodl-tmp/models/BAAI/bge-m3',  
-                       use_fp16=True) # Setting use_fp16 to True speeds up computation with a slight performance degradation
+                       use_fp16=torch.cuda.is_available())
 
 sentences_1 = ["What is BGE M3?", "Defination of BM25"]
 sentences_2 = ["BGE M3 is an embedding model supporting dense retrieval, lexical matching and multi-vector interaction.", 
@@ -30,3 +32,30 @@ similarity = embeddings_1 @ embeddings_2.T
 print(similarity)
 # [[0.6265, 0.3477], [0.3499, 0.678 ]]
 
+
+# In[2]:
+
+
+# CPU推理：对底层Transformer的Linear层做动态int8量化，并与浮点模型对比编码吞吐量和检索recall
+import os
+import sys
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+from services.cpu_inference import (benchmark_embedders, load_benchmark_passages, print_benchmark_report,
+                                    quantize_dynamic_int8, set_cpu_threads)
+
+set_cpu_threads()
+int8_model = BGEM3FlagModel('/root/autodl-tmp/models/BAAI/bge-m3', use_fp16=False)
+int8_model.model = quantize_dynamic_int8(int8_model.model, inplace=True)
+
+# 用互不重复的段落作为语料，重复文本会让排错的量化模型也命中相同内容，recall虚高
+bench_documents = load_benchmark_passages(limit=256)
+bench_queries = ["刘备、关羽、张飞在哪里结义？", "曹操为什么要刺杀董卓？", "孙坚是怎么死的？",
+                 "吕布为了貂蝉和董卓反目", "诸葛亮出山前隐居在哪里？", "赤壁之战中周瑜用了什么计策？"]
+report = benchmark_embedders(
+    {
+        'float': lambda texts: model.encode(texts, batch_size=12, max_length=512)['dense_vecs'],
+        'int8': lambda texts: int8_model.encode(texts, batch_size=12, max_length=512)['dense_vecs'],
+    },
+    bench_queries, bench_documents, k=10,
+)
+print_benchmark_report(report)
@@ -15,8 +15,10 @@
    - DASHSCOPE_API_KEY: 您从阿里云百炼平台获取的 API Key。
    - HF_TOKEN: (可选) 您的 Hugging Face Token，用于下载 CLIP 模型，避免手动确认。
 """
+import hashlib
 import os
 import re
+import sys
 import numpy as np
 import faiss
 from openai import OpenAI
@@ -27,6 +29,13 @@ from paddleocr import PaddleOCR
 from transformers import CLIPProcessor, CLIPModel
 import torch
 
+# 添加项目根目录到Python路径，以便导入共享的services包
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+from services.embedding_cache import cached_embedding_function, embed_with_cache
+from services.batch_embedding import embed_texts_batched, openai_embedding_request
+from services.chunk_store import ChunkMetadataStore, METADATA_FILE
+from services.vector_index import build_index, compare_with_flat, print_index_report, search
+
 # 初始化PaddleOCR
 ocr = PaddleOCR(use_angle_cls=True, lang='ch', show_log=False)
 
@@ -56,9 +65,13 @@ except Exception as e:
 # 定义全局变量
 DOCS_DIR = "disney_knowledge_base"
 IMG_DIR = os.path.join(DOCS_DIR, "images")
+INDEX_DIR = "disney_index"  # FAISS 索引与元数据的保存目录，删除该目录即可强制重建
+SOURCE_HASH_FILE = "source_hash.txt"  # 构建索引时输入文档和配置的哈希，与当前不一致时重建
 TEXT_EMBEDDING_MODEL = "text-embedding-v4"
 TEXT_EMBEDDING_DIM = 1024
 IMAGE_EMBEDDING_DIM = 512 # CLIP 'vit-base-patch32' 模型的输出维度
+# 文本索引类型: flat / ivf_flat / ivf_pq / hnsw，语料规模很大时选用近似索引
+TEXT_INDEX_TYPE = os.getenv("TEXT_INDEX_TYPE", "flat")
 
 # Step1. 文档解析与内容提取
 def parse_docx(file_path):
@@ -119,8 +132,8 @@ def image_to_text(image_path):
         return {"ocr": ""}
 
 # Step2. Embedding 与索引构建
-def get_text_embedding(text):
-    """获取文本的 Embedding。"""
+def request_text_embedding(text):
+    """调用 API 获取文本的 Embedding。"""
     response = client.embeddings.create(
         model=TEXT_EMBEDDING_MODEL,
         input=text,
@@ -128,6 +141,21 @@ def get_text_embedding(text):
     )
     return response.data[0].embedding
 
+# 获取文本的 Embedding，相同文本的结果缓存在本地磁盘，重复构建知识库时不再调用 API
+get_text_embedding = cached_embedding_function(request_text_embedding, TEXT_EMBEDDING_MODEL, TEXT_EMBEDDING_DIM)
+
+# 批量请求：每次请求发送多条文本
+request_text_embedding_batch = openai_embedding_request(client, TEXT_EMBEDDING_MODEL, TEXT_EMBEDDING_DIM)
+
+def get_text_embeddings(texts, batch_size=10, max_workers=4):
+    """批量获取文本的 Embedding：先查缓存，未命中的文本分批并发请求 API，结果顺序与输入一致。"""
+    def embed_missing(missing):
+        return embed_texts_batched(
+            missing, request_text_embedding_batch, batch_size=batch_size, max_workers=max_workers,
+            progress=lambda done, total: print(f"    - Embedding 进度: {done}/{total} 批")
+        )
+    return embed_with_cache(texts, embed_missing, TEXT_EMBEDDING_MODEL, TEXT_EMBEDDING_DIM)
+
 def get_image_embedding(image_path):
     """获取图片的 Embedding。"""
     image = Image.open(image_path)
@@ -147,8 +175,8 @@ def build_knowledge_base(docs_dir, img_dir):
     """构建完整的知识库，包括解析、切片、Embedding和索引。"""
     print("\n--- 步骤 1 & 2: 正在解析、Embedding并索引知识库 ---")
     
-    metadata_store = []
-    text_vectors = []
+    metadata_store = ChunkMetadataStore()  # 按ID索引的列式元数据存储
+    pending_texts = []  # 先收集所有文本，最后统一批量计算 Embedding
     image_vectors = []
     
     doc_id_counter = 0
@@ -178,11 +206,14 @@ def build_knowledge_base(docs_dir, img_dir):
                     metadata["type"] = "text"
                     metadata["content"] = text
                     
-                    vector = get_text_embedding(text)
-                    text_vectors.append(vector)
+                    pending_texts.append(text)
                     metadata_store.append(metadata)
                     doc_id_counter += 1
 
+    # 批量并发计算文本 Embedding，顺序与 metadata_store 中的文本条目一致
+    print(f"  - 正在批量计算 {len(pending_texts)} 个文本片段的 Embedding...")
+    text_vectors = get_text_embeddings(pending_texts)
+
     # 处理images目录中的独立图片文件
     print("  - 正在处理独立图片文件...")
     for img_filename in os.listdir(img_dir):
@@ -207,17 +238,17 @@ def build_knowledge_base(docs_dir, img_dir):
             doc_id_counter += 1
 
     # 创建 FAISS 索引
-    # 文本索引
-    text_index = faiss.IndexFlatL2(TEXT_EMBEDDING_DIM)
-    text_index_map = faiss.IndexIDMap(text_index)
-    text_ids = [m["id"] for m in metadata_store if m["type"] == "text"]
-    if text_vectors:  # 只有当有文本向量时才添加到索引
-        text_index_map.add_with_ids(np.array(text_vectors).astype('float32'), np.array(text_ids))
+    # 文本索引（近似索引会在采样数据上自动训练）
+    text_ids = metadata_store.ids_of_type("text")
+    text_matrix = np.array(text_vectors, dtype='float32').reshape(-1, TEXT_EMBEDDING_DIM)
+    text_index_map = build_index(text_matrix, ids=text_ids, index_type=TEXT_INDEX_TYPE)
+    if TEXT_INDEX_TYPE != "flat" and text_vectors:
+        print_index_report(compare_with_flat(text_index_map, text_matrix, ids=text_ids, k=3))
     
     # 图像索引
     image_index = faiss.IndexFlatL2(IMAGE_EMBEDDING_DIM)
     image_index_map = faiss.IndexIDMap(image_index)
-    image_ids = [m["id"] for m in metadata_store if m["type"] == "image"]
+    image_ids = metadata_store.ids_of_type("image")
     if image_vectors:  # 只有当有图像向量时才添加到索引
         image_index_map.add_with_ids(np.array(image_vectors).astype('float32'), np.array(image_ids))
     
@@ -225,10 +256,56 @@ def build_knowledge_base(docs_dir, img_dir):
     
     return metadata_store, text_index_map, image_index_map
 
+def compute_source_hash(docs_dir):
+    """计算知识库目录下全部文件（含图片）内容和索引配置的哈希，任一文档增删改或更换模型都会改变该值。"""
+    digest = hashlib.sha256()
+    digest.update(f"{TEXT_EMBEDDING_MODEL}|{TEXT_EMBEDDING_DIM}|{TEXT_INDEX_TYPE}|{IMAGE_EMBEDDING_DIM}".encode("utf-8"))
+    for root, dirs, files in os.walk(docs_dir):
+        dirs.sort()
+        for filename in sorted(files):
+            if filename.startswith('.'):
+                continue
+            file_path = os.path.join(root, filename)
+            digest.update(os.path.relpath(file_path, docs_dir).encode("utf-8"))
+            with open(file_path, "rb") as f:
+                digest.update(hashlib.sha256(f.read()).digest())
+    return digest.hexdigest()
+
+def is_knowledge_base_current(index_dir, source_hash):
+    """已保存的知识库存在，且构建时的输入哈希与当前一致时返回 True。"""
+    hash_path = os.path.join(index_dir, SOURCE_HASH_FILE)
+    if not os.path.exists(os.path.join(index_dir, METADATA_FILE)) or not os.path.exists(hash_path):
+        return False
+    with open(hash_path, encoding="utf-8") as f:
+        return f.read().strip() == source_hash
+
+def save_knowledge_base(index_dir, metadata_store, text_index, image_index, source_hash):
+    """将元数据与 FAISS 索引保存到同一目录，最后写入输入哈希，保存中途失败时下次会重建。"""
+    os.makedirs(index_dir, exist_ok=True)
+    hash_path = os.path.join(index_dir, SOURCE_HASH_FILE)
+    if os.path.exists(hash_path):
+        os.remove(hash_path)
+    faiss.write_index(text_index, os.path.join(index_dir, "text.index"))
+    faiss.write_index(image_index, os.path.join(index_dir, "image.index"))
+    metadata_store.save(index_dir)
+    with open(hash_path, "w", encoding="utf-8") as f:
+        f.write(source_hash)
+    print(f"知识库已保存到: {index_dir}")
+
+def load_knowledge_base(index_dir):
+    """从目录加载元数据与 FAISS 索引。"""
+    metadata_store = ChunkMetadataStore.load(index_dir)
+    text_index = faiss.read_index(os.path.join(index_dir, "text.index"))
+    image_index = faiss.read_index(os.path.join(index_dir, "image.index"))
+    print(f"已从 {index_dir} 加载知识库，共 {len(metadata_store)} 条元数据。")
+    return metadata_store, text_index, image_index
+
 # Step3. RAG 问答流程
-def rag_ask(query, metadata_store, text_index, image_index, k=3):
+def rag_ask(query, metadata_store, text_index, image_index, k=3, nprobe=None, ef_search=None):
     """
     执行完整的 RAG 流程：检索 -> 构建Prompt -> 生成答案
+
+    nprobe / ef_search 只对本次文本检索生效，分别用于 IVF 和 HNSW 索引
     """
     print(f"\n--- 收到用户提问: '{query}' ---")
     
@@ -238,11 +315,11 @@ def rag_ask(query, metadata_store, text_index, image_index, k=3):
     
     # 文本检索
     query_text_vec = np.array([get_text_embedding(query)]).astype('float32')
-    distances, text_ids = text_index.search(query_text_vec, k)
+    distances, text_ids = search(text_index, query_text_vec, k, nprobe=nprobe, ef_search=ef_search)
     for i, doc_id in enumerate(text_ids[0]):
         if doc_id != -1:
-            # 通过ID在元数据中查找
-            match = next((item for item in metadata_store if item["id"] == doc_id), None)
+            # 通过ID在元数据中查找（哈希索引，O(1)）
+            match = metadata_store.get(doc_id)
             if match:
                 retrieved_context.append(match)
                 print(f"    - 文本检索命中 (ID: {doc_id}, 距离: {distances[0][i]:.4f})")
@@ -255,7 +332,7 @@ def rag_ask(query, metadata_store, text_index, image_index, k=3):
         distances, image_ids = image_index.search(query_clip_vec, 1) # 只找最相关的1张图
         for i, doc_id in enumerate(image_ids[0]):
             if doc_id != -1:
-                match = next((item for item in metadata_store if item["id"] == doc_id), None)
+                match = metadata_store.get(doc_id)
                 if match:
                     # 将OCR内容也加入上下文
                     context_text = f"找到一张相关图片，图片路径: {match['path']}。图片上的文字是: '{match['ocr']}'"
@@ -311,8 +388,15 @@ def rag_ask(query, metadata_store, text_index, image_index, k=3):
 
 # --- 主函数 ---
 if __name__ == "__main__":
-    # 1. 构建知识库 (一次性离线过程)
-    metadata_store, text_index, image_index = build_knowledge_base(DOCS_DIR, IMG_DIR)
+    # 1. 加载已保存的知识库；不存在或文档、配置已变化时重新构建并保存
+    source_hash = compute_source_hash(DOCS_DIR)
+    if is_knowledge_base_current(INDEX_DIR, source_hash):
+        metadata_store, text_index, image_index = load_knowledge_base(INDEX_DIR)
+    else:
+        if os.path.exists(os.path.join(INDEX_DIR, METADATA_FILE)):
+            print("知识库文档或索引配置已变化，重新构建索引...")
+        metadata_store, text_index, image_index = build_knowledge_base(DOCS_DIR, IMG_DIR)
+        save_knowledge_base(INDEX_DIR, metadata_store, text_index, image_index, source_hash)
     
     # 2. 开始问答
     print("\n=============================================")
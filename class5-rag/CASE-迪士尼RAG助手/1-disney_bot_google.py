@@ -17,6 +17,7 @@
 """
 import os
 import re
+import sys
 import numpy as np
 import faiss
 from docx import Document as DocxDocument
@@ -27,6 +28,10 @@ from transformers import CLIPProcessor, CLIPModel
 import torch
 import google.generativeai as genai
 
+# 添加项目根目录到Python路径，以便导入共享的services包
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+from services.chunk_store import ChunkMetadataStore
+
 # 初始化PaddleOCR
 ocr = PaddleOCR(use_angle_cls=True, lang='ch', show_log=False)
 
@@ -145,7 +150,7 @@ def build_knowledge_base(docs_dir, img_dir):
     """构建完整的知识库，包括解析、切片、Embedding和索引。"""
     print("\n--- 步骤 1 & 2: 正在解析、Embedding并索引知识库 ---")
     
-    metadata_store = []
+    metadata_store = ChunkMetadataStore()  # 按ID索引的列式元数据存储
     text_vectors = []
     image_vectors = []
     
@@ -208,14 +213,14 @@ def build_knowledge_base(docs_dir, img_dir):
     # 文本索引
     text_index = faiss.IndexFlatL2(TEXT_EMBEDDING_DIM)
     text_index_map = faiss.IndexIDMap(text_index)
-    text_ids = [m["id"] for m in metadata_store if m["type"] == "text"]
+    text_ids = metadata_store.ids_of_type("text")
     if text_vectors:  # 只有当有文本向量时才添加到索引
         text_index_map.add_with_ids(np.array(text_vectors).astype('float32'), np.array(text_ids))
     
     # 图像索引
     image_index = faiss.IndexFlatL2(IMAGE_EMBEDDING_DIM)
     image_index_map = faiss.IndexIDMap(image_index)
-    image_ids = [m["id"] for m in metadata_store if m["type"] == "image"]
+    image_ids = metadata_store.ids_of_type("image")
     if image_vectors:  # 只有当有图像向量时才添加到索引
         image_index_map.add_with_ids(np.array(image_vectors).astype('float32'), np.array(image_ids))
     
@@ -239,8 +244,8 @@ def rag_ask(query, metadata_store, text_index, image_index, k=3):
     distances, text_ids = text_index.search(query_text_vec, k)
     for i, doc_id in enumerate(text_ids[0]):
         if doc_id != -1:
-            # 通过ID在元数据中查找
-            match = next((item for item in metadata_store if item["id"] == doc_id), None)
+            # 通过ID在元数据中查找（哈希索引，O(1)）
+            match = metadata_store.get(doc_id)
             if match:
                 retrieved_context.append(match)
                 print(f"    - 文本检索命中 (ID: {doc_id}, 距离: {distances[0][i]:.4f})")
@@ -253,7 +258,7 @@ def rag_ask(query, metadata_store, text_index, image_index, k=3):
         distances, image_ids = image_index.search(query_clip_vec, 1) # 只找最相关的1张图
         for i, doc_id in enumerate(image_ids[0]):
             if doc_id != -1:
-                match = next((item for item in metadata_store if item["id"] == doc_id), None)
+                match = metadata_store.get(doc_id)
                 if match:
                     # 将OCR内容也加入上下文
                     context_text = f"找到一张相关图片，图片路径: {match['path']}。图片上的文字是: '{match['ocr']}'"
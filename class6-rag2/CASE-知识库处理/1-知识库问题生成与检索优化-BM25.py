@@ -1,15 +1,20 @@
 # 知识库问题生成与检索优化 - BM25版本
 # 导入依赖库
 import os
+import sys
 import json
+import hashlib
 import numpy as np
-from openai import OpenAI
+from openai import AsyncOpenAI, OpenAI
 import pandas as pd
 from datetime import datetime
-from rank_bm25 import BM25Okapi
-import jieba
 import re
 
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+from services.async_llm import DEFAULT_CONCURRENCY, run_concurrent_sync
+from services.bm25_index import BM25Index
+from services.segmentation import SegmentationService
+
 # 从环境变量中获取 API Key
 DASHSCOPE_API_KEY = os.getenv('DASHSCOPE_API_KEY')
 
@@ -19,6 +24,13 @@ client = OpenAI(
     base_url="https://dashscope.aliyuncs.com/compatible-mode/v1"
 )
 
+# 异步客户端，用于批量并发生成问题；限流由 run_concurrent 统一退避重试，客户端自身不再重试
+async_client = AsyncOpenAI(
+    api_key=DASHSCOPE_API_KEY,
+    base_url="https://dashscope.aliyuncs.com/compatible-mode/v1",
+    max_retries=0,
+)
+
 # 预处理AI响应中的JSON格式
 def preprocess_json_response(response):
     """预处理AI响应，移除markdown代码块格式"""
@@ -46,23 +58,34 @@ def get_completion(prompt, model="qwen-turbo-latest"):
     )
     return response.choices[0].message.content
 
+# 基于 prompt 异步生成文本
+async def get_completion_async(prompt, model="qwen-turbo-latest"):
+    messages = [{"role": "user", "content": prompt}]
+    response = await async_client.chat.completions.create(
+        model=model,
+        messages=messages,
+        temperature=0.7,
+    )
+    return response.choices[0].message.content
+
+# 停用词
+STOP_WORDS = {'的', '了', '在', '是', '我', '有', '和', '就', '不', '人', '都', '一', '一个', '上', '也', '很', '到', '说', '要', '去', '你', '会', '着', '没有', '看', '好', '自己', '这'}
+
+# 分词服务：移除标点符号和特殊字符后用jieba分词，过滤停用词和短词；
+# 结果按文本缓存到磁盘，重建索引时相同文本不再重复分词
+segmenter = SegmentationService(stopwords=STOP_WORDS, min_word_len=2, strip_pattern=r'[^\w\s]')
+
 # 文本预处理和分词
 def preprocess_text(text):
     """文本预处理和分词"""
     if not text:
         return []
-    
-    # 移除标点符号和特殊字符
-    text = re.sub(r'[^\w\s]', '', text)
-    
-    # 使用jieba分词
-    words = jieba.lcut(text)
-    
-    # 过滤停用词和短词
-    stop_words = {'的', '了', '在', '是', '我', '有', '和', '就', '不', '人', '都', '一', '一个', '上', '也', '很', '到', '说', '要', '去', '你', '会', '着', '没有', '看', '好', '自己', '这'}
-    words = [word for word in words if len(word) > 1 and word not in stop_words]
-    
-    return words
+    return segmenter.segment(text)
+
+def preprocess_texts(texts):
+    """批量文本预处理和分词，文本较多时多进程并行"""
+    texts = [text or "" for text in texts]
+    return segmenter.segment_many(texts)
 
 class KnowledgeBaseOptimizer:
     def __init__(self, model="qwen-turbo-latest"):
@@ -77,6 +100,10 @@ class KnowledgeBaseOptimizer:
         
     def generate_questions_for_chunk(self, knowledge_chunk, num_questions=5):
         """为单个知识切片生成多样化问题"""
+        response = get_completion(self._questions_prompt(knowledge_chunk, num_questions), self.model)
+        return self._parse_questions(response, knowledge_chunk)
+    
+    def _questions_prompt(self, knowledge_chunk, num_questions):
         instruction = """
 你是一个专业的问答系统专家。给定的知识内容能回答哪些多样化的问题，这些问题可以：
 1. 使用不同的问法（直接问、间接问、对比问等）
@@ -107,9 +134,10 @@ class KnowledgeBaseOptimizer:
 
 ### 生成结果 ###
 """
-        
-        response = get_completion(prompt, self.model)
-        
+        return prompt
+    
+    def _parse_questions(self, response, knowledge_chunk, strict=False):
+        """strict为True时解析失败直接抛出异常，批量生成时不把兜底结果写入检查点"""
         # 预处理响应，移除markdown代码块格式
         response = preprocess_json_response(response)
         
@@ -117,6 +145,8 @@ class KnowledgeBaseOptimizer:
             result = json.loads(response)
             return result.get('questions', [])
         except json.JSONDecodeError as e:
+            if strict:
+                raise ValueError(f"问题生成结果JSON解析失败: {e}") from e
             print(f"JSON解析失败: {e}")
             print(f"AI返回内容: {response[:50]}...")
             # 如果JSON解析失败，返回简单的问题列表
@@ -132,6 +162,19 @@ class KnowledgeBaseOptimizer:
         content_metadata = []
         question_metadata = []
         
+        # 先批量分词（多进程并行并写入缓存），下面逐条取分词结果时直接命中缓存
+        all_texts = []
+        for chunk in knowledge_base:
+            text = chunk.get('content', '')
+            if not text.strip():
+                continue
+            all_texts.append(text)
+            for question_data in chunk.get('generated_questions') or []:
+                question = question_data.get('question', '')
+                if question.strip():
+                    all_texts.append(f"内容：{text} 问题：{question}")
+        preprocess_texts(all_texts)
+        
         for i, chunk in enumerate(knowledge_base):
             # 获取知识切片的内容
             text = chunk.get('content', '')
@@ -171,15 +214,15 @@ class KnowledgeBaseOptimizer:
                                 "question_data": question_data
                             })
         
-        # 创建BM25索引
+        # 创建BM25索引（稀疏矩阵实现，可批量打分）
         if content_documents:
-            self.content_bm25 = BM25Okapi(content_documents)
+            self.content_bm25 = BM25Index().fit(content_documents)
             self.content_documents = content_documents
             self.content_metadata = content_metadata
             print(f"原文索引构建完成，共索引 {len(content_documents)} 个知识切片")
         
         if question_documents:
-            self.question_bm25 = BM25Okapi(question_documents)
+            self.question_bm25 = BM25Index().fit(question_documents)
             self.question_documents = question_documents
             self.question_metadata = question_metadata
             print(f"问题索引构建完成，共索引 {len(question_documents)} 个问题")
@@ -187,80 +230,117 @@ class KnowledgeBaseOptimizer:
         if not content_documents and not question_documents:
             print("没有有效的内容可以索引")
     
+    def _get_index(self, search_type):
+        """返回检索类型对应的 (BM25索引, 元数据列表)"""
+        if search_type == "content":
+            return self.content_bm25, self.content_metadata
+        if search_type == "question":
+            return self.question_bm25, self.question_metadata
+        return None, []
+    
     def search_similar_chunks(self, query, k=3, search_type="content"):
         """使用BM25搜索相似的内容（原文或问题）"""
-        if search_type == "content":
-            if not self.content_bm25:
-                return []
-            bm25 = self.content_bm25
-            metadata_store = self.content_metadata
-        elif search_type == "question":
-            if not self.question_bm25:
-                return []
-            bm25 = self.question_bm25
-            print('question_bm25=', bm25)
-            metadata_store = self.question_metadata
-        else:
-            return []
+        return self.search_similar_chunks_batch([query], k=k, search_type=search_type)[0]
+    
+    def search_similar_chunks_batch(self, queries, k=3, search_type="content"):
+        """批量BM25检索：所有查询通过一次稀疏矩阵乘法打分，每个查询用argpartition取top-k"""
+        bm25, metadata_store = self._get_index(search_type)
+        if not bm25:
+            return [[] for _ in queries]
         
         try:
             # 预处理查询
-            query_words = preprocess_text(query)
-            if not query_words:
-                return []
+            query_words = preprocess_texts(queries)
             
-            # 搜索最相似的k个内容
-            scores = bm25.get_scores(query_words)
-            
-            # 获取top-k结果
-            top_indices = np.argsort(scores)[::-1][:k]
-            
-            results = []
-            for idx in top_indices:
-                if scores[idx] > 0:  # 只返回有相关性的结果
-                    metadata = metadata_store[idx]
+            all_results = []
+            for hits in bm25.top_k(query_words, k=k):
+                results = []
+                for idx, score in hits:  # top_k 只返回有相关性（得分大于0）的结果
                     # 将BM25分数转换为0-1范围的相似度
-                    similarity = min(1.0, scores[idx] / 10.0)  # 归一化
+                    similarity = min(1.0, score / 10.0)  # 归一化
                     results.append({
-                        "metadata": metadata,
-                        "score": scores[idx],
+                        "metadata": metadata_store[idx],
+                        "score": score,
                         "similarity": similarity
                     })
+                all_results.append(results)
             
-            return results
+            return all_results
             
         except Exception as e:
             print(f"搜索失败: {e}")
-            return []
+            return [[] for _ in queries]
     
-    def calculate_similarity(self, query, knowledge_chunk):
+    def save_index(self, directory):
+        """保存原文/问题BM25索引及其元数据，便于评估时直接加载而无需重新分词建索引"""
+        os.makedirs(directory, exist_ok=True)
+        for search_type in ("content", "question"):
+            bm25, metadata_store = self._get_index(search_type)
+            if not bm25:
+                continue
+            bm25.save(os.path.join(directory, search_type))
+            with open(os.path.join(directory, search_type, "metadata.json"), "w", encoding="utf-8") as f:
+                json.dump(metadata_store, f, ensure_ascii=False)
+        print(f"BM25索引已保存到: {directory}")
+    
+    def load_index(self, directory):
+        """加载 save_index 保存的BM25索引"""
+        for search_type in ("content", "question"):
+            path = os.path.join(directory, search_type)
+            if not os.path.exists(path):
+                continue
+            bm25 = BM25Index.load(path)
+            with open(os.path.join(path, "metadata.json"), "r", encoding="utf-8") as f:
+                metadata_store = json.load(f)
+            if search_type == "content":
+                self.content_bm25, self.content_metadata = bm25, metadata_store
+            else:
+                self.question_bm25, self.question_metadata = bm25, metadata_store
+        print(f"已从 {directory} 加载BM25索引")
+    
+    def calculate_similarity(self, query, knowledge_chunk, search_type="content"):
         """计算查询与知识切片的相似度（使用BM25）"""
+        return self.calculate_similarity_batch(query, [knowledge_chunk], search_type)[0]
+    
+    def calculate_similarity_batch(self, query, texts, search_type="content"):
+        """
+        一次计算查询与多个文本的BM25相似度
+        
+        使用 build_knowledge_index 构建（或 load_index 加载）的语料级统计量（IDF、平均长度）打分，
+        不用候选文本本身建索引：候选很少时IDF会退化甚至为负。尚未建索引时抛出 RuntimeError。
+        """
+        bm25, _ = self._get_index(search_type)
+        if bm25 is None:
+            raise RuntimeError("尚未构建BM25索引，请先调用 build_knowledge_index 或 load_index")
         try:
             query_words = preprocess_text(query)
-            chunk_words = preprocess_text(knowledge_chunk)
-            
-            if not query_words or not chunk_words:
-                return 0.0
+            texts_words = preprocess_texts(texts)
+            if not query_words or not texts_words:
+                return [0.0] * len(texts)
             
-            # 创建临时BM25索引
-            temp_bm25 = BM25Okapi([chunk_words])
-            scores = temp_bm25.get_scores(query_words)
+            scores = bm25.score_candidates(query_words, texts_words)
             
-            # 返回最高分数并归一化
-            max_score = max(scores) if scores else 0.0
-            return min(1.0, max_score / 10.0)
+            # 归一化到0-1
+            return [min(1.0, float(score) / 10.0) for score in scores]
             
         except Exception as e:
             print(f"相似度计算失败: {e}")
-            return 0.0
-    
-    def calculate_question_similarity(self, user_query, generated_questions):
-        """计算用户查询与生成问题的相似度"""
-        similarities = []
-        for question_data in generated_questions:
-            question = question_data['question']
-            similarity = self.calculate_similarity(user_query, question)
-            similarities.append(similarity)
+            return [0.0] * len(texts)
+    
+    def calculate_question_similarity(self, user_query, generated_questions, content):
+        """
+        计算用户查询与生成问题的相似度
+        
+        问题索引中的文档是 "内容：{原文} 问题：{问题}" 的拼接文本，这里按同样的格式拼接后打分，
+        使文档长度归一化与索引一致，得分可与检索得分比较。
+        
+        参数:
+            user_query: 用户查询
+            generated_questions: 该知识切片生成的问题列表
+            content: 该知识切片的原文
+        """
+        combined_texts = [f"内容：{content} 问题：{question_data['question']}" for question_data in generated_questions]
+        similarities = self.calculate_similarity_batch(user_query, combined_texts, search_type="question")
         return max(similarities) if similarities else 0.0
     
     def evaluate_retrieval_methods(self, knowledge_base, test_queries):
@@ -277,12 +357,17 @@ class KnowledgeBaseOptimizer:
             'query_details': []
         }
         
+        # 所有测试查询批量检索
+        queries = [query_info['query'] for query_info in test_queries]
+        all_content_results = self.search_similar_chunks_batch(queries, k=1, search_type="content")
+        all_question_results = self.search_similar_chunks_batch(queries, k=1, search_type="question")
+        
         for i, query_info in enumerate(test_queries):
             user_query = query_info['query']
             correct_chunk = query_info['correct_chunk']
             
             # 方法1：BM25原文检索
-            content_results = self.search_similar_chunks(user_query, k=1, search_type="content")
+            content_results = all_content_results[i]
             content_correct = False
             content_score = 0.0
             content_chunk_id = None
@@ -293,7 +378,7 @@ class KnowledgeBaseOptimizer:
                 content_chunk_id = best_match['id']
             
             # 方法2：BM25问题检索
-            question_results = self.search_similar_chunks(user_query, k=1, search_type="question")
+            question_results = all_question_results[i]
             question_correct = False
             question_score = 0.0
             question_chunk_id = None
@@ -325,6 +410,10 @@ class KnowledgeBaseOptimizer:
     
     def generate_diverse_questions(self, knowledge_chunk, num_questions=8):
         """生成更多样化的问题（更丰富）"""
+        response = get_completion(self._diverse_questions_prompt(knowledge_chunk, num_questions), self.model)
+        return self._parse_diverse_questions(response)
+    
+    def _diverse_questions_prompt(self, knowledge_chunk, num_questions):
         instruction = """
 你是一个专业的问答系统专家。请为给定的知识内容生成高度多样化的问题，确保：
 1. 问题类型多样化：直接问、间接问、对比问、条件问、假设问、推理问等
@@ -360,9 +449,10 @@ class KnowledgeBaseOptimizer:
 
 ### 生成结果 ###
 """
-        
-        response = get_completion(prompt, self.model)
-        
+        return prompt
+    
+    def _parse_diverse_questions(self, response, strict=False):
+        """strict为True时解析失败直接抛出异常，批量生成时不把空结果写入检查点"""
         # 预处理响应，移除markdown代码块格式
         response = preprocess_json_response(response)
         
@@ -370,9 +460,53 @@ class KnowledgeBaseOptimizer:
             result = json.loads(response)
             return result.get('questions', [])
         except json.JSONDecodeError as e:
+            if strict:
+                raise ValueError(f"多样化问题生成结果JSON解析失败: {e}") from e
             print(f"多样化问题生成JSON解析失败: {e}")
             print(f"AI返回内容: {response[:200]}...")
             return []
+    
+    def generate_questions_batch(self, knowledge_base, num_questions=5, diverse=False,
+                                 concurrency=DEFAULT_CONCURRENCY, checkpoint_path=None):
+        """
+        为整个知识库并发生成问题，结果写入每个切片的 generated_questions
+        
+        用 asyncio 并发调用LLM（信号量限制并发数，限流时退避重试）；指定 checkpoint_path 时
+        每完成一个切片就追加写入检查点，中途中断后重新运行会跳过已完成的切片。
+        
+        参数:
+            knowledge_base: 知识切片列表
+            num_questions: 每个切片生成的问题数
+            diverse: 是否使用 generate_diverse_questions 的多样化提示词
+            concurrency: 最大并发请求数
+            checkpoint_path: JSONL检查点路径
+        返回:
+            生成成功的切片数
+        """
+        tasks = []
+        keys = []
+        for i, chunk in enumerate(knowledge_base):
+            content = chunk.get('content', '')
+            # 检查点键包含内容哈希和生成参数，切片内容或参数变化后会重新生成
+            digest = hashlib.sha256(f"{diverse}|{num_questions}|{content}".encode('utf-8')).hexdigest()[:16]
+            key = f"{chunk.get('id', f'chunk_{i}')}:{digest}"
+            keys.append(key)
+            if content.strip():
+                tasks.append((key, content))
+        
+        # 解析失败时抛出异常，该切片记为失败、不写入检查点，重新运行时会再次生成
+        async def worker(content):
+            if diverse:
+                response = await get_completion_async(self._diverse_questions_prompt(content, num_questions), self.model)
+                return self._parse_diverse_questions(response, strict=True)
+            response = await get_completion_async(self._questions_prompt(content, num_questions), self.model)
+            return self._parse_questions(response, content, strict=True)
+        
+        results = run_concurrent_sync(tasks, worker, concurrency=concurrency, checkpoint_path=checkpoint_path)
+        for chunk, key in zip(knowledge_base, keys):
+            if key in results:
+                chunk['generated_questions'] = results[key]
+        return sum(key in results for key in keys)
 
 def main():
     # 初始化知识库优化器
@@ -467,9 +601,9 @@ def main():
     
     # 为知识库生成问题
     print('正在为知识库生成问题...')
-    for chunk in knowledge_base:
-        chunk['generated_questions'] = optimizer.generate_questions_for_chunk(chunk['content'])
-        #print("chunk['generated_questions']=", chunk['generated_questions'])
+    # 并发生成，已完成的切片记录在检查点中，重新运行时不会重复生成
+    checkpoint_path = os.path.join(os.path.dirname(os.path.abspath(__file__)), "generated_questions.jsonl")
+    optimizer.generate_questions_batch(knowledge_base, checkpoint_path=checkpoint_path)
     print('为知识库生成问题完毕')
     
     # 评估检索方法
@@ -2,9 +2,16 @@
 # 导入依赖库
 import dashscope
 import os
+import sys
 import json
 from datetime import datetime
 from collections import Counter
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+from services.batch_embedding import embed_texts_batched
+from services.embedding_cache import embed_with_cache
+from services.knowledge_clustering import DEFAULT_MAX_CLUSTER_SIZE, DEFAULT_SIMILARITY_THRESHOLD, cluster_by_similarity
 
 # 从环境变量中获取 API Key
 dashscope.api_key = os.getenv('DASHSCOPE_API_KEY')
@@ -37,6 +44,20 @@ def get_completion(prompt, model="qwen-turbo-latest"):
     )
     return response.output.choices[0].message.content
 
+# 批量文本向量（单次请求最多10条）
+def request_text_embeddings(texts, model="text-embedding-v4"):
+    response = dashscope.TextEmbedding.call(model=model, input=texts)
+    embeddings = sorted(response.output["embeddings"], key=lambda item: item["text_index"])
+    return [item["embedding"] for item in embeddings]
+
+# 分批并发请求，已计算过的文本直接从磁盘缓存读取
+def get_text_embeddings(texts, model="text-embedding-v4"):
+    return embed_with_cache(
+        texts,
+        lambda batch: embed_texts_batched(batch, lambda b: request_text_embeddings(b, model)),
+        model,
+    )
+
 class ConversationKnowledgeExtractor:
     def __init__(self, model="qwen-turbo-latest"):
         self.model = model
@@ -114,8 +135,14 @@ class ConversationKnowledgeExtractor:
         
         return all_knowledge
     
-    def merge_similar_knowledge(self, knowledge_list):
-        """使用LLM合并相似的知识点，过滤掉需求和问题类型"""
+    def merge_similar_knowledge(self, knowledge_list, similarity_threshold=DEFAULT_SIMILARITY_THRESHOLD,
+                                max_cluster_size=DEFAULT_MAX_CLUSTER_SIZE, max_workers=8):
+        """
+        使用LLM合并相似的知识点，过滤掉需求和问题类型
+        
+        同类型的知识点先按内容向量聚成近似重复的簇（每簇最多max_cluster_size条），
+        只有多于一条的簇才并发交给LLM合并，单例直接保留。
+        """
         # 过滤掉需求和问题类型的知识，因为它们是临时的、个性化的
         filtered_knowledge = [
             knowledge for knowledge in knowledge_list 
@@ -134,17 +161,24 @@ class ConversationKnowledgeExtractor:
                 knowledge_by_type[knowledge_type] = []
             knowledge_by_type[knowledge_type].append(knowledge)
         
+        # 在每个知识类型内按内容向量聚类，单例直接保留，其余簇并发交给LLM合并
         merged_knowledge = []
-        
-        # 对每个知识类型分别进行LLM合并
+        clusters = []
         for knowledge_type, knowledge_group in knowledge_by_type.items():
-            if len(knowledge_group) == 1:
-                # 只有一个知识点，直接添加
-                merged_knowledge.append(knowledge_group[0])
-            else:
-                # 多个知识点，使用LLM合并
-                merged = self.merge_knowledge_with_llm(knowledge_group, knowledge_type)
-                merged_knowledge.append(merged)
+            group_vectors = get_text_embeddings([knowledge.get('content', '') for knowledge in knowledge_group])
+            for cluster in cluster_by_similarity(group_vectors, threshold=similarity_threshold,
+                                                 max_cluster_size=max_cluster_size):
+                members = [knowledge_group[i] for i in cluster]
+                merged_knowledge.append(members[0] if len(members) == 1 else None)
+                clusters.append((knowledge_type, members))
+        
+        to_merge = [(i, knowledge_type, members) for i, (knowledge_type, members) in enumerate(clusters) if len(members) > 1]
+        print(f"聚类得到 {len(clusters)} 个簇，其中 {len(to_merge)} 个需要LLM合并")
+        with ThreadPoolExecutor(max_workers=max_workers) as executor:
+            futures = [(i, executor.submit(self.merge_knowledge_with_llm, members, knowledge_type))
+                       for i, knowledge_type, members in to_merge]
+            for i, future in futures:
+                merged_knowledge[i] = future.result()
         
         return merged_knowledge
     
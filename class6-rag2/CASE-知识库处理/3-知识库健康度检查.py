@@ -2,9 +2,19 @@
 # 导入依赖库
 import dashscope
 import os
+import sys
 import json
 import re
 from datetime import datetime
+from concurrent.futures import ThreadPoolExecutor
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+from services.batch_embedding import embed_texts_batched
+from services.conflict_candidates import find_candidate_pairs
+from services.embedding_cache import embed_with_cache
+from services.fact_extraction import DEFAULT_RECHECK_DAYS, FactIndex
+from services.kb_shards import DEFAULT_SHARD_TOKENS, shard_by_token_budget
+from services.segmentation import SegmentationService
 
 # 从环境变量中获取 API Key
 dashscope.api_key = os.getenv('DASHSCOPE_API_KEY')
@@ -20,10 +30,50 @@ def get_completion(prompt, model="qwen-turbo-latest"):
     )
     return response.output.choices[0].message.content
 
+# 批量文本向量（单次请求最多10条），已计算过的文本直接从磁盘缓存读取
+def request_text_embeddings(texts, model="text-embedding-v4"):
+    response = dashscope.TextEmbedding.call(model=model, input=texts)
+    embeddings = sorted(response.output["embeddings"], key=lambda item: item["text_index"])
+    return [item["embedding"] for item in embeddings]
+
+def get_text_embeddings(texts, model="text-embedding-v4"):
+    return embed_with_cache(
+        texts,
+        lambda batch: embed_texts_batched(batch, lambda b: request_text_embeddings(b, model)),
+        model,
+    )
+
+# 冲突候选预筛选用的分词：过滤停用词、单字和纯数字（数字不同恰恰是冲突所在，不能作为同一对象的依据）
+STOP_WORDS = {'的', '了', '在', '是', '和', '为', '有', '也', '可以', '或', '等', '以及', '通常'}
+segmenter = SegmentationService(stopwords=STOP_WORDS, min_word_len=2, strip_pattern=r'[^\w\s]')
+
+def tokenize_for_conflicts(texts):
+    return [[word for word in words if not word.isdigit()] for words in segmenter.segment_many(texts)]
+
+# 评分字段可能以字符串形式返回，统一转为0-1之间的浮点数
+def parse_score(value, default=0.0):
+    try:
+        return min(1.0, max(0.0, float(value)))
+    except (TypeError, ValueError):
+        return default
+
 class KnowledgeBaseHealthChecker:
-    def __init__(self, model="qwen-turbo-latest"):
+    def __init__(self, model="qwen-turbo-latest", shard_tokens=DEFAULT_SHARD_TOKENS, max_workers=8,
+                 embed=None, conflict_pairs_per_call=10, fact_index=None, recheck_days=DEFAULT_RECHECK_DAYS):
         self.model = model
+        # 日期、价格、电话等时效性事实的抽取索引，过期检查只把规则标记的切片交给LLM复核
+        self.fact_index = fact_index if fact_index is not None else FactIndex()
+        # LLM复核结论的有效期（天），期内内容未变化的切片不再复核
+        self.recheck_days = recheck_days
+        # 可选的批量文本向量函数（如 get_text_embeddings），提供时冲突候选加入向量近邻
+        self.embed = embed
+        # 每次LLM冲突判断包含的候选切片对数
+        self.conflict_pairs_per_call = conflict_pairs_per_call
         self.health_report = {}
+        # 每个分片中知识内容的token预算，保证单次检查不超出上下文窗口
+        self.shard_tokens = shard_tokens
+        # 同时进行的LLM检查数
+        self.max_workers = max_workers
         
     def check_missing_knowledge(self, knowledge_base, test_queries):
         """使用LLM检查缺少的知识"""
@@ -235,18 +285,240 @@ class KnowledgeBaseHealthChecker:
             print(f"LLM检查冲突知识失败: {e}")
             return None
     
+    def check_outdated_knowledge_indexed(self, knowledge_base):
+        """
+        基于抽取索引检查过期知识，返回结构与 check_outdated_knowledge 相同
+        
+        先用正则抽取的日期、价格、电话等事实和 last_updated 做规则判定，只把被标记、
+        且没有有效复核结论的切片按分片并发交给LLM复核；复核结论按内容缓存，知识库不变时重跑几乎不调用LLM。
+        """
+        reextracted = self.fact_index.update(knowledge_base)
+        chunk_ids = [str(chunk.get('id', '')) for chunk in knowledge_base]
+        flagged = self.fact_index.flag_outdated(chunk_ids)
+        reviews = self.fact_index.get_reviews(list(flagged), self.recheck_days)
+        to_review = [chunk for chunk in knowledge_base if str(chunk.get('id', '')) in flagged
+                     and str(chunk.get('id', '')) not in reviews]
+        print(f"过期检查: 重新抽取 {reextracted} 个切片，规则标记 {len(flagged)} 个，其中 {len(to_review)} 个需要LLM复核")
+        
+        failed = 0
+        if to_review:
+            shards = self.shard_knowledge_base(to_review)
+            with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+                shard_results = list(executor.map(self.check_outdated_knowledge, shards))
+            new_reviews = {}
+            for shard, result in zip(shards, shard_results):
+                if result is None:
+                    failed += 1
+                    continue
+                shard_ids = [str(chunk.get('id', '')) for chunk in shard]
+                for chunk_id in shard_ids:
+                    new_reviews[chunk_id] = []
+                for item in result.get('outdated_knowledge', []):
+                    chunk_id = str(item.get('chunk_id', ''))
+                    if chunk_id in new_reviews:
+                        new_reviews[chunk_id].append(item)
+            self.fact_index.put_reviews(new_reviews)
+            reviews.update(new_reviews)
+        
+        outdated = []
+        for chunk_id in flagged:
+            for item in reviews.get(chunk_id, []):
+                # 附上规则标记的原因，便于核对
+                outdated.append({**item, "flag_reasons": flagged[chunk_id]})
+        outdated_ids = {str(item.get('chunk_id', '')) for item in outdated}
+        # 复核失败的标记切片无法判断是否过期，不计入新鲜度；所有复核分片都失败时评分为None
+        unreviewed = sum(chunk_id not in reviews for chunk_id in flagged)
+        checked = len(knowledge_base) - unreviewed if not to_review or failed < len(shards) else 0
+        return {
+            "outdated_knowledge": outdated,
+            # 新鲜度：已完成检查的切片中未被判定为过期的比例
+            "freshness_score": (1 - len(outdated_ids) / checked if checked else None) if knowledge_base else 1.0,
+            "update_recommendations": f"规则标记 {len(flagged)} 个切片，LLM确认 {len(outdated_ids)} 个切片需要更新",
+            "flagged_chunks": len(flagged),
+            "llm_reviewed_chunks": len(to_review),
+            "failed_shards": failed,
+            "unreviewed_chunks": unreviewed
+        }
+    
+    def find_conflict_candidates(self, knowledge_base):
+        """用倒排索引（共享关键词）和向量近邻（高相似度）预筛选可能冲突的切片对"""
+        contents = [chunk.get('content', '') for chunk in knowledge_base]
+        vectors = self.embed(contents) if self.embed and contents else None
+        return find_candidate_pairs(tokenize_for_conflicts(contents), vectors=vectors)
+    
+    def check_conflict_pairs(self, pairs, knowledge_base):
+        """使用LLM判断一批候选切片对是否冲突"""
+        instruction = """
+你是一个知识一致性检查专家。下面每一组是两条可能谈论同一对象的知识切片，请逐组判断它们之间是否存在冲突或矛盾。
+
+检查标准：
+1. 同一主题的不同说法（地点、名称、描述等）
+2. 价格信息的差异（价格、费用、收费标准等）
+3. 时间信息的不一致（营业时间、开放时间、活动时间等）
+4. 规则政策的冲突（规定、政策、要求等）
+5. 操作流程的差异（步骤、方法、流程等）
+6. 联系方式的差异（地址、电话、网址等）
+
+只返回确实存在冲突的组，请返回JSON格式：
+{
+    "conflicting_knowledge": [
+        {
+            "conflict_type": "冲突类型",
+            "chunk_ids": ["相关切片ID"],
+            "conflicting_content": ["冲突内容"],
+            "severity": "严重程度（高/中/低）",
+            "resolution_suggestion": "解决建议"
+        }
+    ]
+}
+"""
+        
+        pairs_text = []
+        for i, pair in enumerate(pairs, 1):
+            left, right = knowledge_base[pair.left], knowledge_base[pair.right]
+            pairs_text.append(f"第{i}组:")
+            pairs_text.append(f"  ID: {left.get('id', 'unknown')} | 内容: {left.get('content', '')}")
+            pairs_text.append(f"  ID: {right.get('id', 'unknown')} | 内容: {right.get('content', '')}")
+        pairs_text = "\n".join(pairs_text)
+        
+        prompt = f"""
+### 指令 ###
+{instruction}
+
+### 候选切片对 ###
+{pairs_text}
+
+### 分析结果 ###
+"""
+        
+        try:
+            response = get_completion(prompt, self.model)
+            
+            # 预处理响应，移除markdown代码块格式
+            if response.startswith('```json'):
+                response = response[7:]
+            elif response.startswith('```'):
+                response = response[3:]
+            if response.endswith('```'):
+                response = response[:-3]
+            
+            return json.loads(response.strip()).get('conflicting_knowledge', [])
+            
+        except Exception as e:
+            print(f"LLM检查候选冲突失败: {e}")
+            return None
+    
+    def check_conflicting_knowledge_by_candidates(self, knowledge_base):
+        """
+        预筛选候选切片对后检查冲突，返回结构与 check_conflicting_knowledge 相同
+        
+        不再让LLM在整个知识库中两两比较，只把候选对分批并发交给LLM判断，
+        调用次数取决于候选对数量而不是知识库大小的平方，也能发现分布在不同分片中的冲突。
+        """
+        pairs = self.find_conflict_candidates(knowledge_base)
+        batches = [pairs[i:i + self.conflict_pairs_per_call] for i in range(0, len(pairs), self.conflict_pairs_per_call)]
+        print(f"冲突检查: {len(knowledge_base)} 个切片中预筛选出 {len(pairs)} 个候选对，分 {len(batches)} 次LLM调用")
+        
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            batch_results = list(executor.map(lambda batch: self.check_conflict_pairs(batch, knowledge_base), batches))
+        
+        conflicts = [item for result in batch_results if result for item in result]
+        conflicting_ids = {chunk_id for item in conflicts for chunk_id in item.get('chunk_ids', [])}
+        # 只出现在失败批次中的切片没有完成冲突检查，不计入一致性；所有批次都失败时评分为None
+        checked_indices, failed_indices = set(), set()
+        for batch, result in zip(batches, batch_results):
+            indices = checked_indices if result is not None else failed_indices
+            for pair in batch:
+                indices.update((pair.left, pair.right))
+        checked = len(knowledge_base) - len(failed_indices - checked_indices) if checked_indices or not batches else 0
+        return {
+            "conflicting_knowledge": conflicts,
+            # 一致性：已完成检查的切片中未卷入任何冲突的比例
+            "consistency_score": (1 - len(conflicting_ids) / checked if checked else None) if knowledge_base else 1.0,
+            "conflict_analysis": f"共 {len(pairs)} 个候选切片对，发现 {len(conflicts)} 处冲突",
+            "candidate_pairs": len(pairs),
+            "failed_batches": sum(result is None for result in batch_results)
+        }
+    
+    def shard_knowledge_base(self, knowledge_base):
+        """按token预算把知识库切成分片，按三种检查中最长的单行格式估算"""
+        lines = [f"ID: {chunk.get('id', 'unknown')} | 更新时间: {chunk.get('last_updated', 'unknown')} | 内容: {chunk.get('content', '')}"
+                 for chunk in knowledge_base]
+        return [[knowledge_base[i] for i in shard] for shard in shard_by_token_budget(lines, self.shard_tokens)]
+    
+    def merge_missing_results(self, shard_results, test_queries):
+        """合并各分片的缺少知识检查：只有在所有分片中都找不到答案的查询才算缺少"""
+        results = [result for result in shard_results if result]
+        if len(results) == 1 and len(shard_results) == 1:
+            return results[0]
+        
+        # LLM返回的查询文本可能与测试查询略有出入，按包含关系对应回测试查询
+        known_queries = [query_info['query'] for query_info in test_queries]
+        def match_query(text):
+            text = text.strip()
+            for query in known_queries:
+                if text and (text in query or query in text):
+                    return query
+            return text
+        
+        missing_by_query = {}
+        for result in results:
+            for item in result.get('missing_knowledge', []):
+                missing_by_query.setdefault(match_query(item.get('query', '')), []).append(item)
+        # 某个分片覆盖了该查询时，它不会出现在该分片的缺少列表中
+        missing = [items[0] for items in missing_by_query.values() if len(items) == len(results)]
+        # 所有分片的检查都失败时无法评估覆盖率，评分为None
+        if not results:
+            coverage = None
+        else:
+            coverage = 1 - len(missing) / len(test_queries) if test_queries else 1.0
+        return {
+            "missing_knowledge": missing,
+            "coverage_score": coverage,
+            "completeness_analysis": f"共检查 {len(shard_results)} 个分片，{len(missing)} 个查询在所有分片中都缺少相关知识",
+            "failed_shards": len(shard_results) - len(results)
+        }
+    
+    def run_sharded_checks(self, knowledge_base, test_queries):
+        """
+        分片并发执行三种检查并合并结果
+        
+        知识库按token预算切片后，每个分片的缺少知识检查作为独立任务并发提交，全部完成后合并；
+        过期检查只复核抽取索引标记的切片，冲突检查只判断预筛选的候选切片对，二者与分片检查同时执行。
+        
+        返回:
+            (缺少知识结果, 过期知识结果, 冲突知识结果)
+        """
+        shards = self.shard_knowledge_base(knowledge_base)
+        print(f"知识库共 {len(knowledge_base)} 个切片，切分为 {len(shards)} 个分片")
+        
+        with ThreadPoolExecutor(max_workers=self.max_workers) as executor:
+            outdated_future = executor.submit(self.check_outdated_knowledge_indexed, knowledge_base)
+            conflicting_future = executor.submit(self.check_conflicting_knowledge_by_candidates, knowledge_base)
+            missing_futures = [executor.submit(self.check_missing_knowledge, shard, test_queries) for shard in shards]
+            missing_results = [future.result() for future in missing_futures]
+            outdated_result = outdated_future.result()
+            conflicting_result = conflicting_future.result()
+        
+        return (
+            self.merge_missing_results(missing_results, test_queries),
+            outdated_result,
+            conflicting_result,
+        )
+    
     def calculate_overall_health_score(self, missing_result, outdated_result, conflicting_result):
-        """计算整体健康度评分"""
-        coverage_score = missing_result.get('coverage_score', 0)
-        freshness_score = outdated_result.get('freshness_score', 0)
-        consistency_score = conflicting_result.get('consistency_score', 0)
+        """计算整体健康度评分，评分为None（LLM检查全部失败、无法评估）的维度不参与加权，全部无法评估时返回None"""
+        weighted = [
+            (missing_result.get('coverage_score', 0), 0.4),       # 覆盖率权重40%
+            (outdated_result.get('freshness_score', 0), 0.3),     # 新鲜度权重30%
+            (conflicting_result.get('consistency_score', 0), 0.3)  # 一致性权重30%
+        ]
+        weighted = [(parse_score(score), weight) for score, weight in weighted if score is not None]
+        if not weighted:
+            return None
         
         # 加权计算
-        overall_score = (
-            coverage_score * 0.4 +      # 覆盖率权重40%
-            freshness_score * 0.3 +     # 新鲜度权重30%
-            consistency_score * 0.3      # 一致性权重30%
-        )
+        overall_score = sum(score * weight for score, weight in weighted) / sum(weight for _, weight in weighted)
         
         return overall_score
     
@@ -254,25 +526,23 @@ class KnowledgeBaseHealthChecker:
         """生成完整的健康度报告"""
         print("正在检查知识库健康度...")
         
-        # 1. 检查缺少的知识
-        print("1. 检查缺少的知识...")
-        missing_result = self.check_missing_knowledge(knowledge_base, test_queries)
-        
-        # 2. 检查过期的知识
-        print("2. 检查过期的知识...")
-        outdated_result = self.check_outdated_knowledge(knowledge_base)
-        
-        # 3. 检查冲突的知识
-        print("3. 检查冲突的知识...")
-        conflicting_result = self.check_conflicting_knowledge(knowledge_base)
+        # 1-3. 按分片并发检查缺少、过期和冲突的知识
+        print("1-3. 分片并发检查缺少、过期和冲突的知识...")
+        missing_result, outdated_result, conflicting_result = self.run_sharded_checks(knowledge_base, test_queries)
         
         # 4. 计算整体健康度
         overall_score = self.calculate_overall_health_score(missing_result, outdated_result, conflicting_result)
+        health_level = self.get_health_level(overall_score)
+        # 部分维度无法评估时，等级只反映其余维度，需在报告中注明
+        if overall_score is not None and None in (missing_result.get('coverage_score'),
+                                                  outdated_result.get('freshness_score'),
+                                                  conflicting_result.get('consistency_score')):
+            health_level += "（部分维度无法评估）"
         
         # 5. 生成报告
         report = {
             "overall_health_score": overall_score,
-            "health_level": self.get_health_level(overall_score),
+            "health_level": health_level,
             "missing_knowledge": missing_result,
             "outdated_knowledge": outdated_result,
             "conflicting_knowledge": conflicting_result,
@@ -284,6 +554,8 @@ class KnowledgeBaseHealthChecker:
     
     def get_health_level(self, score):
         """根据评分确定健康等级"""
+        if score is None:
+            return "无法评估"
         if score >= 0.8:
             return "优秀"
         elif score >= 0.6:
@@ -297,6 +569,15 @@ class KnowledgeBaseHealthChecker:
         """生成改进建议"""
         recommendations = []
         
+        # 检查失败、无法评估的维度
+        failed_checks = [name for name, result, key in (
+            ("缺少知识", missing_result, 'coverage_score'),
+            ("过期知识", outdated_result, 'freshness_score'),
+            ("冲突知识", conflicting_result, 'consistency_score'),
+        ) if result.get(key) is None]
+        for name in failed_checks:
+            recommendations.append(f"{name}检查全部失败，无法评估，请排查LLM调用后重新检查")
+        
         # 基于缺少知识的建议
         missing_count = len(missing_result.get('missing_knowledge', []))
         if missing_count > 0:
@@ -318,8 +599,8 @@ class KnowledgeBaseHealthChecker:
         return recommendations
 
 def main():
-    # 初始化知识库健康度检查器
-    checker = KnowledgeBaseHealthChecker()
+    # 初始化知识库健康度检查器（冲突候选同时使用关键词倒排索引和向量近邻）
+    checker = KnowledgeBaseHealthChecker(embed=get_text_embeddings)
     
     print("=== 知识库健康度检查示例（迪士尼主题乐园） ===\n")
     
@@ -386,7 +667,8 @@ def main():
     # 显示报告
     print("=== 知识库健康度报告 ===\n")
     
-    print(f"整体健康度评分: {health_report['overall_health_score']:.2f}")
+    overall = health_report['overall_health_score']
+    print(f"整体健康度评分: {overall:.2f}" if overall is not None else "整体健康度评分: 无法评估")
     print(f"健康等级: {health_report['health_level']}")
     print(f"检查时间: {health_report['check_date']}")
     
@@ -398,7 +680,8 @@ def main():
     # 1. 缺少的知识
     print("1. 缺少的知识分析:")
     missing = health_report['missing_knowledge']
-    print(f"   覆盖率: {health_report['missing_knowledge']['coverage_score']*100:.1f}%")
+    coverage = missing['coverage_score']
+    print(f"   覆盖率: {coverage*100:.1f}%" if coverage is not None else "   覆盖率: 无法评估（LLM检查全部失败）")
     print(f"   缺少知识点数量: {len(missing['missing_knowledge'])}")
     for i, item in enumerate(missing['missing_knowledge'][:3], 1):
         print(f"   {i}. 查询: {item['query']}")
@@ -410,7 +693,8 @@ def main():
     # 2. 过期的知识
     print("2. 过期的知识分析:")
     outdated = health_report['outdated_knowledge']
-    print(f"   新鲜度评分: {outdated['freshness_score']:.2f}")
+    freshness = outdated['freshness_score']
+    print(f"   新鲜度评分: {freshness:.2f}" if freshness is not None else "   新鲜度评分: 无法评估（LLM复核全部失败）")
     print(f"   过期知识点数量: {len(outdated['outdated_knowledge'])}")
     for i, item in enumerate(outdated['outdated_knowledge'][:3], 1):
         print(f"   {i}. 切片ID: {item['chunk_id']}")
@@ -422,7 +706,8 @@ def main():
     # 3. 冲突的知识
     print("3. 冲突的知识分析:")
     conflicting = health_report['conflicting_knowledge']
-    print(f"   一致性评分: {conflicting['consistency_score']:.2f}")
+    consistency = conflicting['consistency_score']
+    print(f"   一致性评分: {consistency:.2f}" if consistency is not None else "   一致性评分: 无法评估（LLM检查全部失败）")
     print(f"   冲突数量: {len(conflicting['conflicting_knowledge'])}")
     for i, item in enumerate(conflicting['conflicting_knowledge'][:3], 1):
         print(f"   {i}. 冲突类型: {item['conflict_type']}")
@@ -2,15 +2,26 @@
 # 导入依赖库
 import dashscope
 import os
+import sys
 import json
 import re
 from datetime import datetime, timedelta
-from collections import defaultdict, Counter
+from collections import defaultdict, Counter, OrderedDict
 import pandas as pd
 import numpy as np
 import faiss
 from openai import OpenAI
 
+# 添加项目根目录到Python路径，以便导入共享的services包
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+from services.embedding_cache import cached_embedding_function, embed_with_cache
+from services.batch_embedding import embed_texts_batched, openai_embedding_request
+from services.change_detection import DEFAULT_SIMILARITY_THRESHOLD, detect_changes
+from services.chunk_store import ChunkMetadataStore
+from services.vector_index import (build_index, compare_with_flat, normalize_vectors, print_index_report, search,
+                                   similarity_from_distance)
+from services.version_store import DEFAULT_STORE_PATH, VersionStore, vector_id
+
 # 从环境变量中获取 API Key
 dashscope.api_key = os.getenv('DASHSCOPE_API_KEY')
 
@@ -35,8 +46,8 @@ def get_completion(prompt, model="qwen-turbo-latest"):
     )
     return response.output.choices[0].message.content
 
-def get_text_embedding(text):
-    """获取文本的 Embedding"""
+def request_text_embedding(text):
+    """调用 API 获取文本的 Embedding"""
     response = client.embeddings.create(
         model=TEXT_EMBEDDING_MODEL,
         input=text,
@@ -44,59 +55,174 @@ def get_text_embedding(text):
     )
     return response.data[0].embedding
 
+# 获取文本的 Embedding，结果缓存在本地磁盘，多个版本中相同的切片只调用一次 API
+get_text_embedding = cached_embedding_function(request_text_embedding, TEXT_EMBEDDING_MODEL, TEXT_EMBEDDING_DIM)
+
+# 批量请求：每次请求发送多条文本
+request_text_embedding_batch = openai_embedding_request(client, TEXT_EMBEDDING_MODEL, TEXT_EMBEDDING_DIM)
+
+def get_text_embeddings(texts, batch_size=10, max_workers=4):
+    """批量获取文本的 Embedding：先查缓存，未命中的文本分批并发请求，结果顺序与输入一致"""
+    def embed_missing(missing):
+        return embed_texts_batched(missing, request_text_embedding_batch,
+                                   batch_size=batch_size, max_workers=max_workers)
+    return embed_with_cache(texts, embed_missing, TEXT_EMBEDDING_MODEL, TEXT_EMBEDDING_DIM)
+
 class KnowledgeBaseVersionManager:
-    def __init__(self, model="qwen-turbo-latest"):
+    def __init__(self, model="qwen-turbo-latest", index_type="flat", metric="cosine",
+                 store_path=DEFAULT_STORE_PATH, max_cached_indexes=3):
+        """
+        index_type: 向量索引类型，flat / ivf_flat / ivf_pq / hnsw
+        metric: cosine（内积索引，得分即余弦相似度）或 l2（L2索引，距离按 cos = 1 - d/2 换算为余弦相似度）；
+                两种模式下入库和查询向量都先归一化
+        store_path: 版本存储文件路径，切片内容和向量按内容哈希只保存一份，为None时只保存在内存中
+        max_cached_indexes: 内存中最多保留几个版本的向量索引，其余版本检索时由已保存的向量重建，无需重新Embedding
+        """
         self.model = model
-        self.versions = {}
-        
-    def create_version(self, knowledge_base, version_name, description=""):
-        """创建知识库版本"""
-        # 构建向量索引
-        metadata_store, text_index = self.build_vector_index(knowledge_base)
+        self.index_type = index_type
+        self.metric = metric
+        self.max_cached_indexes = max_cached_indexes
+        self.store = VersionStore(store_path)
+        # 版本名 -> 版本清单（切片ID与内容哈希，不含切片内容），按创建时间排序
+        self.versions = self.store.load_manifests()
+        # 版本名 -> (metadata_store, text_index)，按最近使用顺序淘汰
+        self._indexes = OrderedDict()
+        
+    def create_version(self, knowledge_base, version_name, description="", parent=None):
+        """
+        创建知识库版本：只保存和Embedding新出现的内容，向量索引由父版本的索引增删变化的向量得到
+
+        parent: 父版本名；默认时，重新创建已有版本沿用其原来的父版本，新版本取创建顺序中的上一个版本
+        """
+        existing = self.versions.get(version_name)
+        if parent is None:
+            # 不能取"最近创建的其他版本"：重建旧版本时它可能是之后才创建的版本，会颠倒版本谱系
+            parent = existing['parent'] if existing else next(reversed(self.versions), None)
+        
+        hashes = self.store.put_chunks(chunk.get('content', '') for chunk in knowledge_base)
+        chunks = []
+        for chunk, content_hash in zip(knowledge_base, hashes):
+            entry = {key: value for key, value in chunk.items() if key != 'content'}
+            entry['hash'] = content_hash
+            chunks.append(entry)
+        
+        # 只为还没有向量的内容调用Embedding，各版本共享未变化切片的向量
+        new_embeddings = self.embed_new_chunks(
+            [h for chunk, h in zip(knowledge_base, hashes) if chunk.get('content', '').strip()])
         
         version_info = {
             "version_name": version_name,
             "description": description,
-            "created_date": datetime.now().isoformat(),
-            "knowledge_base": knowledge_base,
-            "metadata_store": metadata_store,
-            "text_index": text_index,
+            # 重新创建同名版本时保留原创建时间，版本的先后顺序不变
+            "created_date": existing['created_date'] if existing else datetime.now().isoformat(),
+            "parent": parent,
+            "chunks": chunks,
             "statistics": self.calculate_version_statistics(knowledge_base)
         }
-        
+        self.store.save_manifest(version_info)
+        # 重新创建同名版本时，旧的索引作废，版本在创建顺序中的位置不变
+        self._indexes.pop(version_name, None)
         self.versions[version_name] = version_info
-        return version_info
-    
-    def build_vector_index(self, knowledge_base):
-        """构建向量索引"""
-        metadata_store = []
-        text_vectors = []
-        
-        for i, chunk in enumerate(knowledge_base):
-            content = chunk.get('content', '')
-            if not content.strip():
-                continue
-                
-            metadata = {
-                "id": i,
-                "content": content,
-                "chunk_id": chunk.get('id', f'chunk_{i}')
-            }
-            
-            # 获取文本embedding
-            vector = get_text_embedding(content)
-            text_vectors.append(vector)
-            metadata_store.append(metadata)
-        
-        # 创建FAISS索引
-        text_index = faiss.IndexFlatL2(TEXT_EMBEDDING_DIM)
-        text_index_map = faiss.IndexIDMap(text_index)
-        
-        if text_vectors:
-            text_ids = [m["id"] for m in metadata_store]
-            text_index_map.add_with_ids(np.array(text_vectors).astype('float32'), np.array(text_ids))
-        
-        return metadata_store, text_index_map
+        self.get_version_index(version_name)
+        
+        return {**version_info, "new_embeddings": new_embeddings}
+    
+    def embed_new_chunks(self, content_hashes):
+        """为还没有保存向量的内容获取Embedding并写入存储，返回新增的向量数"""
+        missing = self.store.missing_vectors(content_hashes)
+        if not missing:
+            return 0
+        contents = self.store.get_contents(missing)
+        vectors = get_text_embeddings([contents[h] for h in missing])
+        self.store.put_vectors(dict(zip(missing, vectors)))
+        return len(missing)
+    
+    def get_knowledge_base(self, version_name):
+        """由版本清单和共享的切片存储还原完整的知识库"""
+        chunks = self.versions[version_name]['chunks']
+        contents = self.store.get_contents([entry['hash'] for entry in chunks])
+        knowledge_base = []
+        for entry in chunks:
+            chunk = {key: value for key, value in entry.items() if key != 'hash'}
+            chunk['content'] = contents[entry['hash']]
+            knowledge_base.append(chunk)
+        return knowledge_base
+    
+    def delete_version(self, version_name):
+        """删除版本清单，并清理不再被任何版本引用的切片和向量，返回清理的切片数"""
+        self.store.delete_manifest(version_name)
+        self.versions.pop(version_name, None)
+        self._indexes.pop(version_name, None)
+        return self.store.prune()
+    
+    def get_version_index(self, version_name):
+        """获取版本的 (metadata_store, text_index)，flat索引在父版本索引还在内存中时增量构建，否则由已保存的向量全量构建"""
+        if version_name in self._indexes:
+            self._indexes.move_to_end(version_name)
+            return self._indexes[version_name]
+        
+        manifest = self.versions[version_name]
+        parent = manifest.get('parent')
+        # 只有flat索引经IndexIDMap包装后能正确删除向量；HNSW不支持删除，IVF删除后内部ID与IDMap错位，
+        # 这两类索引全量构建（仍使用已保存的向量，不重新Embedding）
+        if parent in self._indexes and parent in self.versions and self.index_type == "flat":
+            text_index = self.apply_changes_to_index(self._indexes[parent][1], self.versions[parent], manifest)
+        else:
+            text_index = self.build_vector_index(manifest)
+        
+        # 元数据只保存向量ID到切片ID和内容哈希的映射，切片内容在检索命中后才从存储中读取
+        metadata_store = ChunkMetadataStore()
+        for entry in manifest['chunks']:
+            doc_id = vector_id(entry['hash'])
+            if doc_id not in metadata_store:
+                metadata_store.append({"id": doc_id, "chunk_id": entry.get('id'), "hash": entry['hash']})
+        
+        self._indexes[version_name] = (metadata_store, text_index)
+        while len(self._indexes) > self.max_cached_indexes:
+            self._indexes.popitem(last=False)
+        return metadata_store, text_index
+    
+    def build_vector_index(self, manifest):
+        """由已保存的向量全量构建版本的向量索引，向量ID由内容哈希得到"""
+        hashes = list(dict.fromkeys(entry['hash'] for entry in manifest['chunks']))
+        vectors = self.store.get_vectors(hashes)
+        # 空白切片没有向量，不进入索引
+        hashes = [h for h in hashes if h in vectors]
+        
+        # 创建FAISS索引（近似索引会在采样数据上自动训练）
+        text_ids = [vector_id(h) for h in hashes]
+        text_matrix = np.array([vectors[h] for h in hashes], dtype='float32').reshape(-1, TEXT_EMBEDDING_DIM)
+        # l2模式也使用单位向量，距离才能换算为余弦相似度
+        text_matrix = normalize_vectors(text_matrix)
+        text_index_map = build_index(text_matrix, ids=text_ids, index_type=self.index_type, metric=self.metric)
+        if self.index_type != "flat" and hashes:
+            print_index_report(compare_with_flat(text_index_map, text_matrix, ids=text_ids, k=3, metric=self.metric))
+        
+        return text_index_map
+    
+    def apply_changes_to_index(self, parent_index, parent_manifest, manifest):
+        """复制父版本的索引，只删除不再存在的内容的向量、加入新内容的向量"""
+        # 清单中已有内容哈希，只需精确匹配：移动/重命名的切片向量不变，不需要改动索引
+        changes = self.detect_changes(parent_manifest['chunks'], manifest['chunks'], similarity_threshold=None)
+        old_hashes = {entry['hash'] for entry in parent_manifest['chunks']}
+        new_hashes = {entry['hash'] for entry in manifest['chunks']}
+        # 同一内容可能被其他切片继续使用，只有整个版本中都不存在时才删除或新增
+        removed = ({chunk['hash'] for chunk in changes['removed_chunks']} |
+                   {chunk['old_hash'] for chunk in changes['modified_chunks']}) - new_hashes
+        added = ({chunk['hash'] for chunk in changes['added_chunks']} |
+                 {chunk['new_hash'] for chunk in changes['modified_chunks']}) - old_hashes
+        
+        text_index = faiss.clone_index(parent_index)
+        if removed:
+            text_index.remove_ids(np.array([vector_id(h) for h in removed], dtype='int64'))
+        vectors = self.store.get_vectors(sorted(added))
+        if vectors:
+            added_hashes = list(vectors)
+            matrix = normalize_vectors(np.array([vectors[h] for h in added_hashes], dtype='float32'))
+            text_index.add_with_ids(matrix, np.array([vector_id(h) for h in added_hashes], dtype='int64'))
+        print(f"版本 {manifest['version_name']} 的索引由 {parent_manifest['version_name']} 增量构建："
+              f"删除 {len(removed)} 个向量，新增 {len(vectors)} 个向量")
+        return text_index
     
     def calculate_version_statistics(self, knowledge_base):
         """计算版本统计信息"""
@@ -117,8 +243,8 @@ class KnowledgeBaseVersionManager:
         v1 = self.versions[version1_name]
         v2 = self.versions[version2_name]
         
-        kb1 = v1['knowledge_base']
-        kb2 = v2['knowledge_base']
+        kb1 = self.get_knowledge_base(version1_name)
+        kb2 = self.get_knowledge_base(version2_name)
         
         comparison = {
             "version1": version1_name,
@@ -130,56 +256,14 @@ class KnowledgeBaseVersionManager:
         
         return comparison
     
-    def detect_changes(self, kb1, kb2):
-        """检测知识库变化"""
-        changes = {
-            "added_chunks": [],
-            "removed_chunks": [],
-            "modified_chunks": [],
-            "unchanged_chunks": []
-        }
-        
-        # 创建ID映射
-        kb1_dict = {chunk.get('id'): chunk for chunk in kb1}
-        kb2_dict = {chunk.get('id'): chunk for chunk in kb2}
-        
-        # 检测新增和删除
-        kb1_ids = set(kb1_dict.keys())
-        kb2_ids = set(kb2_dict.keys())
-        
-        added_ids = kb2_ids - kb1_ids
-        removed_ids = kb1_ids - kb2_ids
-        common_ids = kb1_ids & kb2_ids
-        
-        # 记录新增的知识切片
-        for chunk_id in added_ids:
-            changes["added_chunks"].append({
-                "id": chunk_id,
-                "content": kb2_dict[chunk_id].get('content', '')
-            })
-        
-        # 记录删除的知识切片
-        for chunk_id in removed_ids:
-            changes["removed_chunks"].append({
-                "id": chunk_id,
-                "content": kb1_dict[chunk_id].get('content', '')
-            })
-        
-        # 检测修改的知识切片
-        for chunk_id in common_ids:
-            chunk1 = kb1_dict[chunk_id]
-            chunk2 = kb2_dict[chunk_id]
-            
-            if chunk1.get('content') != chunk2.get('content'):
-                changes["modified_chunks"].append({
-                    "id": chunk_id,
-                    "old_content": chunk1.get('content', ''),
-                    "new_content": chunk2.get('content', '')
-                })
-            else:
-                changes["unchanged_chunks"].append(chunk_id)
-        
-        return changes
+    def detect_changes(self, kb1, kb2, similarity_threshold=DEFAULT_SIMILARITY_THRESHOLD):
+        """
+        检测知识库变化：按内容哈希识别未变化和移动/重命名的切片，ID对不上的切片用MinHash/LSH匹配相近内容，
+        重新切分的文档不会被整体记为删除+新增
+
+        similarity_threshold: 视为修改的最低Jaccard相似度，为None时只做精确匹配
+        """
+        return detect_changes(kb1, kb2, similarity_threshold=similarity_threshold)
     
     def compare_statistics(self, stats1, stats2):
         """比较统计信息"""
@@ -268,34 +352,36 @@ class KnowledgeBaseVersionManager:
         
         return performance_metrics
     
-    def retrieve_relevant_chunks(self, query, version_name, k=3):
-        """使用embedding和faiss检索相关知识切片"""
+    def retrieve_relevant_chunks(self, query, version_name, k=3, nprobe=None, ef_search=None):
+        """使用embedding和faiss检索相关知识切片，nprobe / ef_search 只对本次查询生效"""
         if version_name not in self.versions:
             return []
         
-        version_info = self.versions[version_name]
-        metadata_store = version_info['metadata_store']
-        text_index = version_info['text_index']
+        metadata_store, text_index = self.get_version_index(version_name)
         
         # 获取查询的embedding
-        query_vector = np.array([get_text_embedding(query)]).astype('float32')
+        query_vector = normalize_vectors(np.array([get_text_embedding(query)]).astype('float32'))
         
         # 使用faiss进行检索
-        distances, indices = text_index.search(query_vector, k)
+        distances, indices = search(text_index, query_vector, k, nprobe=nprobe, ef_search=ef_search, metric=self.metric)
+        # cosine模式下得分即余弦相似度；l2模式下向量均已归一化，按 cos = 1 - d/2 换算，阈值在不同查询间可比
+        similarities = similarity_from_distance(distances, self.metric)
+        
+        # 通过ID在元数据中查找（哈希索引，O(1)），再按内容哈希一次性取回命中切片的内容
+        matches = [(metadata_store.get(doc_id), float(similarities[0][i]))
+                   for i, doc_id in enumerate(indices[0]) if doc_id != -1]  # faiss返回-1表示没有找到匹配
+        matches = [(match, score) for match, score in matches if match]
+        contents = self.store.get_contents([match["hash"] for match, _ in matches])
         
         relevant_chunks = []
-        for i, doc_id in enumerate(indices[0]):
-            if doc_id != -1:  # faiss返回-1表示没有找到匹配
-                # 通过ID在元数据中查找
-                match = next((item for item in metadata_store if item["id"] == doc_id), None)
-                if match:
-                    # 构造返回的知识切片格式
-                    chunk = {
-                        "id": match["chunk_id"],
-                        "content": match["content"],
-                        "similarity_score": 1.0 / (1.0 + distances[0][i])  # 将距离转换为相似度
-                    }
-                    relevant_chunks.append(chunk)
+        for match, score in matches:
+            # 构造返回的知识切片格式
+            chunk = {
+                "id": match["chunk_id"],
+                "content": contents[match["hash"]],
+                "similarity_score": score
+            }
+            relevant_chunks.append(chunk)
         
         return relevant_chunks
     
@@ -450,12 +536,22 @@ def main():
     print(f"  描述: {v1_info['description']}")
     print(f"  知识切片数量: {v1_info['statistics']['total_chunks']}")
     print(f"  平均切片长度: {v1_info['statistics']['average_chunk_length']:.0f}字符")
+    print(f"  新增向量: {v1_info['new_embeddings']}个")
     
     print(f"\n版本2信息:")
     print(f"  版本名: {v2_info['version_name']}")
     print(f"  描述: {v2_info['description']}")
     print(f"  知识切片数量: {v2_info['statistics']['total_chunks']}")
     print(f"  平均切片长度: {v2_info['statistics']['average_chunk_length']:.0f}字符")
+    print(f"  父版本: {v2_info['parent']}")
+    print(f"  新增向量: {v2_info['new_embeddings']}个")
+    
+    # 各版本只保存清单，切片内容和向量按内容哈希共享
+    store_stats = version_manager.store.stats()
+    print(f"\n版本存储:")
+    print(f"  版本数: {store_stats['versions']}")
+    print(f"  各版本引用的切片总数: {store_stats['chunk_references']}")
+    print(f"  实际保存的切片数: {store_stats['stored_chunks']}（向量 {store_stats['stored_vectors']} 个）")
     
     print("\n" + "="*60 + "\n")
     
@@ -468,6 +564,7 @@ def main():
     print(f"  新增知识切片: {len(changes['added_chunks'])}个")
     print(f"  删除知识切片: {len(changes['removed_chunks'])}个")
     print(f"  修改知识切片: {len(changes['modified_chunks'])}个")
+    print(f"  移动/重命名知识切片: {len(changes['moved_chunks'])}个")
     
     print(f"\n新增的知识切片:")
     for i, chunk in enumerate(changes['added_chunks'], 1):
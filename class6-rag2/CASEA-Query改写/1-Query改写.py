@@ -2,7 +2,14 @@
 # 导入依赖库
 import dashscope
 import os
+import sys
 import json
+import time
+
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+from services.embedding_cache import cached_embedding_function
+from services.query_classifier import PLAIN, QueryTypeClassifier, evaluate_against_llm, print_classifier_report
+from services.rewrite_cache import RewriteCache
 
 # 从环境变量中获取 API Key
 dashscope.api_key = os.getenv('DASHSCOPE_API_KEY')
@@ -18,10 +25,21 @@ def get_completion(prompt, model="qwen-turbo-latest"):
     )
     return response.output.choices[0].message.content
 
+# 查询向量，用于改写缓存的近似重复命中
+def request_text_embedding(text, model="text-embedding-v4"):
+    response = dashscope.TextEmbedding.call(model=model, input=text)
+    return response.output["embeddings"][0]["embedding"]
+
+get_text_embedding = cached_embedding_function(request_text_embedding, "text-embedding-v4")
+
 # Query改写功能
 class QueryRewriter:
-    def __init__(self, model="qwen-turbo-latest"):
+    def __init__(self, model="qwen-turbo-latest", cache=None, classifier=None):
         self.model = model
+        # 改写结果缓存：相同（或近似重复）的查询在相同对话历史下不再重复调用LLM
+        self.cache = cache if cache is not None else RewriteCache()
+        # 规则预分类器：触发词明确的查询在本地判定类型，只有低置信度的查询才调用LLM识别
+        self.classifier = classifier if classifier is not None else QueryTypeClassifier()
     
     def rewrite_context_dependent_query(self, current_query, conversation_history):
         """上下文依赖型Query改写"""
@@ -177,28 +195,116 @@ class QueryRewriter:
             return {
                 "query_type": "未知类型",
                 "rewritten_query": query,
-                "confidence": 0.5
+                "confidence": 0.5,
+                "parse_failed": True
             }
     
-    def auto_rewrite_and_execute(self, query, conversation_history="", context_info=""):
-        """自动识别Query类型并进行改写，然后根据类型调用相应的改写方法"""
-        # 首先进行自动识别
-        result = self.auto_rewrite_query(query, conversation_history, context_info)
+    def fast_rewrite_query(self, query, conversation_history="", context_info=""):
+        """快速路径：一次LLM调用同时完成类型识别和按类型规则的改写"""
+        instruction = """
+你是一个智能的查询分析与改写专家。请先识别用户查询属于以下哪种类型，再按该类型的规则直接给出最终改写结果：
+1. 上下文依赖型 - 包含"还有"、"其他"等需要上下文理解的词汇；改写为包含所有必要上下文信息的独立完整问题
+2. 对比型 - 包含"哪个"、"比较"、"更"、"哪个更好"、"哪个更"等比较词汇；识别出需要比较的多个对象，改写为明确的对比性查询
+3. 模糊指代型 - 包含"它"、"他们"、"都"、"这个"等指代词；把指代词替换为对话历史中明确的对象名称
+4. 多意图型 - 包含多个独立问题，用"、"或"？"分隔；分解为多个可以单独回答的简单问题，rewritten_query为问题数组
+5. 反问型 - 包含"不会"、"难道"等反问语气；改写为中立、客观、可直接用于检索的问题
+6. 普通查询 - 不属于以上类型；直接返回原查询
+说明：如果同时存在多意图型、模糊指代型，优先级为多意图型>模糊指代型
+
+请只返回JSON格式的结果：
+{
+    "query_type": "查询类型",
+    "rewritten_query": "改写后的查询（多意图型为问题数组）",
+    "confidence": "置信度(0-1)"
+}
+"""
         
-        # 根据识别结果调用相应的改写方法
-        query_type = result.get('query_type', '')
+        prompt = f"""
+### 指令 ###
+{instruction}
+
+### 对话历史 ###
+{conversation_history}
+
+### 上下文信息 ###
+{context_info}
+
+### 原始查询 ###
+{query}
+
+### 分析结果 ###
+"""
+        
+        response = get_completion(prompt, self.model)
+        try:
+            return json.loads(response)
+        except:
+            return {
+                "query_type": "未知类型",
+                "rewritten_query": query,
+                "confidence": 0.5,
+                "parse_failed": True
+            }
+    
+    def auto_rewrite_and_execute(self, query, conversation_history="", context_info="", fast=False):
+        """
+        自动识别Query类型并进行改写，然后根据类型调用相应的改写方法
         
+        结果按 (归一化查询, 对话历史) 缓存；fast=True 时只调用一次LLM，同时得到类型和改写结果
+        """
+        kind = "fast_rewrite" if fast else "auto_rewrite_and_execute"
+        history_key = f"{conversation_history}\n{context_info}"
+        return self.cache.get_or_compute(
+            kind, query, history_key,
+            lambda: self._rewrite_and_execute(query, conversation_history, context_info, fast),
+            # LLM回复解析失败时的兜底结果不缓存，避免在TTL内一直返回"未知类型"
+            cacheable=lambda result: not result["auto_rewrite_result"].get("parse_failed"),
+        )
+    
+    def rewrite_by_type(self, query_type, query, conversation_history="", context_info=""):
+        """根据类型调用相应的改写方法，未知类型返回None"""
         if '上下文依赖' in query_type:
-            final_result = self.rewrite_context_dependent_query(query, conversation_history)
+            return self.rewrite_context_dependent_query(query, conversation_history)
         elif '对比' in query_type:
-            final_result = self.rewrite_comparative_query(query, context_info or conversation_history)
+            return self.rewrite_comparative_query(query, context_info or conversation_history)
         elif '模糊指代' in query_type:
-            final_result = self.rewrite_ambiguous_reference_query(query, conversation_history)
+            return self.rewrite_ambiguous_reference_query(query, conversation_history)
         elif '多意图' in query_type:
-            final_result = self.rewrite_multi_intent_query(query)
+            return self.rewrite_multi_intent_query(query)
         elif '反问' in query_type:
-            final_result = self.rewrite_rhetorical_query(query, conversation_history)
-        else:
+            return self.rewrite_rhetorical_query(query, conversation_history)
+        return None
+    
+    def _rewrite_and_execute(self, query, conversation_history, context_info, fast):
+        # 规则预分类置信度足够时跳过LLM类型识别：普通查询直接返回原查询，其余类型只调用一次对应的改写方法
+        prediction = self.classifier.classify(query, conversation_history)
+        if self.classifier.is_confident(prediction):
+            rewritten_query = self.rewrite_by_type(prediction.query_type, query, conversation_history, context_info)
+            return {
+                "original_query": query,
+                "detected_type": prediction.query_type,
+                "confidence": prediction.confidence,
+                "rewritten_query": query if prediction.query_type == PLAIN else rewritten_query,
+                "auto_rewrite_result": {"source": "rule", "matches": prediction.matches}
+            }
+        
+        if fast:
+            result = self.fast_rewrite_query(query, conversation_history, context_info)
+            return {
+                "original_query": query,
+                "detected_type": result.get('query_type', ''),
+                "confidence": result.get('confidence', 0.5),
+                "rewritten_query": result.get('rewritten_query', query),
+                "auto_rewrite_result": result
+            }
+        
+        # 首先进行自动识别
+        result = self.auto_rewrite_query(query, conversation_history, context_info)
+        
+        # 根据识别结果调用相应的改写方法
+        query_type = result.get('query_type', '')
+        final_result = self.rewrite_by_type(query_type, query, conversation_history, context_info)
+        if final_result is None:
             # 对于其他类型，返回自动识别的改写结果
             final_result = result.get('rewritten_query', query)
         
@@ -299,6 +405,30 @@ AI: "正在为您查询... 查询到下周六的门票已经售罄。"
         print(f"  识别类型: {result['query_type']}")
         print(f"  改写结果: {result['rewritten_query']}")
         print(f"  置信度: {result['confidence']}\n")
+    
+    # 示例7: 带缓存的快速改写（一次LLM调用同时识别类型并改写）
+    print("示例7: 带缓存的快速改写")
+    # 提供查询向量时，措辞略有不同的重复查询也能命中缓存
+    cached_rewriter = QueryRewriter(cache=RewriteCache(embed=get_text_embedding))
+    for query in ["哪个园区更好玩？", "哪个园区更好玩", "哪个园区比较好玩？"]:
+        start_time = time.time()
+        result = cached_rewriter.auto_rewrite_and_execute(query, fast=True)
+        print(f"查询: {query} -> {result['rewritten_query']} (类型: {result['detected_type']}, 耗时: {time.time() - start_time:.3f} 秒)")
+    print(f"缓存统计: {cached_rewriter.cache.stats()}")
+    
+    # 示例8: 规则预分类与LLM识别结果对比（准确率与延迟）
+    print("\n示例8: 规则预分类评估")
+    eval_queries = test_queries + [
+        "上海迪士尼乐园几点开门？",
+        "门票多少钱",
+        "成都有什么好玩的",
+        "那周末呢？",
+        "创极速光轮需要排队多久",
+        "难道雨天也不能退票吗"
+    ]
+    report = evaluate_against_llm(rewriter.classifier, eval_queries,
+                                  lambda q: rewriter.auto_rewrite_query(q)['query_type'])
+    print_classifier_report(report)
 
 if __name__ == "__main__":
     main() 
\ No newline at end of file
@@ -2,10 +2,14 @@
 # 导入依赖库
 from langchain_ollama import ChatOllama
 import os
+import sys
 import json
 import re
 from datetime import datetime
 
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+from services.rewrite_cache import RewriteCache
+
 # 初始化Ollama客户端
 def get_completion(prompt, model="qwen3:14b"):
     llm = ChatOllama(model=model, temperature=0)
@@ -13,8 +17,10 @@ def get_completion(prompt, model="qwen3:14b"):
     return response.content
 
 class WebSearchQueryRewriter:
-    def __init__(self, model="qwen3:14b"):
+    def __init__(self, model="qwen3:14b", cache=None):
         self.model = model
+        # 改写结果缓存：相同查询在相同对话历史、同一天内不再重复调用LLM
+        self.cache = cache if cache is not None else RewriteCache()
     
     def identify_web_search_needs(self, query, conversation_history=""):
         """识别查询是否需要联网搜索"""
@@ -59,7 +65,8 @@ class WebSearchQueryRewriter:
             return {
                 "need_web_search": False,
                 "search_reason": "无法解析",
-                "confidence": 0.5
+                "confidence": 0.5,
+                "parse_failed": True
             }
     
     def rewrite_for_web_search(self, query, search_type="general"):
@@ -105,7 +112,8 @@ class WebSearchQueryRewriter:
                 "rewritten_query": query,
                 "search_keywords": [query],
                 "search_intent": "信息查询",
-                "suggested_sources": ["官方网站", "旅游网站"]
+                "suggested_sources": ["官方网站", "旅游网站"],
+                "parse_failed": True
             }
     
     def generate_search_strategy(self, query, search_type="general"):
@@ -149,14 +157,103 @@ class WebSearchQueryRewriter:
             return json.loads(response)
         except:
             return {
+                "primary_keywords": [query],
+                "extended_keywords": [],
+                "search_platforms": ["百度", "谷歌"],
+                "time_range": "最近一周",
+                "parse_failed": True
+            }
+    
+    def fast_web_search_rewrite(self, query, conversation_history=""):
+        """快速路径：一次LLM调用同时完成联网需求识别、查询改写和搜索策略生成"""
+        current_date = datetime.now().strftime("%Y年%m月%d日")
+        instruction = f"""
+你是一个智能的查询分析与搜索优化专家。当前日期：{current_date}
+请先判断用户查询是否需要联网搜索来获取最新、最准确的信息（时效性信息、实时数据、价格、营业时间、新闻动态等需要联网）。
+如果需要联网搜索，再把查询改写为适合搜索引擎检索的形式（补充时间、地点等限定词，把相对时间转换为具体日期），并制定搜索策略。
+
+请只返回JSON格式的结果：
+{{
+    "need_web_search": true/false,
+    "search_reason": "需要或不需要联网搜索的原因",
+    "confidence": "置信度(0-1)",
+    "rewritten_query": "改写后的搜索查询",
+    "search_keywords": ["关键词1", "关键词2"],
+    "search_intent": "搜索意图",
+    "suggested_sources": ["建议的搜索来源"],
+    "search_strategy": {{
+        "primary_keywords": ["主要关键词"],
+        "extended_keywords": ["扩展关键词"],
+        "search_platforms": ["搜索平台"],
+        "time_range": "具体的时间范围"
+    }}
+}}
+"""
+        
+        prompt = f"""
+### 指令 ###
+{instruction}
+
+### 对话历史 ###
+{conversation_history}
+
+### 用户查询 ###
+{query}
+
+### 分析结果 ###
+"""
+        
+        response = get_completion(prompt, self.model)
+        try:
+            result = json.loads(response)
+        except:
+            result = {"need_web_search": False, "parse_failed": True}
+        
+        if not result.get('need_web_search', False):
+            return {
+                "need_web_search": False,
+                "reason": result.get('search_reason') or "查询不需要联网搜索",
+                "original_query": query,
+                "parse_failed": result.get('parse_failed', False)
+            }
+        return {
+            "need_web_search": True,
+            "search_reason": result.get('search_reason', ''),
+            "confidence": result.get('confidence', 0.5),
+            "original_query": query,
+            "rewritten_query": result.get('rewritten_query', query),
+            "search_keywords": result.get('search_keywords', []),
+            "search_intent": result.get('search_intent', ''),
+            "suggested_sources": result.get('suggested_sources', []),
+            "search_strategy": result.get('search_strategy') or {
                 "primary_keywords": [query],
                 "extended_keywords": [],
                 "search_platforms": ["百度", "谷歌"],
                 "time_range": "最近一周"
             }
+        }
     
-    def auto_web_search_rewrite(self, query, conversation_history=""):
-        """自动识别并改写为联网搜索查询"""
+    def auto_web_search_rewrite(self, query, conversation_history="", fast=False):
+        """
+        自动识别并改写为联网搜索查询
+        
+        结果按 (归一化查询, 对话历史, 当前日期) 缓存，"今天"、"下周六"等相对时间不会跨天复用；
+        fast=True 时只调用一次LLM
+        """
+        kind = "fast_web_search" if fast else "web_search"
+        # 改写结果包含具体日期，缓存键加入当前日期
+        history_key = f"{datetime.now().strftime('%Y-%m-%d')}\n{conversation_history}"
+        return self.cache.get_or_compute(
+            kind, query, history_key,
+            lambda: self._web_search_rewrite(query, conversation_history, fast),
+            # 任一步LLM回复解析失败时的兜底结果不缓存，下次请求重新调用LLM
+            cacheable=lambda result: not result.get('parse_failed'),
+        )
+    
+    def _web_search_rewrite(self, query, conversation_history, fast):
+        if fast:
+            return self.fast_web_search_rewrite(query, conversation_history)
+        
         # 第一步：识别是否需要联网搜索
         search_analysis = self.identify_web_search_needs(query, conversation_history)
         
@@ -164,7 +261,8 @@ class WebSearchQueryRewriter:
             return {
                 "need_web_search": False,
                 "reason": "查询不需要联网搜索",
-                "original_query": query
+                "original_query": query,
+                "parse_failed": search_analysis.get('parse_failed', False)
             }
         
         # 第二步：改写查询
@@ -182,7 +280,8 @@ class WebSearchQueryRewriter:
             "search_keywords": rewritten_result.get('search_keywords', []),
             "search_intent": rewritten_result.get('search_intent', ''),
             "suggested_sources": rewritten_result.get('suggested_sources', []),
-            "search_strategy": search_strategy
+            "search_strategy": search_strategy,
+            "parse_failed": bool(rewritten_result.get('parse_failed') or search_strategy.get('parse_failed'))
         }
 
 def main():
@@ -247,6 +346,17 @@ AI: "上海迪士尼乐园是一个很棒的选择！"
     else:
         print(f"[NO] 不需要联网搜索")
         print(f"  原因: {result2['reason']}")
+    
+    print("\n" + "="*60 + "\n")
+    
+    # 示例3: 快速路径与缓存命中
+    print("示例3: 快速路径与缓存命中")
+    for query in [query2, query2 + " "]:
+        start_time = datetime.now()
+        result3 = web_searcher.auto_web_search_rewrite(query, fast=True)
+        elapsed = (datetime.now() - start_time).total_seconds()
+        print(f"查询: {query.strip()} -> {result3.get('rewritten_query', query)} (耗时: {elapsed:.3f} 秒)")
+    print(f"缓存统计: {web_searcher.cache.stats()}")
 
 if __name__ == "__main__":
     main()
\ No newline at end of file
@@ -3,6 +3,11 @@ from langchain_community.vectorstores import FAISS
 from langchain_community.embeddings import DashScopeEmbeddings
 from langchain_community.llms import Tongyi
 import os
+import sys
+
+# 添加项目根目录到Python路径，以便导入共享的services包
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+from services.embedding_cache import CachedEmbeddings
 
 # 获取环境变量中的 DASHSCOPE_API_KEY
 DASHSCOPE_API_KEY = os.getenv('DASHSCOPE_API_KEY')
@@ -11,10 +16,10 @@ if not DASHSCOPE_API_KEY:
 llm = Tongyi(model_name="deepseek-v3", dashscope_api_key=DASHSCOPE_API_KEY) # qwen-turbo
 
 # 创建嵌入模型
-embeddings = DashScopeEmbeddings(
+embeddings = CachedEmbeddings(DashScopeEmbeddings(
     model="text-embedding-v1",
     dashscope_api_key=DASHSCOPE_API_KEY,
-)
+))
 
 # 加载向量数据库，添加allow_dangerous_deserialization=True参数以允许反序列化
 vectorstore = FAISS.load_local("./faiss-1", embeddings, allow_dangerous_deserialization=True)
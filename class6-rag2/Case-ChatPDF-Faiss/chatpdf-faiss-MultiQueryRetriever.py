@@ -1,108 +1,50 @@
-from PyPDF2 import PdfReader
 from langchain.chains.question_answering import load_qa_chain
 from langchain_openai import OpenAI
 from langchain_community.callbacks.manager import get_openai_callback
-from langchain.text_splitter import RecursiveCharacterTextSplitter
 from langchain_community.embeddings import DashScopeEmbeddings
 from langchain_community.vectorstores import FAISS
-from langchain.retrievers import MultiQueryRetriever
 from langchain_community.llms import Tongyi
-from typing import List, Tuple
 import os
-import pickle
-from langchain_core.callbacks.manager import CallbackManagerForRetrieverRun
+import sys
+
+# 添加项目根目录到Python路径，以便导入共享的services包
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+from services.embedding_cache import CachedEmbeddings
+from services.multi_query import BatchMultiQueryRetriever
+from services.pdf_pages import PageOffsetIndex, backfill_legacy_pages, extract_text_with_page_offsets, split_text_with_pages
 
 # 获取环境变量中的 DASHSCOPE_API_KEY
 DASHSCOPE_API_KEY = os.getenv('DASHSCOPE_API_KEY')
 if not DASHSCOPE_API_KEY:
     raise ValueError("请设置环境变量 DASHSCOPE_API_KEY")
 
-def extract_text_with_page_numbers(pdf) -> Tuple[str, List[int]]:
-    """
-    从PDF中提取文本并记录每行文本对应的页码
-    
-    参数:
-        pdf: PDF文件对象
-    
-    返回:
-        text: 提取的文本内容
-        page_numbers: 每行文本对应的页码列表
-    """
-    text = ""
-    page_numbers = []
-
-    for page_number, page in enumerate(pdf.pages, start=1):
-        extracted_text = page.extract_text()
-        if extracted_text:
-            text += extracted_text
-            page_numbers.extend([page_number] * len(extracted_text.split("\n")))
-        else:
-            print(f"No text found on page {page_number}.")
-
-    return text, page_numbers
-
-def process_text_with_splitter(text: str, page_numbers: List[int], save_path: str = None) -> FAISS:
+def process_text_with_splitter(text: str, page_index: PageOffsetIndex, save_path: str = None) -> FAISS:
     """
     处理文本并创建向量存储
     
     参数:
         text: 提取的文本内容
-        page_numbers: 每行文本对应的页码列表
+        page_index: 字符偏移量到页码的索引
         save_path: 可选，保存向量数据库的路径
     
     返回:
         knowledgeBase: 基于FAISS的向量存储对象
     """
-    # 创建文本分割器，用于将长文本分割成小块
-    text_splitter = RecursiveCharacterTextSplitter(
-        separators=["\n\n", "\n", ".", " ", ""],
-        chunk_size=1000,
-        chunk_overlap=200,
-        length_function=len,
-    )
-
-    # 分割文本
-    chunks = text_splitter.split_text(text)
+    # 分割文本，同时根据每块的起始偏移量确定页码
+    chunks, metadatas = split_text_with_pages(text, page_index, chunk_size=1000, chunk_overlap=200)
     print(f"文本被分割成 {len(chunks)} 个块。")
         
     # 创建嵌入模型
-    embeddings = DashScopeEmbeddings(
+    embeddings = CachedEmbeddings(DashScopeEmbeddings(
         model="text-embedding-v1",
         dashscope_api_key=DASHSCOPE_API_KEY,
-    )
+    ))
     
     # 从文本块创建知识库
-    knowledgeBase = FAISS.from_texts(chunks, embeddings)
+    knowledgeBase = FAISS.from_texts(chunks, embeddings, metadatas=metadatas)
     print("已从文本块创建知识库。")
     
-    # 改进：存储每个文本块对应的页码信息
-    lines = text.split("\n")
-    page_info = {}
-    for chunk in chunks:
-        # 查找chunk在原始文本中的开始位置
-        start_idx = text.find(chunk[:100])  # 使用chunk的前100个字符作为定位点
-        if start_idx == -1:
-            # 如果找不到精确匹配，则使用模糊匹配
-            for i, line in enumerate(lines):
-                if chunk.startswith(line[:min(50, len(line))]):
-                    start_idx = i
-                    break
-            if start_idx == -1:
-                for i, line in enumerate(lines):
-                    if line and line in chunk:
-                        start_idx = text.find(line)
-                        break
-        if start_idx != -1:
-            line_count = text[:start_idx].count("\n")
-            if line_count < len(page_numbers):
-                page_info[chunk] = page_numbers[line_count]
-            else:
-                page_info[chunk] = page_numbers[-1] if page_numbers else 1
-        else:
-            page_info[chunk] = -1
-    knowledgeBase.page_info = page_info
-    
-    # 如果提供了保存路径，则保存向量数据库和页码信息
+    # 如果提供了保存路径，则保存向量数据库（页码作为元数据随文本块写入docstore）
     if save_path:
         # 确保目录存在
         os.makedirs(save_path, exist_ok=True)
@@ -110,11 +52,6 @@ def process_text_with_splitter(text: str, page_numbers: List[int], save_path: st
         # 保存FAISS向量数据库
         knowledgeBase.save_local(save_path)
         print(f"向量数据库已保存到: {save_path}")
-        
-        # 保存页码信息到同一目录
-        with open(os.path.join(save_path, "page_info.pkl"), "wb") as f:
-            pickle.dump(page_info, f)
-        print(f"页码信息已保存到: {os.path.join(save_path, 'page_info.pkl')}")
 
     return knowledgeBase
 
@@ -131,56 +68,45 @@ def load_knowledge_base(load_path: str, embeddings = None) -> FAISS:
     """
     # 如果没有提供嵌入模型，则创建一个新的
     if embeddings is None:
-        embeddings = DashScopeEmbeddings(
+        embeddings = CachedEmbeddings(DashScopeEmbeddings(
             model="text-embedding-v1",
             dashscope_api_key=DASHSCOPE_API_KEY,
-        )
+        ))
     
     # 加载FAISS向量数据库，添加allow_dangerous_deserialization=True参数以允许反序列化
     knowledgeBase = FAISS.load_local(load_path, embeddings, allow_dangerous_deserialization=True)
     print(f"向量数据库已从 {load_path} 加载。")
     
-    # 加载页码信息
-    page_info_path = os.path.join(load_path, "page_info.pkl")
-    if os.path.exists(page_info_path):
-        with open(page_info_path, "rb") as f:
-            page_info = pickle.load(f)
-        knowledgeBase.page_info = page_info
-        print("页码信息已加载。")
-    else:
-        print("警告: 未找到页码信息文件。")
+    # 旧版本把页码单独保存在page_info.pkl中，为缺少页码元数据的文本块补齐
+    if backfill_legacy_pages(knowledgeBase, load_path):
+        print("已从旧版页码信息文件补齐页码。")
     
     return knowledgeBase
 
-def create_multi_query_retriever(vectorstore, llm):
+def create_multi_query_retriever(vectorstore, llm, cache_path: str = None):
     """
-    创建MultiQueryRetriever
+    创建多查询检索器
+    
+    查询变体按原始问题缓存；所有变体一次批量嵌入、一次FAISS多行检索，
+    结果按文本块ID用RRF融合去重，而不是逐个变体串行检索。
     
     参数:
         vectorstore: 向量数据库
         llm: 大语言模型，用于查询改写
+        cache_path: 可选，查询变体缓存文件路径
     
     返回:
-        retriever: MultiQueryRetriever对象
+        retriever: BatchMultiQueryRetriever对象
     """
-    # 创建基础检索器
-    base_retriever = vectorstore.as_retriever(search_kwargs={"k": 4})
-    
-    # 创建MultiQueryRetriever
-    retriever = MultiQueryRetriever.from_llm(
-        retriever=base_retriever,
-        llm=llm
-    )
-    
-    return retriever
+    return BatchMultiQueryRetriever(vectorstore, llm, k=4, cache_path=cache_path)
 
 def process_query_with_multi_retriever(query: str, retriever, llm):
     """
-    使用MultiQueryRetriever处理查询
+    使用多查询检索器处理查询
     
     参数:
         query: 用户查询
-        retriever: MultiQueryRetriever对象
+        retriever: 多查询检索器
         llm: 大语言模型
     
     返回:
@@ -206,13 +132,9 @@ def process_query_with_multi_retriever(query: str, retriever, llm):
     # 记录唯一的页码
     unique_pages = set()
     
-    # 获取每个文档块的来源页码
+    # 获取每个文档块的来源页码（旧版知识库加载时已从页码信息文件补齐）
     for doc in docs:
-        text_content = getattr(doc, "page_content", "")
-        # 获取向量存储中的页码信息
-        source_page = retriever.retriever.vectorstore.page_info.get(
-            text_content.strip(), "未知"
-        )
+        source_page = doc.metadata.get("page", "未知")
         
         if source_page not in unique_pages:
             unique_pages.add(source_page)
@@ -229,28 +151,27 @@ def main():
     if os.path.exists(vector_db_path) and os.path.isdir(vector_db_path):
         print(f"发现现有向量数据库: {vector_db_path}")
         # 创建嵌入模型
-        embeddings = DashScopeEmbeddings(
+        embeddings = CachedEmbeddings(DashScopeEmbeddings(
             model="text-embedding-v1",
             dashscope_api_key=DASHSCOPE_API_KEY,
-        )
+        ))
         # 加载向量数据库
         knowledgeBase = load_knowledge_base(vector_db_path, embeddings)
     else:
         print(f"未找到向量数据库，将从PDF创建新的向量数据库")
-        # 读取PDF文件
-        pdf_reader = PdfReader(pdf_path)
-        # 提取文本和页码信息
-        text, page_numbers = extract_text_with_page_numbers(pdf_reader)
+        # 多进程并行提取文本和页码信息
+        text, page_index = extract_text_with_page_offsets(pdf_path)
         print(f"提取的文本长度: {len(text)} 个字符。")
         
         # 处理文本并创建知识库，同时保存到磁盘
-        knowledgeBase = process_text_with_splitter(text, page_numbers, save_path=vector_db_path)
+        knowledgeBase = process_text_with_splitter(text, page_index, save_path=vector_db_path)
     
     # 初始化大语言模型（用于查询改写和回答生成）
     llm = Tongyi(model_name="deepseek-v3", dashscope_api_key=DASHSCOPE_API_KEY)
     
-    # 创建MultiQueryRetriever
-    multi_retriever = create_multi_query_retriever(knowledgeBase, llm)
+    # 创建多查询检索器，查询变体缓存在向量数据库目录中
+    multi_retriever = create_multi_query_retriever(
+        knowledgeBase, llm, cache_path=os.path.join(vector_db_path, "query_variants.json"))
     
     # 设置查询问题
     queries = [
@@ -264,7 +185,7 @@ def main():
         print("\n" + "="*50)
         print(f"查询: {query}")
         
-        # 使用MultiQueryRetriever处理查询
+        # 使用多查询检索器处理查询
         response, unique_pages = process_query_with_multi_retriever(
             query, 
             multi_retriever, 
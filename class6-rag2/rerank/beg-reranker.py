@@ -37,3 +37,64 @@ inputs = tokenizer(pairs, padding=True, truncation=True, return_tensors='pt')
 scores = model(**inputs).logits.view(-1).float()
 print(scores)  # 输出相关性分数
 
+
+
+# In[4]:
+
+
+# 作为检索流水线中的重排序阶段：接在任意检索器之后，批量打分并缓存得分
+import os
+import sys
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+from services.reranker import CrossEncoderReranker
+
+# 复用上面已加载的模型；max_length 越小CPU推理越快，budget 限制每次最多重排的候选数
+reranker = CrossEncoderReranker(model=model, tokenizer=tokenizer, max_length=512, batch_size=16, budget=20)
+
+query = 'what is panda?'
+# 检索阶段（FAISS / BM25 / 混合检索）返回的候选：(文本块ID, 文本)
+candidates = [
+    ('chunk_1', 'The Eiffel Tower is in Paris.'),
+    ('chunk_2', 'Pandas are cute.'),
+    ('chunk_3', 'The giant panda is a bear species endemic to China.'),
+]
+print(reranker.rerank(query, candidates, top_n=2))
+
+# 相同的 (查询, 文本块ID) 再次出现时直接命中缓存，不再推理
+reranker.rerank(query, candidates, top_n=2)
+print(f"缓存命中: {reranker.hits}, 未命中: {reranker.misses}, 耗时: {reranker.last_latency:.4f} 秒")
+
+# LangChain 检索器返回的 Document 列表可直接重排，例如：
+# docs = knowledge_base.similarity_search(query, k=20)
+# for doc, score in reranker.rerank_documents(query, docs, top_n=3):
+#     print(score, doc.page_content[:50])
+
+
+# In[5]:
+
+
+# CPU推理：动态int8量化与ONNX导出，并与浮点模型对比吞吐量和重排recall
+from services.cpu_inference import (OnnxSequenceClassifier, benchmark_rerankers, export_sequence_classifier_onnx,
+                                    load_benchmark_passages, print_benchmark_report, quantize_dynamic_int8,
+                                    set_cpu_threads)
+
+set_cpu_threads()
+int8_model = quantize_dynamic_int8(model)
+onnx_path = export_sequence_classifier_onnx(model, tokenizer, '/root/autodl-tmp/models/onnx/bge-reranker-large.onnx',
+                                            quantize=True)
+onnx_model = OnnxSequenceClassifier(onnx_path)
+
+# 三种模型共用同一套分词、分桶组批逻辑，只是推理后端不同
+rerankers = {
+    'float': CrossEncoderReranker(model=model, tokenizer=tokenizer, max_length=512),
+    'int8': CrossEncoderReranker(model=int8_model, tokenizer=tokenizer, max_length=512),
+    'onnx-int8': CrossEncoderReranker(model=onnx_model, tokenizer=tokenizer, max_length=512),
+}
+# 每个查询各取20条互不重复的段落作为候选，重复候选会让排错的模型也命中相同内容，recall虚高
+bench_queries = ["刘备、关羽、张飞在哪里结义？", "曹操为什么要刺杀董卓？", "孙坚是怎么死的？",
+                 "吕布为了貂蝉和董卓反目", "诸葛亮出山前隐居在哪里？", "赤壁之战中周瑜用了什么计策？"]
+corpus = load_benchmark_passages(limit=20 * len(bench_queries))
+bench_passages = [corpus[i * 20:(i + 1) * 20] for i in range(len(bench_queries))]
+report = benchmark_rerankers({name: r.score_pairs for name, r in rerankers.items()},
+                             bench_queries, bench_passages, k=3)
+print_benchmark_report(report)
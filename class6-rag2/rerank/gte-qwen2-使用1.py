@@ -36,3 +36,35 @@ scores = (query_embeddings @ document_embeddings.T) * 100
 print(scores.tolist())
 [[78.49691772460938, 17.04286003112793], [14.924489974975586, 75.37960815429688]]
 
+
+
+# In[3]:
+
+
+# CPU推理：对Linear层做动态int8量化，并与浮点模型对比编码吞吐量和检索recall
+import os
+import sys
+sys.path.append(os.path.dirname(os.path.dirname(os.path.dirname(os.path.abspath(__file__)))))
+from services.cpu_inference import (benchmark_embedders, load_benchmark_passages, print_benchmark_report,
+                                    quantize_dynamic_int8, set_cpu_threads)
+
+set_cpu_threads()
+# CPU上长序列的注意力计算开销很大，按实际文本长度调小 max_seq_length
+model.max_seq_length = 512
+int8_model = quantize_dynamic_int8(model)
+
+# 用互不重复的段落作为语料，重复文本会让排错的量化模型也命中相同内容，recall虚高
+bench_documents = load_benchmark_passages(limit=256)
+bench_queries = ["刘备、关羽、张飞在哪里结义？", "曹操为什么要刺杀董卓？", "孙坚是怎么死的？",
+                 "吕布为了貂蝉和董卓反目", "诸葛亮出山前隐居在哪里？", "赤壁之战中周瑜用了什么计策？"]
+report = benchmark_embedders(
+    {
+        'float': lambda texts: model.encode(texts, batch_size=16),
+        'int8': lambda texts: int8_model.encode(texts, batch_size=16),
+    },
+    bench_queries, bench_documents, k=10,
+)
+print_benchmark_report(report)
+
+# sentence-transformers>=3.2 也可以直接加载ONNX后端：
+# onnx_model = SentenceTransformer(model_dir, backend="onnx", trust_remote_code=True)
@@ -0,0 +1,138 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+LLM批量并发调用模块
+用 asyncio 并发执行大批量LLM任务（如为整个知识库生成问题）：信号量限制并发数，
+遇到限流（429）和临时性错误时按 Retry-After 或指数退避重试，并让所有任务一起暂停；
+每完成一个任务就把结果追加写入JSONL检查点，中途崩溃后重新运行只处理未完成的任务。
+"""
+
+import asyncio
+import json
+import os
+import random
+import time
+from typing import Any, Awaitable, Callable, Dict, Optional, Sequence, Tuple
+
+from services.batch_embedding import is_retryable_error
+
+DEFAULT_CONCURRENCY = 16
+DEFAULT_MAX_RETRIES = 6
+DEFAULT_BASE_DELAY = 1.0
+DEFAULT_MAX_DELAY = 60.0
+
+
+def retry_after_seconds(error: BaseException) -> Optional[float]:
+    """从限流响应的 Retry-After 头中读取服务端建议的等待秒数"""
+    headers = getattr(getattr(error, "response", None), "headers", None) or {}
+    try:
+        return float(headers.get("retry-after") or headers.get("Retry-After"))
+    except (TypeError, ValueError):
+        return None
+
+
+class CheckpointStore:
+    """JSONL检查点：每行一个 {"key": ..., "result": ...}，追加写入，重复的键以最后一行为准"""
+
+    def __init__(self, path: str):
+        self.path = path
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+
+    def load(self) -> Dict[str, Any]:
+        """读取已完成的结果；崩溃时写了一半的最后一行会被跳过"""
+        results = {}
+        if not os.path.exists(self.path):
+            return results
+        valid_size = 0
+        with open(self.path, "rb") as f:
+            for line in f:
+                if not line.endswith(b"\n"):
+                    break
+                valid_size += len(line)
+                try:
+                    record = json.loads(line.decode("utf-8"))
+                except (UnicodeDecodeError, json.JSONDecodeError):
+                    continue
+                results[record["key"]] = record["result"]
+        # 截掉不完整的最后一行，之后追加的记录从新行开始
+        if valid_size < os.path.getsize(self.path):
+            with open(self.path, "rb+") as f:
+                f.truncate(valid_size)
+        return results
+
+    def append(self, key: str, result: Any) -> None:
+        with open(self.path, "a", encoding="utf-8") as f:
+            f.write(json.dumps({"key": key, "result": result}, ensure_ascii=False) + "\n")
+            f.flush()
+
+
+async def run_concurrent(tasks: Sequence[Tuple[str, Any]], worker: Callable[[Any], Awaitable[Any]],
+                         concurrency: int = DEFAULT_CONCURRENCY, max_retries: int = DEFAULT_MAX_RETRIES,
+                         base_delay: float = DEFAULT_BASE_DELAY, max_delay: float = DEFAULT_MAX_DELAY,
+                         checkpoint_path: Optional[str] = None, progress_every: int = 100) -> Dict[str, Any]:
+    """
+    并发执行一批异步任务
+
+    Args:
+        tasks: (任务键, 参数) 列表，任务键用于检查点去重，须在多次运行间保持稳定
+        worker: 异步函数，输入参数返回可JSON序列化的结果
+        concurrency: 同时进行的最大请求数
+        max_retries: 单个任务因限流/临时性错误重试的最大次数
+        base_delay: 指数退避的初始等待秒数
+        max_delay: 单次退避的最大等待秒数
+        checkpoint_path: JSONL检查点路径，为None时不做断点续跑
+        progress_every: 每完成多少个任务打印一次进度
+
+    Returns:
+        任务键 -> 结果；重试耗尽仍失败的任务不在其中，重新运行时会再次尝试
+    """
+    store = CheckpointStore(checkpoint_path) if checkpoint_path else None
+    results = store.load() if store else {}
+    pending = [(key, arg) for key, arg in dict(tasks).items() if key not in results]
+    if results:
+        print(f"从检查点恢复 {len(results)} 个已完成任务，剩余 {len(pending)} 个")
+
+    semaphore = asyncio.Semaphore(concurrency)
+    # 任一任务被限流时，所有任务都暂停到该时间点，避免继续冲击配额
+    state = {"pause_until": 0.0, "done": 0, "failed": 0}
+    start = time.perf_counter()
+
+    async def run_one(key: str, arg: Any) -> None:
+        for attempt in range(max_retries + 1):
+            try:
+                async with semaphore:
+                    # 拿到并发名额后再检查暂停：在信号量上排队的任务放行时也必须等到限流结束，
+                    # 等待期间可能又有任务被限流而延长暂停，因此循环检查
+                    wait = state["pause_until"] - time.monotonic()
+                    while wait > 0:
+                        await asyncio.sleep(wait)
+                        wait = state["pause_until"] - time.monotonic()
+                    result = await worker(arg)
+            except Exception as e:
+                if attempt == max_retries or not is_retryable_error(e):
+                    state["failed"] += 1
+                    print(f"任务 {key} 失败: {e}")
+                    return
+                delay = retry_after_seconds(e) or min(max_delay, base_delay * 2 ** attempt)
+                delay *= 1 + random.random() * 0.25
+                state["pause_until"] = max(state["pause_until"], time.monotonic() + delay)
+                continue
+            results[key] = result
+            if store:
+                store.append(key, result)
+            state["done"] += 1
+            if progress_every and state["done"] % progress_every == 0:
+                elapsed = time.perf_counter() - start
+                print(f"已完成 {state['done']}/{len(pending)} 个任务，{state['done'] / elapsed:.1f} 个/秒")
+            return
+
+    await asyncio.gather(*(run_one(key, arg) for key, arg in pending))
+    if state["failed"]:
+        print(f"{state['failed']} 个任务重试后仍失败，重新运行可继续处理")
+    return results
+
+
+def run_concurrent_sync(tasks: Sequence[Tuple[str, Any]], worker: Callable[[Any], Awaitable[Any]],
+                        **kwargs) -> Dict[str, Any]:
+    """在同步代码中调用 run_concurrent（参数同 run_concurrent）"""
+    return asyncio.run(run_concurrent(tasks, worker, **kwargs))
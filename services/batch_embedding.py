@@ -0,0 +1,136 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+批量并发 Embedding 模块
+把大量文本按批发送给嵌入接口（如 text-embedding-v4），限制同时在途的请求数，
+遇到限流或临时错误时指数退避重试，输出顺序与输入顺序严格一致。
+"""
+
+import random
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, List, Optional, Sequence
+
+# text-embedding-v4 单次请求最多支持10条文本
+DEFAULT_BATCH_SIZE = 10
+DEFAULT_MAX_WORKERS = 4
+DEFAULT_MAX_RETRIES = 6
+
+# 可重试的HTTP状态码：限流和服务端临时错误
+RETRYABLE_STATUS_CODES = {408, 409, 429, 500, 502, 503, 504}
+
+
+def is_retryable_error(error: Exception) -> bool:
+    """
+    判断异常是否值得重试（限流、超时、连接错误、服务端临时错误）
+
+    Args:
+        error: 请求抛出的异常
+
+    Returns:
+        是否应重试
+    """
+    status_code = getattr(error, "status_code", None)
+    if status_code is None:
+        status_code = getattr(getattr(error, "response", None), "status_code", None)
+    if status_code in RETRYABLE_STATUS_CODES:
+        return True
+    name = type(error).__name__
+    return any(key in name for key in ("RateLimit", "Timeout", "Connection"))
+
+
+def call_with_retry(func: Callable, *args, max_retries: int = DEFAULT_MAX_RETRIES,
+                    base_delay: float = 1.0, max_delay: float = 30.0):
+    """
+    调用函数，遇到可重试错误时按指数退避加随机抖动重试
+
+    Args:
+        func: 要调用的函数
+        max_retries: 最大重试次数
+        base_delay: 首次重试前的等待秒数
+        max_delay: 单次等待的上限秒数
+    """
+    for attempt in range(max_retries + 1):
+        try:
+            return func(*args)
+        except Exception as e:
+            if attempt >= max_retries or not is_retryable_error(e):
+                raise
+            # 服务端给出Retry-After时优先使用
+            retry_after = None
+            headers = getattr(getattr(e, "response", None), "headers", None)
+            if headers:
+                try:
+                    retry_after = float(headers.get("retry-after"))
+                except (TypeError, ValueError):
+                    retry_after = None
+            delay = retry_after if retry_after is not None else min(max_delay, base_delay * 2 ** attempt)
+            delay += random.uniform(0, delay * 0.1)
+            print(f"请求失败({type(e).__name__})，{delay:.1f}秒后进行第{attempt + 1}次重试...")
+            time.sleep(delay)
+
+
+def embed_texts_batched(texts: Sequence[str], embed_batch: Callable[[List[str]], List[List[float]]],
+                        batch_size: int = DEFAULT_BATCH_SIZE, max_workers: int = DEFAULT_MAX_WORKERS,
+                        max_retries: int = DEFAULT_MAX_RETRIES,
+                        progress: Optional[Callable[[int, int], None]] = None) -> List[List[float]]:
+    """
+    分批并发计算文本向量
+
+    Args:
+        texts: 文本列表
+        embed_batch: 单次请求函数，输入一批文本，返回同顺序的向量列表
+        batch_size: 每个请求包含的文本数
+        max_workers: 同时在途的最大请求数
+        max_retries: 每批的最大重试次数
+        progress: 可选回调，参数为(已完成批数, 总批数)
+
+    Returns:
+        与texts一一对应的向量列表
+    """
+    batches = [list(texts[i:i + batch_size]) for i in range(0, len(texts), batch_size)]
+    if not batches:
+        return []
+
+    results: List[Optional[List[List[float]]]] = [None] * len(batches)
+    done = 0
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = {
+            executor.submit(call_with_retry, embed_batch, batch, max_retries=max_retries): i
+            for i, batch in enumerate(batches)
+        }
+        for future, i in futures.items():
+            # 按提交顺序收集结果，保证输出顺序确定
+            vectors = future.result()
+            if len(vectors) != len(batches[i]):
+                raise ValueError(f"第{i}批返回了{len(vectors)}个向量，期望{len(batches[i])}个")
+            results[i] = vectors
+            done += 1
+            if progress:
+                progress(done, len(batches))
+
+    return [vector for batch_vectors in results for vector in batch_vectors]
+
+
+def openai_embedding_request(client, model: str, dimensions: Optional[int] = None) -> Callable[[List[str]], List[List[float]]]:
+    """
+    构造基于OpenAI兼容接口（如百炼）的单批请求函数
+
+    Args:
+        client: OpenAI客户端
+        model: 嵌入模型名称
+        dimensions: 向量维度
+
+    Returns:
+        输入一批文本、返回向量列表的函数
+    """
+    def request(batch: List[str]) -> List[List[float]]:
+        kwargs = {"model": model, "input": batch, "encoding_format": "float"}
+        if dimensions:
+            kwargs["dimensions"] = dimensions
+        response = client.embeddings.create(**kwargs)
+        # 接口返回的data带有index字段，按index排序以对应输入顺序
+        data = sorted(response.data, key=lambda item: item.index)
+        return [item.embedding for item in data]
+
+    return request
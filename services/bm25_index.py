@@ -0,0 +1,249 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+向量化 BM25 检索模块
+把分词后的语料构建为 scipy CSR 格式的 词项 x 文档 权重矩阵，IDF 与文档长度归一化在构建时一次算好，
+检索时把一批查询编码为稀疏矩阵，与权重矩阵做一次稀疏矩阵乘法即可得到全部得分，
+top-k 用 argpartition 只在非零得分上选取，不做全量排序。
+打分公式与 rank_bm25.BM25Okapi 一致，索引可保存到磁盘并重新加载。
+也可以用语料级的 IDF 和平均文档长度，为一个查询对任意候选文本列表一次性打分。
+"""
+
+import json
+import os
+from collections import Counter
+from typing import Dict, Iterable, List, Sequence, Tuple
+
+import numpy as np
+from scipy import sparse
+
+MATRIX_FILE = "bm25_matrix.npz"
+META_FILE = "bm25_meta.json"
+
+DEFAULT_K1 = 1.5
+DEFAULT_B = 0.75
+# 与 BM25Okapi 相同：IDF为负的词（出现在一半以上文档中）用 epsilon * 平均IDF 代替
+DEFAULT_EPSILON = 0.25
+# 批量检索时每次相乘的查询数，限制中间结果的内存占用
+DEFAULT_QUERY_BATCH_SIZE = 256
+
+
+class BM25Index:
+    """基于稀疏矩阵的 BM25 索引，支持批量查询打分"""
+
+    def __init__(self, k1: float = DEFAULT_K1, b: float = DEFAULT_B, epsilon: float = DEFAULT_EPSILON):
+        self.k1 = k1
+        self.b = b
+        self.epsilon = epsilon
+        self.vocabulary: Dict[str, int] = {}
+        self.idf = np.zeros(0, dtype=np.float32)
+        self.doc_len = np.zeros(0, dtype=np.int32)
+        self.avgdl = 0.0
+        # 形状为 (词表大小, 文档数)，元素为该词在该文档中的 BM25 得分贡献
+        self.matrix = sparse.csr_matrix((0, 0), dtype=np.float32)
+
+    def __len__(self) -> int:
+        return self.matrix.shape[1]
+
+    @property
+    def num_docs(self) -> int:
+        return self.matrix.shape[1]
+
+    def fit(self, corpus: Iterable[Sequence[str]]) -> "BM25Index":
+        """
+        构建索引
+
+        Args:
+            corpus: 分词后的文档列表，每个文档为词列表
+
+        Returns:
+            self，便于链式调用
+        """
+        vocabulary: Dict[str, int] = {}
+        rows, cols, counts = [], [], []
+        doc_len = []
+        for doc_id, tokens in enumerate(corpus):
+            doc_len.append(len(tokens))
+            for token, count in Counter(tokens).items():
+                term_id = vocabulary.setdefault(token, len(vocabulary))
+                rows.append(term_id)
+                cols.append(doc_id)
+                counts.append(count)
+
+        num_docs = len(doc_len)
+        self.vocabulary = vocabulary
+        self.doc_len = np.asarray(doc_len, dtype=np.int32)
+        self.avgdl = float(self.doc_len.mean()) if num_docs else 0.0
+
+        tf = sparse.csr_matrix(
+            (np.asarray(counts, dtype=np.float32), (np.asarray(rows, dtype=np.int64), np.asarray(cols, dtype=np.int64))),
+            shape=(len(vocabulary), num_docs),
+        )
+        self.idf = self._compute_idf(np.diff(tf.indptr), num_docs)
+
+        # 逐元素计算 idf * tf * (k1 + 1) / (tf + k1 * (1 - b + b * dl / avgdl))
+        tf.sort_indices()
+        term_ids = np.repeat(np.arange(tf.shape[0]), np.diff(tf.indptr))
+        length_norm = self.length_norm(self.doc_len)
+        freqs = tf.data
+        tf.data = (self.idf[term_ids] * freqs * (self.k1 + 1)
+                   / (freqs + length_norm[tf.indices])).astype(np.float32)
+        self.matrix = tf
+        return self
+
+    def _compute_idf(self, doc_freq: np.ndarray, num_docs: int) -> np.ndarray:
+        doc_freq = doc_freq.astype(np.float64)
+        idf = np.log(num_docs - doc_freq + 0.5) - np.log(doc_freq + 0.5)
+        if len(idf):
+            idf[idf < 0] = self.epsilon * idf.mean()
+        return idf.astype(np.float32)
+
+    def length_norm(self, lengths) -> np.ndarray:
+        """文档长度归一化项 k1 * (1 - b + b * dl / avgdl)"""
+        lengths = np.asarray(lengths, dtype=np.float32)
+        avgdl = self.avgdl or 1.0
+        return (self.k1 * (1 - self.b + self.b * lengths / avgdl)).astype(np.float32)
+
+    def encode_queries(self, queries: Sequence[Sequence[str]]) -> sparse.csr_matrix:
+        """
+        把分词后的查询编码为 (查询数, 词表大小) 的稀疏计数矩阵，不在词表中的词忽略
+
+        查询中重复出现的词按次数计分，与 BM25Okapi.get_scores 的行为一致。
+        """
+        rows, cols, counts = [], [], []
+        for row, tokens in enumerate(queries):
+            for token, count in Counter(tokens).items():
+                term_id = self.vocabulary.get(token)
+                if term_id is not None:
+                    rows.append(row)
+                    cols.append(term_id)
+                    counts.append(count)
+        return sparse.csr_matrix(
+            (np.asarray(counts, dtype=np.float32), (np.asarray(rows, dtype=np.int64), np.asarray(cols, dtype=np.int64))),
+            shape=(len(queries), len(self.vocabulary)),
+        )
+
+    def score_batch(self, queries: Sequence[Sequence[str]]) -> sparse.csr_matrix:
+        """
+        批量计算查询对全部文档的得分
+
+        Args:
+            queries: 分词后的查询列表
+
+        Returns:
+            (查询数, 文档数) 的稀疏得分矩阵，未命中任何查询词的文档不占存储
+        """
+        return (self.encode_queries(queries) @ self.matrix).tocsr()
+
+    def get_scores(self, query: Sequence[str]) -> np.ndarray:
+        """返回单个查询对全部文档的稠密得分数组，与 BM25Okapi.get_scores 兼容"""
+        return self.score_batch([query]).toarray()[0]
+
+    def term_idf(self, tokens: Sequence[str]) -> np.ndarray:
+        """返回各词的语料级IDF，语料中未出现的词按文档频率为0计算"""
+        unseen = float(np.log(self.num_docs + 0.5) - np.log(0.5))
+        return np.asarray([
+            self.idf[self.vocabulary[token]] if token in self.vocabulary else unseen for token in tokens
+        ], dtype=np.float32)
+
+    def score_candidates(self, query: Sequence[str], candidates: Sequence[Sequence[str]]) -> np.ndarray:
+        """
+        用本索引的语料统计量（IDF、平均文档长度）为一个查询对任意候选文本打分
+
+        候选文本不需要在索引中，打分等价于把每个候选当作语料中的一篇文档，
+        不会像为单个文本临时建索引那样得到退化的IDF。
+
+        Args:
+            query: 分词后的查询
+            candidates: 分词后的候选文本列表
+
+        Returns:
+            与candidates一一对应的得分数组
+        """
+        query_counts = Counter(query)
+        if not query_counts or not candidates:
+            return np.zeros(len(candidates), dtype=np.float32)
+        terms = list(query_counts)
+        column_of = {term: i for i, term in enumerate(terms)}
+        weights = self.term_idf(terms) * np.asarray([query_counts[t] for t in terms], dtype=np.float32)
+
+        # 只统计查询词在各候选中的词频：(候选数, 查询词数) 的稠密矩阵
+        rows, cols = [], []
+        for row, tokens in enumerate(candidates):
+            for token in tokens:
+                col = column_of.get(token)
+                if col is not None:
+                    rows.append(row)
+                    cols.append(col)
+        tf = np.zeros((len(candidates), len(terms)), dtype=np.float32)
+        np.add.at(tf, (np.asarray(rows, dtype=np.int64), np.asarray(cols, dtype=np.int64)), 1.0)
+
+        length_norm = self.length_norm([len(tokens) for tokens in candidates])[:, None]
+        return ((tf * (self.k1 + 1) / (tf + length_norm)) @ weights).astype(np.float32)
+
+    def top_k(self, queries: Sequence[Sequence[str]], k: int = 3,
+              batch_size: int = DEFAULT_QUERY_BATCH_SIZE) -> List[List[Tuple[int, float]]]:
+        """
+        批量检索每个查询得分最高的k个文档
+
+        Args:
+            queries: 分词后的查询列表
+            k: 每个查询返回的文档数
+            batch_size: 每次稀疏矩阵乘法包含的查询数
+
+        Returns:
+            与queries一一对应的列表，每项为按得分降序排列的 (文档行号, 得分)，只包含得分大于0的文档
+        """
+        results: List[List[Tuple[int, float]]] = []
+        for start in range(0, len(queries), batch_size):
+            scores = self.score_batch(queries[start:start + batch_size])
+            for row in range(scores.shape[0]):
+                begin, end = scores.indptr[row], scores.indptr[row + 1]
+                results.append(_top_k_sparse_row(scores.indices[begin:end], scores.data[begin:end], k))
+        return results
+
+    def save(self, directory: str) -> None:
+        """保存到目录下的 bm25_matrix.npz 与 bm25_meta.json"""
+        os.makedirs(directory, exist_ok=True)
+        sparse.save_npz(os.path.join(directory, MATRIX_FILE), self.matrix)
+        terms = [None] * len(self.vocabulary)
+        for token, term_id in self.vocabulary.items():
+            terms[term_id] = token
+        meta = {
+            "k1": self.k1,
+            "b": self.b,
+            "epsilon": self.epsilon,
+            "avgdl": self.avgdl,
+            "terms": terms,
+            "idf": self.idf.tolist(),
+            "doc_len": self.doc_len.tolist(),
+        }
+        with open(os.path.join(directory, META_FILE), "w", encoding="utf-8") as f:
+            json.dump(meta, f, ensure_ascii=False)
+
+    @classmethod
+    def load(cls, directory: str) -> "BM25Index":
+        """从 save 保存的目录加载索引"""
+        with open(os.path.join(directory, META_FILE), "r", encoding="utf-8") as f:
+            meta = json.load(f)
+        index = cls(k1=meta["k1"], b=meta["b"], epsilon=meta["epsilon"])
+        index.avgdl = meta["avgdl"]
+        index.vocabulary = {token: term_id for term_id, token in enumerate(meta["terms"])}
+        index.idf = np.asarray(meta["idf"], dtype=np.float32)
+        index.doc_len = np.asarray(meta["doc_len"], dtype=np.int32)
+        index.matrix = sparse.load_npz(os.path.join(directory, MATRIX_FILE)).tocsr()
+        return index
+
+
+def _top_k_sparse_row(doc_ids: np.ndarray, scores: np.ndarray, k: int) -> List[Tuple[int, float]]:
+    """在一行稀疏得分中选出得分最高的k个正分文档"""
+    if k <= 0:
+        return []
+    positive = scores > 0
+    doc_ids, scores = doc_ids[positive], scores[positive]
+    if len(scores) > k:
+        part = np.argpartition(-scores, k - 1)[:k]
+        doc_ids, scores = doc_ids[part], scores[part]
+    order = np.argsort(-scores, kind="stable")
+    return [(int(doc_ids[i]), float(scores[i])) for i in order]
+
@@ -0,0 +1,210 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+知识库版本变化检测模块
+按内容哈希比较两个版本的切片：ID和内容都相同的为未变化，内容相同但ID不同的为移动/重命名，
+剩余切片中ID相同的为修改；重新切分后ID对不上的切片再用MinHash/LSH找出内容相近的一对，记为修改。
+整个过程只做哈希表查找和LSH分桶，时间复杂度与切片数近似线性。
+"""
+
+import hashlib
+import re
+import zlib
+from collections import defaultdict
+from typing import Dict, List, Optional, Sequence, Set
+
+import numpy as np
+
+DEFAULT_SIMILARITY_THRESHOLD = 0.5
+DEFAULT_NUM_PERM = 64
+# 16个band、每个band 4行，Jaccard相似度约0.5以上的一对大概率落入同一个桶
+DEFAULT_BANDS = 16
+DEFAULT_NGRAM = 3
+
+# 2^31-1，保证 a*x+b 在uint64范围内不会溢出
+_MERSENNE_PRIME = (1 << 31) - 1
+_WHITESPACE = re.compile(r"\s+")
+
+
+def hash_content(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def shingles(text: str, n: int = DEFAULT_NGRAM) -> Set[str]:
+    """去掉空白后按字符n-gram切分（中文没有空格分词，字符级n-gram更稳定），短于n的文本整体作为一个片段"""
+    text = _WHITESPACE.sub("", text)
+    if len(text) <= n:
+        return {text} if text else set()
+    return {text[i:i + n] for i in range(len(text) - n + 1)}
+
+
+def jaccard(a: Set[str], b: Set[str]) -> float:
+    if not a and not b:
+        return 1.0
+    return len(a & b) / len(a | b)
+
+
+class MinHasher:
+    """用 num_perm 个随机线性哈希近似集合的最小哈希签名，签名中相等的位置比例即Jaccard相似度的估计"""
+
+    def __init__(self, num_perm: int = DEFAULT_NUM_PERM, seed: int = 1):
+        rng = np.random.default_rng(seed)
+        self.num_perm = num_perm
+        self._a = rng.integers(1, _MERSENNE_PRIME, num_perm, dtype=np.uint64)
+        self._b = rng.integers(0, _MERSENNE_PRIME, num_perm, dtype=np.uint64)
+
+    def signature(self, items: Set[str]) -> np.ndarray:
+        if not items:
+            return np.full(self.num_perm, _MERSENNE_PRIME, dtype=np.uint64)
+        values = np.array([zlib.crc32(item.encode("utf-8")) % _MERSENNE_PRIME for item in items], dtype=np.uint64)
+        hashed = (np.outer(values, self._a) + self._b) % _MERSENNE_PRIME
+        return hashed.min(axis=0)
+
+
+def _fuzzy_matches(old_texts: Dict[int, str], new_texts: Dict[int, str], threshold: float,
+                   num_perm: int, bands: int, ngram: int) -> List[tuple]:
+    """
+    用LSH分桶找出内容相近的 (旧下标, 新下标, 相似度)，按相似度从高到低一对一匹配
+
+    同一个桶里的才计算精确的Jaccard相似度，避免两两比较
+    """
+    # 空白文本块没有片段，两两之间Jaccard恒为1，不参与匹配，按新增/删除处理
+    old_shingles = {i: items for i, items in ((i, shingles(text, ngram)) for i, text in old_texts.items()) if items}
+    new_shingles = {j: items for j, items in ((j, shingles(text, ngram)) for j, text in new_texts.items()) if items}
+    if not old_shingles or not new_shingles:
+        return []
+    rows = num_perm // bands
+    hasher = MinHasher(bands * rows)
+
+    buckets = defaultdict(list)
+    for i, items in old_shingles.items():
+        signature = hasher.signature(items)
+        for band in range(bands):
+            buckets[(band, signature[band * rows:(band + 1) * rows].tobytes())].append(i)
+
+    candidates = {}
+    for j, items in new_shingles.items():
+        signature = hasher.signature(items)
+        seen = set()
+        for band in range(bands):
+            for i in buckets.get((band, signature[band * rows:(band + 1) * rows].tobytes()), ()):
+                if i in seen:
+                    continue
+                seen.add(i)
+                similarity = jaccard(old_shingles[i], items)
+                if similarity >= threshold:
+                    candidates[(i, j)] = similarity
+
+    matches, used_old, used_new = [], set(), set()
+    for (i, j), similarity in sorted(candidates.items(), key=lambda item: (-item[1], item[0])):
+        if i in used_old or j in used_new:
+            continue
+        used_old.add(i)
+        used_new.add(j)
+        matches.append((i, j, similarity))
+    return matches
+
+
+def detect_changes(old_chunks: Sequence[Dict], new_chunks: Sequence[Dict],
+                   similarity_threshold: Optional[float] = DEFAULT_SIMILARITY_THRESHOLD,
+                   num_perm: int = DEFAULT_NUM_PERM, bands: int = DEFAULT_BANDS,
+                   ngram: int = DEFAULT_NGRAM) -> Dict[str, List]:
+    """
+    检测两个版本之间的切片变化
+
+    Args:
+        old_chunks: 旧版本切片，含 id 和 content；已有内容哈希时可只提供 hash 字段
+        new_chunks: 新版本切片，格式同上
+        similarity_threshold: ID对不上的切片间字符n-gram的Jaccard相似度达到该值时视为修改，为None时不做模糊匹配
+            （只需按内容哈希增量更新索引时可关闭）
+        num_perm: MinHash签名长度
+        bands: LSH分段数，num_perm需能被整除
+        ngram: 字符n-gram长度
+
+    Returns:
+        {"added_chunks": [{"id", "content", "hash"}],
+         "removed_chunks": [{"id", "content", "hash"}],
+         "modified_chunks": [{"id", "old_id", "old_content", "new_content", "old_hash", "new_hash", "similarity"}],
+         "moved_chunks": [{"id", "old_id", "content", "hash"}],
+         "unchanged_chunks": [id]}
+        除 removed_chunks 按旧版本顺序外，其余都按新版本中的顺序排列；ID相同的修改 similarity 为None
+    """
+    def hashes_of(chunks):
+        return [chunk.get("hash") or hash_content(chunk.get("content", "")) for chunk in chunks]
+
+    old_hashes, new_hashes = hashes_of(old_chunks), hashes_of(new_chunks)
+    old_by_id = {}
+    for i, chunk in enumerate(old_chunks):
+        old_by_id.setdefault(chunk.get("id"), i)
+
+    # new下标 -> (类型, old下标, 相似度)
+    matched: Dict[int, tuple] = {}
+    used_old = set()
+
+    # 1. ID和内容都相同
+    for j, chunk in enumerate(new_chunks):
+        i = old_by_id.get(chunk.get("id"))
+        if i is not None and i not in used_old and old_hashes[i] == new_hashes[j]:
+            matched[j] = ("unchanged", i, 1.0)
+            used_old.add(i)
+
+    # 2. 内容相同、ID不同：移动或重命名，不需要重新Embedding
+    old_by_hash = defaultdict(list)
+    for i, content_hash in enumerate(old_hashes):
+        if i not in used_old:
+            old_by_hash[content_hash].append(i)
+    for j, content_hash in enumerate(new_hashes):
+        if j not in matched and old_by_hash.get(content_hash):
+            i = old_by_hash[content_hash].pop(0)
+            matched[j] = ("moved", i, 1.0)
+            used_old.add(i)
+
+    # 3. ID相同、内容不同
+    for j, chunk in enumerate(new_chunks):
+        i = old_by_id.get(chunk.get("id"))
+        if j not in matched and i is not None and i not in used_old:
+            matched[j] = ("modified", i, None)
+            used_old.add(i)
+
+    # 4. 剩余切片按内容相似度匹配，识别重新切分或改了ID的修改
+    if similarity_threshold is not None:
+        old_rest = {i: chunk.get("content", "") for i, chunk in enumerate(old_chunks) if i not in used_old}
+        new_rest = {j: chunk.get("content", "") for j, chunk in enumerate(new_chunks) if j not in matched}
+        for i, j, similarity in _fuzzy_matches(old_rest, new_rest, similarity_threshold, num_perm, bands, ngram):
+            matched[j] = ("modified", i, similarity)
+            used_old.add(i)
+
+    changes = {
+        "added_chunks": [],
+        "removed_chunks": [],
+        "modified_chunks": [],
+        "moved_chunks": [],
+        "unchanged_chunks": []
+    }
+    for j, chunk in enumerate(new_chunks):
+        if j not in matched:
+            changes["added_chunks"].append({"id": chunk.get("id"), "content": chunk.get("content", ""),
+                                            "hash": new_hashes[j]})
+            continue
+        kind, i, similarity = matched[j]
+        old_chunk = old_chunks[i]
+        if kind == "unchanged":
+            changes["unchanged_chunks"].append(chunk.get("id"))
+        elif kind == "moved":
+            changes["moved_chunks"].append({"id": chunk.get("id"), "old_id": old_chunk.get("id"),
+                                            "content": chunk.get("content", ""), "hash": new_hashes[j]})
+        else:
+            changes["modified_chunks"].append({
+                "id": chunk.get("id"),
+                "old_id": old_chunk.get("id"),
+                "old_content": old_chunk.get("content", ""),
+                "new_content": chunk.get("content", ""),
+                "old_hash": old_hashes[i],
+                "new_hash": new_hashes[j],
+                "similarity": similarity
+            })
+    for i, chunk in enumerate(old_chunks):
+        if i not in used_old:
+            changes["removed_chunks"].append({"id": chunk.get("id"), "content": chunk.get("content", ""),
+                                              "hash": old_hashes[i]})
+    return changes
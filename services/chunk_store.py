@@ -0,0 +1,189 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+文本切片元数据存储模块
+按列存储切片的 content/source/type/path 等字段，并维护 ID -> 行号 的哈希索引，
+FAISS 检索命中后可以 O(1) 取回元数据，且可与 FAISS 索引一起保存到磁盘。
+"""
+
+import json
+import os
+from array import array
+from typing import Any, Dict, Iterator, List, Optional
+
+METADATA_FILE = "metadata.json"
+
+
+class _CategoryColumn:
+    """字典编码的字符串列：重复值（如来源文件名、类型）只保存一次，行内只存整数编码"""
+
+    def __init__(self):
+        self.values: List[Any] = []
+        self.codes = array("i")
+        self._code_of: Dict[Any, int] = {}
+
+    def append(self, value: Any) -> None:
+        code = self._code_of.get(value)
+        if code is None:
+            code = len(self.values)
+            self._code_of[value] = code
+            self.values.append(value)
+        self.codes.append(code)
+
+    def __getitem__(self, row: int) -> Any:
+        return self.values[self.codes[row]]
+
+    def to_dict(self) -> dict:
+        return {"values": self.values, "codes": self.codes.tolist()}
+
+    @classmethod
+    def from_dict(cls, data: dict) -> "_CategoryColumn":
+        column = cls()
+        column.values = list(data["values"])
+        column.codes = array("i", data["codes"])
+        column._code_of = {value: code for code, value in enumerate(column.values)}
+        return column
+
+
+class ChunkMetadataStore:
+    """按列存储的切片元数据，支持按ID常数时间查找"""
+
+    # 高频且取值重复度高的列使用字典编码
+    CATEGORY_COLUMNS = ("source", "type")
+    # 每行各不相同的列直接存为列表
+    PLAIN_COLUMNS = ("content", "path")
+
+    def __init__(self):
+        self.ids = array("q")
+        self._row_by_id: Dict[int, int] = {}
+        self._category = {name: _CategoryColumn() for name in self.CATEGORY_COLUMNS}
+        self._plain: Dict[str, List[Any]] = {name: [] for name in self.PLAIN_COLUMNS}
+        # 其他字段（如 ocr、page、chunk_id）稀疏存储：字段名 -> {行号: 值}
+        self._extra: Dict[str, Dict[int, Any]] = {}
+
+    def __len__(self) -> int:
+        return len(self.ids)
+
+    def __contains__(self, doc_id: int) -> bool:
+        return int(doc_id) in self._row_by_id
+
+    def __iter__(self) -> Iterator[Dict[str, Any]]:
+        for row in range(len(self.ids)):
+            yield self._row(row)
+
+    def append(self, metadata: Dict[str, Any]) -> None:
+        """
+        添加一条元数据
+
+        Args:
+            metadata: 必须包含整数字段 id，其余字段可选
+        """
+        doc_id = int(metadata["id"])
+        if doc_id in self._row_by_id:
+            raise ValueError(f"重复的切片ID: {doc_id}")
+
+        row = len(self.ids)
+        self.ids.append(doc_id)
+        self._row_by_id[doc_id] = row
+        for name, column in self._category.items():
+            column.append(metadata.get(name))
+        for name, column in self._plain.items():
+            column.append(metadata.get(name))
+        for key, value in metadata.items():
+            if key == "id" or key in self._category or key in self._plain:
+                continue
+            self._extra.setdefault(key, {})[row] = value
+
+    def get(self, doc_id: int) -> Optional[Dict[str, Any]]:
+        """
+        按ID获取元数据
+
+        Args:
+            doc_id: 切片ID（FAISS返回的ID）
+
+        Returns:
+            元数据字典，ID不存在时返回None
+        """
+        row = self._row_by_id.get(int(doc_id))
+        if row is None:
+            return None
+        return self._row(row)
+
+    def get_field(self, doc_id: int, name: str, default: Any = None) -> Any:
+        """只取单个字段，避免构造整行字典"""
+        row = self._row_by_id.get(int(doc_id))
+        if row is None:
+            return default
+        if name in self._category:
+            return self._category[name][row]
+        if name in self._plain:
+            return self._plain[name][row]
+        return self._extra.get(name, {}).get(row, default)
+
+    def ids_of_type(self, chunk_type: str) -> List[int]:
+        """返回指定类型（text/image等）的全部切片ID，保持插入顺序"""
+        column = self._category["type"]
+        code = column._code_of.get(chunk_type)
+        if code is None:
+            return []
+        return [self.ids[row] for row, c in enumerate(column.codes) if c == code]
+
+    def _row(self, row: int) -> Dict[str, Any]:
+        item = {"id": self.ids[row]}
+        for name, column in self._category.items():
+            value = column[row]
+            if value is not None:
+                item[name] = value
+        for name, column in self._plain.items():
+            value = column[row]
+            if value is not None:
+                item[name] = value
+        for name, values in self._extra.items():
+            if row in values:
+                item[name] = values[row]
+        return item
+
+    def save(self, directory: str) -> str:
+        """
+        保存到目录下的 metadata.json（与 FAISS 索引文件放在同一目录）
+
+        Returns:
+            保存的文件路径
+        """
+        os.makedirs(directory, exist_ok=True)
+        data = {
+            "ids": self.ids.tolist(),
+            "category_columns": {name: column.to_dict() for name, column in self._category.items()},
+            "plain_columns": self._plain,
+            "extra_columns": {name: {str(row): value for row, value in values.items()}
+                              for name, values in self._extra.items()},
+        }
+        path = os.path.join(directory, METADATA_FILE)
+        with open(path, "w", encoding="utf-8") as f:
+            json.dump(data, f, ensure_ascii=False)
+        return path
+
+    @classmethod
+    def load(cls, directory: str) -> "ChunkMetadataStore":
+        """从目录下的 metadata.json 加载"""
+        with open(os.path.join(directory, METADATA_FILE), "r", encoding="utf-8") as f:
+            data = json.load(f)
+
+        store = cls()
+        store.ids = array("q", data["ids"])
+        store._row_by_id = {doc_id: row for row, doc_id in enumerate(store.ids)}
+        for name in cls.CATEGORY_COLUMNS:
+            store._category[name] = _CategoryColumn.from_dict(data["category_columns"][name])
+        for name in cls.PLAIN_COLUMNS:
+            store._plain[name] = list(data["plain_columns"][name])
+        store._extra = {name: {int(row): value for row, value in values.items()}
+                        for name, values in data.get("extra_columns", {}).items()}
+        return store
+
+    @classmethod
+    def from_records(cls, records) -> "ChunkMetadataStore":
+        """从字典列表（旧版 metadata_store 格式）构造"""
+        store = cls()
+        for record in records:
+            store.append(record)
+        return store
@@ -0,0 +1,124 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+冲突候选对预筛选模块
+知识冲突只可能出现在谈论同一对象的切片之间。先用两种廉价方法找出候选切片对：
+倒排索引（共享足够多的实体/关键词）和向量近邻检索（余弦相似度超过阈值），
+再只把候选对分批交给LLM判断是否冲突，把全量两两比较变成有限次数的定向调用。
+"""
+
+from collections import defaultdict
+from dataclasses import dataclass, field
+from typing import Dict, List, Optional, Sequence, Tuple
+
+from services.vector_index import build_index, normalize_vectors, search
+
+DEFAULT_MIN_SHARED_TERMS = 2
+# 出现在过多切片中的词（如"迪士尼"）区分不出对象，且会产生平方级的候选对，直接跳过
+DEFAULT_MAX_POSTINGS = 200
+# 同理，出现在超过该比例切片中的词也跳过（小知识库中 DEFAULT_MAX_POSTINGS 起不到作用）
+DEFAULT_MAX_DF_RATIO = 0.5
+DEFAULT_SIMILARITY_THRESHOLD = 0.8
+DEFAULT_NEIGHBORS = 10
+# 超过该数量时改用HNSW近似检索
+ANN_MIN_VECTORS = 10_000
+
+
+@dataclass
+class CandidatePair:
+    """一对可能冲突的切片"""
+    left: int
+    right: int
+    shared_terms: List[str] = field(default_factory=list)
+    similarity: Optional[float] = None
+
+    @property
+    def score(self) -> float:
+        """候选优先级：关键词重合度与向量相似度中较大的一个"""
+        return max(len(self.shared_terms) / 10, self.similarity or 0.0)
+
+
+def keyword_candidate_pairs(token_lists: Sequence[Sequence[str]], min_shared_terms: int = DEFAULT_MIN_SHARED_TERMS,
+                            max_postings: int = DEFAULT_MAX_POSTINGS,
+                            max_df_ratio: float = DEFAULT_MAX_DF_RATIO) -> Dict[Tuple[int, int], List[str]]:
+    """
+    用倒排索引找出共享至少min_shared_terms个关键词的切片对
+
+    Args:
+        token_lists: 每个切片的分词结果
+        min_shared_terms: 判定为候选所需的最少共享词数
+        max_postings: 倒排表长度上限，出现在更多切片中的词不参与配对
+        max_df_ratio: 出现在超过该比例切片中的词不参与配对（至少允许2个切片）
+
+    Returns:
+        (下标小, 下标大) -> 共享的关键词
+    """
+    postings: Dict[str, List[int]] = defaultdict(list)
+    for i, tokens in enumerate(token_lists):
+        for term in set(tokens):
+            postings[term].append(i)
+
+    max_docs = min(max_postings, max(2, int(max_df_ratio * len(token_lists))))
+    shared: Dict[Tuple[int, int], List[str]] = defaultdict(list)
+    for term, docs in postings.items():
+        if len(docs) < 2 or len(docs) > max_docs:
+            continue
+        for a in range(len(docs)):
+            for b in range(a + 1, len(docs)):
+                shared[(docs[a], docs[b])].append(term)
+    return {pair: sorted(terms) for pair, terms in shared.items() if len(terms) >= min_shared_terms}
+
+
+def embedding_candidate_pairs(vectors, threshold: float = DEFAULT_SIMILARITY_THRESHOLD,
+                              k: int = DEFAULT_NEIGHBORS) -> Dict[Tuple[int, int], float]:
+    """
+    用向量近邻检索找出余弦相似度不低于threshold的切片对
+
+    Returns:
+        (下标小, 下标大) -> 余弦相似度
+    """
+    num_vectors = len(vectors)
+    if num_vectors < 2:
+        return {}
+    vectors = normalize_vectors(vectors)
+    index = build_index(vectors, index_type="hnsw" if num_vectors >= ANN_MIN_VECTORS else "flat", metric="ip")
+    similarities, neighbors = search(index, vectors, min(k, num_vectors))
+
+    pairs: Dict[Tuple[int, int], float] = {}
+    for i in range(num_vectors):
+        for similarity, j in zip(similarities[i], neighbors[i]):
+            j = int(j)
+            if j < 0 or j == i or similarity < threshold:
+                continue
+            pairs[(min(i, j), max(i, j))] = float(similarity)
+    return pairs
+
+
+def find_candidate_pairs(token_lists: Sequence[Sequence[str]], vectors=None,
+                         min_shared_terms: int = DEFAULT_MIN_SHARED_TERMS, max_postings: int = DEFAULT_MAX_POSTINGS,
+                         max_df_ratio: float = DEFAULT_MAX_DF_RATIO,
+                         similarity_threshold: float = DEFAULT_SIMILARITY_THRESHOLD, k: int = DEFAULT_NEIGHBORS,
+                         max_pairs: Optional[int] = None) -> List[CandidatePair]:
+    """
+    合并关键词和向量两路候选
+
+    Args:
+        token_lists: 每个切片的分词结果
+        vectors: 可选，每个切片的向量，提供时加入向量近邻候选
+        min_shared_terms: 关键词候选所需的最少共享词数
+        max_postings: 倒排表长度上限
+        max_df_ratio: 参与配对的词的最大文档频率比例
+        similarity_threshold: 向量候选的余弦相似度阈值
+        k: 每个切片检索的近邻数
+        max_pairs: 最多返回的候选对数，按优先级截断
+
+    Returns:
+        按优先级降序的候选对
+    """
+    keyword_pairs = keyword_candidate_pairs(token_lists, min_shared_terms, max_postings, max_df_ratio)
+    vector_pairs = embedding_candidate_pairs(vectors, similarity_threshold, k) if vectors is not None else {}
+
+    candidates = [CandidatePair(left, right, keyword_pairs.get((left, right), []), vector_pairs.get((left, right)))
+                  for left, right in set(keyword_pairs) | set(vector_pairs)]
+    candidates.sort(key=lambda pair: (-pair.score, pair.left, pair.right))
+    return candidates[:max_pairs] if max_pairs else candidates
@@ -0,0 +1,346 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Embedding 持久化缓存模块
+以 (模型, 维度, 文本哈希) 为键把向量保存在本地SQLite文件中，
+支持LRU淘汰和条目数/容量上限，可包装任意嵌入后端。
+"""
+
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+from typing import Callable, Iterable, List, Optional, Sequence
+
+import numpy as np
+from langchain_core.embeddings import Embeddings
+
+# 默认缓存文件位置，可通过环境变量 EMBEDDING_CACHE_PATH 覆盖
+DEFAULT_CACHE_PATH = os.getenv(
+    "EMBEDDING_CACHE_PATH",
+    os.path.join(os.path.expanduser("~"), ".cache", "llm-course", "embeddings.sqlite3"),
+)
+DEFAULT_MAX_ENTRIES = 500_000
+DEFAULT_MAX_BYTES = 4 * 1024 ** 3
+
+# SQLite单条语句的参数个数有限，批量查询时分段执行
+_SQL_BATCH = 500
+# 条目数和字节数在内存中累加，每写入这么多条重新精确统计一次，纳入其他进程的写入
+_SYNC_INTERVAL = 10_000
+# 超出上限时一次淘汰到上限的90%，避免缓存写满后每次写入都触发淘汰
+_EVICT_TARGET = 0.9
+
+
+def hash_text(text: str) -> str:
+    """计算文本的SHA256，作为缓存键的一部分"""
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+class EmbeddingCache:
+    """基于SQLite的Embedding磁盘缓存，线程安全，可多进程共享同一文件"""
+
+    def __init__(self, path: str = DEFAULT_CACHE_PATH, max_entries: int = DEFAULT_MAX_ENTRIES,
+                 max_bytes: int = DEFAULT_MAX_BYTES):
+        """
+        初始化缓存
+
+        Args:
+            path: 缓存文件路径
+            max_entries: 最多保存的向量条数，超出后按最近最少使用淘汰
+            max_bytes: 向量数据总字节数上限，超出后按最近最少使用淘汰
+        """
+        self.path = path
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        # 缓存条目数和向量字节数的估计值，首次写入时精确统计
+        self._count = None
+        self._bytes = 0
+        self._unsynced_writes = 0
+
+        directory = os.path.dirname(os.path.abspath(path))
+        os.makedirs(directory, exist_ok=True)
+        self._conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        # WAL模式允许多个进程同时读，写入时不阻塞读取
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS embeddings (
+                model TEXT NOT NULL,
+                dimensions INTEGER NOT NULL,
+                text_hash TEXT NOT NULL,
+                vector BLOB NOT NULL,
+                last_access REAL NOT NULL,
+                PRIMARY KEY (model, dimensions, text_hash)
+            )
+            """
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS idx_last_access ON embeddings(last_access)")
+        self._conn.commit()
+
+    def get_many(self, model: str, dimensions: int, texts: Sequence[str]) -> List[Optional[List[float]]]:
+        """
+        批量查询缓存
+
+        Args:
+            model: 嵌入模型名称
+            dimensions: 向量维度，未指定维度的后端传0
+            texts: 文本列表
+
+        Returns:
+            与texts一一对应的向量列表，未命中的位置为None
+        """
+        hashes = [hash_text(text) for text in texts]
+        found = {}
+        with self._lock:
+            unique_hashes = list(dict.fromkeys(hashes))
+            for start in range(0, len(unique_hashes), _SQL_BATCH):
+                batch = unique_hashes[start:start + _SQL_BATCH]
+                placeholders = ",".join("?" * len(batch))
+                rows = self._conn.execute(
+                    f"SELECT text_hash, vector FROM embeddings "
+                    f"WHERE model = ? AND dimensions = ? AND text_hash IN ({placeholders})",
+                    [model, dimensions, *batch],
+                ).fetchall()
+                for text_hash, blob in rows:
+                    found[text_hash] = np.frombuffer(blob, dtype=np.float32).tolist()
+
+            # 更新命中条目的访问时间，用于LRU淘汰
+            if found:
+                now = time.time()
+                self._conn.executemany(
+                    "UPDATE embeddings SET last_access = ? WHERE model = ? AND dimensions = ? AND text_hash = ?",
+                    [(now, model, dimensions, h) for h in found],
+                )
+                self._conn.commit()
+
+        results = [found.get(h) for h in hashes]
+        hit_count = sum(1 for r in results if r is not None)
+        self.hits += hit_count
+        self.misses += len(results) - hit_count
+        return results
+
+    def put_many(self, model: str, dimensions: int, texts: Sequence[str], vectors: Iterable[Sequence[float]]) -> None:
+        """
+        批量写入缓存，写入后按容量上限执行淘汰
+
+        Args:
+            model: 嵌入模型名称
+            dimensions: 向量维度，未指定维度的后端传0
+            texts: 文本列表
+            vectors: 与texts一一对应的向量
+        """
+        now = time.time()
+        rows = [
+            (model, dimensions, hash_text(text), np.asarray(vector, dtype=np.float32).tobytes(), now)
+            for text, vector in zip(texts, vectors)
+        ]
+        if not rows:
+            return
+        with self._lock:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO embeddings (model, dimensions, text_hash, vector, last_access) "
+                "VALUES (?, ?, ?, ?, ?)",
+                rows,
+            )
+            self._evict(len(rows), sum(len(row[3]) for row in rows))
+            self._conn.commit()
+
+    def _sync_totals(self) -> None:
+        """全表精确统计条目数和字节数（调用方需持有锁）"""
+        self._count, self._bytes = self._conn.execute(
+            "SELECT COUNT(*), COALESCE(SUM(LENGTH(vector)), 0) FROM embeddings"
+        ).fetchone()
+        self._unsynced_writes = 0
+
+    def _over_limit(self) -> bool:
+        return self._count > self.max_entries or self._bytes > self.max_bytes
+
+    def _evict(self, added_rows: int, added_bytes: int) -> None:
+        """
+        按最近最少使用顺序删除超出上限的条目（调用方需持有锁）
+
+        平时只累加本次写入的条数和字节数，不扫描全表；估计值超出上限时才精确统计并淘汰
+        """
+        if self._count is None or self._unsynced_writes + added_rows >= _SYNC_INTERVAL:
+            self._sync_totals()
+        else:
+            # 覆盖已有条目时估计值偏大，只会让精确统计提前发生
+            self._count += added_rows
+            self._bytes += added_bytes
+            self._unsynced_writes += added_rows
+        if not self._over_limit():
+            return
+        self._sync_totals()
+        if not self._over_limit():
+            return
+
+        count, total_bytes = self._count, self._bytes
+        target_entries = int(self.max_entries * _EVICT_TARGET)
+        target_bytes = int(self.max_bytes * _EVICT_TARGET)
+        excess = max(0, count - target_entries)
+        if total_bytes > target_bytes and count:
+            # 按平均条目大小估算需要删除的条数
+            avg_size = total_bytes / count
+            excess = max(excess, int((total_bytes - target_bytes) / avg_size) + 1)
+        deleted = self._conn.execute(
+            "DELETE FROM embeddings WHERE rowid IN "
+            "(SELECT rowid FROM embeddings ORDER BY last_access ASC LIMIT ?)",
+            (excess,),
+        ).rowcount
+        self._count = count - deleted
+        self._bytes = max(0, total_bytes - int(deleted * total_bytes / count))
+
+    def stats(self) -> dict:
+        """返回缓存统计信息"""
+        with self._lock:
+            count, total_bytes = self._conn.execute(
+                "SELECT COUNT(*), COALESCE(SUM(LENGTH(vector)), 0) FROM embeddings"
+            ).fetchone()
+        return {
+            "entries": count,
+            "bytes": total_bytes,
+            "hits": self.hits,
+            "misses": self.misses,
+        }
+
+    def clear(self) -> None:
+        """清空缓存"""
+        with self._lock:
+            self._conn.execute("DELETE FROM embeddings")
+            self._conn.commit()
+            self._count, self._bytes, self._unsynced_writes = 0, 0, 0
+
+    def close(self) -> None:
+        """关闭数据库连接"""
+        with self._lock:
+            self._conn.close()
+
+
+_default_cache = None
+_default_cache_lock = threading.Lock()
+
+
+def get_default_cache() -> EmbeddingCache:
+    """获取进程内共享的默认缓存实例"""
+    global _default_cache
+    with _default_cache_lock:
+        if _default_cache is None:
+            _default_cache = EmbeddingCache()
+        return _default_cache
+
+
+def embed_with_cache(texts: Sequence[str], embed_batch: Callable[[List[str]], List[List[float]]],
+                     model: str, dimensions: int = 0,
+                     cache: Optional[EmbeddingCache] = None) -> List[List[float]]:
+    """
+    先查缓存，只对未命中的文本调用嵌入函数，结果写回缓存
+
+    Args:
+        texts: 文本列表
+        embed_batch: 批量嵌入函数，输入文本列表，返回向量列表
+        model: 嵌入模型名称
+        dimensions: 向量维度，未指定维度的后端传0
+        cache: 缓存实例，默认使用共享缓存
+
+    Returns:
+        与texts一一对应的向量列表
+    """
+    cache = cache or get_default_cache()
+    results = cache.get_many(model, dimensions, texts)
+
+    # 同一批中重复的文本只嵌入一次
+    missing = list(dict.fromkeys(text for text, vector in zip(texts, results) if vector is None))
+    if missing:
+        vectors = embed_batch(missing)
+        cache.put_many(model, dimensions, missing, vectors)
+        # 统一转为float32精度，保证命中与未命中时返回的结果完全一致
+        computed = dict(zip(missing, np.asarray(vectors, dtype=np.float32).tolist()))
+        results = [vector if vector is not None else computed[text]
+                   for text, vector in zip(texts, results)]
+    return results
+
+
+def cached_embedding_function(embed_one: Callable[[str], List[float]], model: str, dimensions: int = 0,
+                              cache: Optional[EmbeddingCache] = None) -> Callable[[str], List[float]]:
+    """
+    包装单文本嵌入函数（如 get_text_embedding），返回带缓存的同签名函数
+
+    Args:
+        embed_one: 输入单个文本、返回向量的函数
+        model: 嵌入模型名称
+        dimensions: 向量维度，未指定维度的后端传0
+        cache: 缓存实例，默认使用共享缓存
+    """
+    def embed_batch(texts):
+        return [embed_one(text) for text in texts]
+
+    def wrapper(text: str) -> List[float]:
+        return embed_with_cache([text], embed_batch, model, dimensions, cache)[0]
+
+    wrapper.__doc__ = embed_one.__doc__
+    wrapper.__wrapped__ = embed_one
+    return wrapper
+
+
+class CachedEmbeddings(Embeddings):
+    """带磁盘缓存的LangChain Embeddings包装器，可包装DashScopeEmbeddings、OllamaEmbeddings等"""
+
+    def __init__(self, embeddings: Embeddings, model: Optional[str] = None, dimensions: int = 0,
+                 cache: Optional[EmbeddingCache] = None, cache_queries: bool = True, normalize: bool = False):
+        """
+        Args:
+            embeddings: 被包装的嵌入后端
+            model: 缓存键中的模型名称，默认读取后端的model属性
+            dimensions: 向量维度，未指定维度的后端传0
+            cache: 缓存实例，默认使用共享缓存
+            cache_queries: 是否同时缓存查询向量
+            normalize: 是否返回L2归一化的向量，配合内积索引即为余弦相似度（缓存中保存原始向量）
+        """
+        self.embeddings = embeddings
+        self.model = model or getattr(embeddings, "model", None) or type(embeddings).__name__
+        self.dimensions = dimensions
+        self.cache = cache or get_default_cache()
+        self.cache_queries = cache_queries
+        self.normalize = normalize
+
+    def _postprocess(self, vectors: List[List[float]]) -> List[List[float]]:
+        if not self.normalize or not vectors:
+            return vectors
+        array = np.asarray(vectors, dtype=np.float32)
+        norms = np.linalg.norm(array, axis=1, keepdims=True)
+        return (array / np.maximum(norms, 1e-12)).tolist()
+
+    def embed_documents(self, texts: List[str]) -> List[List[float]]:
+        return self._postprocess(
+            embed_with_cache(texts, self.embeddings.embed_documents, self.model, self.dimensions, self.cache)
+        )
+
+    def embed_queries(self, texts: List[str], max_workers: int = 8) -> List[List[float]]:
+        """
+        批量计算查询向量：命中缓存的直接返回，其余通过 embed_query 并发请求，
+        保持查询侧的向量语义（部分模型区分query/document），总耗时约为一次请求
+        """
+        def embed_missing(missing: List[str]) -> List[List[float]]:
+            with ThreadPoolExecutor(max_workers=max(1, min(max_workers, len(missing)))) as executor:
+                return list(executor.map(self.embeddings.embed_query, missing))
+
+        if not self.cache_queries:
+            return self._postprocess(embed_missing(texts)) if texts else []
+        return self._postprocess(
+            embed_with_cache(texts, embed_missing, f"{self.model}#query", self.dimensions, self.cache)
+        )
+
+    def embed_query(self, text: str) -> List[float]:
+        if not self.cache_queries:
+            return self._postprocess([self.embeddings.embed_query(text)])[0]
+        # 部分模型的查询向量与文档向量不同，使用独立的模型键
+        return self._postprocess(embed_with_cache(
+            [text], lambda texts: [self.embeddings.embed_query(t) for t in texts],
+            f"{self.model}#query", self.dimensions, self.cache,
+        ))[0]
@@ -0,0 +1,234 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+时效性事实抽取与索引模块
+用正则从知识切片中确定性地抽取日期、年份、金额、电话、网址和"最新/今年"等时效词，
+连同切片的 last_updated 按内容哈希保存在本地SQLite索引中，内容不变的切片不再重复抽取。
+过期候选的判定变成对索引的规则查询，只有被标记的切片才需要交给LLM复核，
+LLM的复核结论也按内容哈希缓存，知识库没有变化时每天重跑健康检查几乎没有成本。
+"""
+
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+from datetime import date, datetime
+from typing import Any, Dict, List, Optional, Sequence
+
+DEFAULT_INDEX_PATH = os.getenv(
+    "FACT_INDEX_PATH",
+    os.path.join(os.path.expanduser("~"), ".cache", "llm-course", "facts.sqlite3"),
+)
+# 含价格、电话、网址的切片超过该天数未更新即标记
+DEFAULT_FACT_MAX_AGE_DAYS = 180
+# 含"最新"、"今年"等相对时效词的切片超过该天数未更新即标记
+DEFAULT_RELATIVE_MAX_AGE_DAYS = 90
+# LLM复核结论的有效期，过期后即使内容未变也重新复核
+DEFAULT_RECHECK_DAYS = 30
+
+_DATE_PATTERNS = [
+    re.compile(r"(?P<y>(?:19|20)\d{2})\s*年\s*(?P<m>\d{1,2})\s*月\s*(?P<d>\d{1,2})\s*[日号]"),
+    re.compile(r"(?<!\d)(?P<y>(?:19|20)\d{2})[-/.](?P<m>\d{1,2})[-/.](?P<d>\d{1,2})(?!\d)"),
+]
+_YEAR_PATTERN = re.compile(r"(?<!\d)((?:19|20)\d{2})\s*年")
+_PRICE_PATTERN = re.compile(
+    r"(?:[¥￥]\s*(?P<pre>\d+(?:\.\d+)?))|(?:(?P<amount>\d+(?:\.\d+)?)\s*(?P<unit>元|块|人民币|RMB|rmb)"
+    r"(?:\s*/\s*(?P<per>天|人|次|小时|晚|年|月))?)"
+)
+_PHONE_PATTERN = re.compile(r"(?<!\d)(?:1[3-9]\d{9}|400-?\d{3}-?\d{4}|0\d{2,3}-?\d{7,8})(?!\d)")
+_URL_PATTERN = re.compile(r"https?://[^\s，。、；）)]+|www\.[^\s，。、；）)]+")
+RELATIVE_TIME_WORDS = ("最新", "目前", "现在", "今年", "本月", "本周", "近期", "最近", "即将", "将于", "预计", "新推出")
+FUTURE_WORDS = ("即将", "将于", "预计", "计划")
+
+
+def hash_content(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def parse_date(value: Any) -> Optional[date]:
+    """解析 2024-01-15、2024/1/15、2024年1月15日、ISO时间等格式，无法解析时返回None"""
+    if isinstance(value, datetime):
+        return value.date()
+    if isinstance(value, date):
+        return value
+    if not value:
+        return None
+    text = str(value).strip()
+    for pattern in _DATE_PATTERNS:
+        match = pattern.search(text)
+        if match:
+            try:
+                return date(int(match["y"]), int(match["m"]), int(match["d"]))
+            except ValueError:
+                return None
+    return None
+
+
+def extract_facts(text: str) -> Dict[str, List]:
+    """
+    从文本中抽取时效性事实
+
+    Returns:
+        {"dates": ISO日期, "years": 年份, "prices": {"amount", "unit", "text"}, "phones", "urls", "time_words"}
+    """
+    dates = []
+    for pattern in _DATE_PATTERNS:
+        for match in pattern.finditer(text):
+            parsed = parse_date(match.group(0))
+            if parsed:
+                dates.append(parsed.isoformat())
+    prices = []
+    for match in _PRICE_PATTERN.finditer(text):
+        amount = match["pre"] or match["amount"]
+        unit = "元" + (f"/{match['per']}" if match["per"] else "")
+        prices.append({"amount": float(amount), "unit": unit, "text": match.group(0)})
+    return {
+        "dates": sorted(set(dates)),
+        "years": sorted({int(year) for year in _YEAR_PATTERN.findall(text)}),
+        "prices": prices,
+        "phones": sorted(set(_PHONE_PATTERN.findall(text))),
+        "urls": sorted(set(_URL_PATTERN.findall(text))),
+        "time_words": [word for word in RELATIVE_TIME_WORDS if word in text],
+    }
+
+
+def outdated_reasons(facts: Dict[str, List], last_updated: Optional[date], today: date,
+                     fact_max_age_days: int = DEFAULT_FACT_MAX_AGE_DAYS,
+                     relative_max_age_days: int = DEFAULT_RELATIVE_MAX_AGE_DAYS) -> List[str]:
+    """
+    按规则判断切片是否可能过期
+
+    Returns:
+        标记原因列表，为空表示无需复核
+    """
+    reasons = []
+    volatile = [name for name, key in (("价格", "prices"), ("电话", "phones"), ("网址", "urls")) if facts.get(key)]
+    age = (today - last_updated).days if last_updated else None
+    if volatile and (age is None or age > fact_max_age_days):
+        reasons.append(f"包含{'/'.join(volatile)}，" + ("缺少更新时间" if age is None else f"已 {age} 天未更新"))
+    if facts.get("time_words") and (age is None or age > relative_max_age_days):
+        reasons.append(f"使用相对时效词（{'、'.join(facts['time_words'])}），" +
+                       ("缺少更新时间" if age is None else f"已 {age} 天未更新"))
+    # "即将/将于/预计"描述的日期已经过去，说明是过时的预告
+    if any(word in facts.get("time_words", []) for word in FUTURE_WORDS):
+        past = [d for d in facts.get("dates", []) if date.fromisoformat(d) < today]
+        past += [str(y) for y in facts.get("years", []) if y < today.year]
+        if past:
+            reasons.append(f"预告性描述中的时间已过去（{'、'.join(past)}）")
+    return reasons
+
+
+class FactIndex:
+    """按切片保存抽取结果、last_updated 和LLM复核结论的索引，线程安全"""
+
+    def __init__(self, path: Optional[str] = DEFAULT_INDEX_PATH):
+        """
+        初始化索引
+
+        Args:
+            path: 索引文件路径，为None时只保存在内存中
+        """
+        if path:
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._conn = sqlite3.connect(path or ":memory:", check_same_thread=False, timeout=30)
+        self._lock = threading.Lock()
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS facts (
+                chunk_id TEXT PRIMARY KEY,
+                content_hash TEXT NOT NULL,
+                last_updated TEXT,
+                facts TEXT NOT NULL,
+                review TEXT,
+                reviewed_at REAL
+            )
+            """
+        )
+        self._conn.commit()
+
+    def update(self, knowledge_base: Sequence[Dict]) -> int:
+        """
+        同步知识库：只对新增或内容变化的切片重新抽取，内容或更新时间变化时清除旧的复核结论
+
+        Returns:
+            重新抽取的切片数
+        """
+        with self._lock:
+            existing = dict(self._conn.execute("SELECT chunk_id, content_hash || '|' || IFNULL(last_updated, '') FROM facts"))
+        rows = []
+        for chunk in knowledge_base:
+            chunk_id = str(chunk.get("id", ""))
+            content = chunk.get("content", "")
+            last_updated = str(chunk["last_updated"]) if chunk.get("last_updated") else None
+            content_hash = hash_content(content)
+            if existing.get(chunk_id) == f"{content_hash}|{last_updated or ''}":
+                continue
+            rows.append((chunk_id, content_hash, last_updated, json.dumps(extract_facts(content), ensure_ascii=False)))
+        if rows:
+            with self._lock:
+                self._conn.executemany(
+                    "INSERT OR REPLACE INTO facts (chunk_id, content_hash, last_updated, facts, review, reviewed_at) "
+                    "VALUES (?, ?, ?, ?, NULL, NULL)", rows)
+                self._conn.commit()
+        return len(rows)
+
+    def facts(self, chunk_id: str) -> Optional[Dict[str, List]]:
+        with self._lock:
+            row = self._conn.execute("SELECT facts FROM facts WHERE chunk_id = ?", (chunk_id,)).fetchone()
+        return json.loads(row[0]) if row else None
+
+    def flag_outdated(self, chunk_ids: Optional[Sequence[str]] = None, today: Optional[date] = None,
+                      fact_max_age_days: int = DEFAULT_FACT_MAX_AGE_DAYS,
+                      relative_max_age_days: int = DEFAULT_RELATIVE_MAX_AGE_DAYS) -> Dict[str, List[str]]:
+        """
+        查询可能过期的切片
+
+        Args:
+            chunk_ids: 只在这些切片中查找，默认为索引中的全部切片
+            today: 判定日期，默认为今天
+
+        Returns:
+            切片ID -> 标记原因
+        """
+        today = today or date.today()
+        with self._lock:
+            rows = self._conn.execute("SELECT chunk_id, last_updated, facts FROM facts").fetchall()
+        wanted = set(chunk_ids) if chunk_ids is not None else None
+        flagged = {}
+        for chunk_id, last_updated, facts in rows:
+            if wanted is not None and chunk_id not in wanted:
+                continue
+            reasons = outdated_reasons(json.loads(facts), parse_date(last_updated), today,
+                                       fact_max_age_days, relative_max_age_days)
+            if reasons:
+                flagged[chunk_id] = reasons
+        return flagged
+
+    def get_reviews(self, chunk_ids: Sequence[str], recheck_days: int = DEFAULT_RECHECK_DAYS) -> Dict[str, List[Dict]]:
+        """返回仍在有效期内的LLM复核结论：切片ID -> 该切片的过期条目（空列表表示复核后未过期）"""
+        min_reviewed = time.time() - recheck_days * 86400
+        reviews = {}
+        with self._lock:
+            for chunk_id in chunk_ids:
+                row = self._conn.execute(
+                    "SELECT review FROM facts WHERE chunk_id = ? AND review IS NOT NULL AND reviewed_at >= ?",
+                    (chunk_id, min_reviewed)).fetchone()
+                if row:
+                    reviews[chunk_id] = json.loads(row[0])
+        return reviews
+
+    def put_reviews(self, reviews: Dict[str, List[Dict]]) -> None:
+        """保存LLM复核结论，切片内容或更新时间变化时会在 update 中被清除"""
+        now = time.time()
+        with self._lock:
+            self._conn.executemany("UPDATE facts SET review = ?, reviewed_at = ? WHERE chunk_id = ?",
+                                   [(json.dumps(items, ensure_ascii=False), now, chunk_id)
+                                    for chunk_id, items in reviews.items()])
+            self._conn.commit()
+
+    def close(self) -> None:
+        self._conn.close()
@@ -0,0 +1,216 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+混合检索模块
+把稠密向量检索（FAISS）与 BM25 词法检索作为并行的检索阶段，同一查询同时提交给各阶段，
+结果按文本块ID对齐后用倒数排名融合（RRF）或归一化加权得分融合。
+词法检索能召回产品编号、保单号这类向量模型难以区分的精确字符串，且不增加一次串行往返。
+"""
+
+import time
+from concurrent.futures import ThreadPoolExecutor, TimeoutError as FutureTimeoutError
+from dataclasses import dataclass, field
+from typing import Callable, Dict, List, Optional, Sequence, Tuple
+
+from services.bm25_index import BM25Index
+from services.vector_index import langchain_metric, similarity_from_distance
+
+# 检索阶段：输入 (查询, 候选数)，返回按相关度降序的 (文本块ID, 得分)
+Stage = Callable[[str, int], List[Tuple[str, float]]]
+
+# RRF 常数，取论文中的经验值60
+DEFAULT_RRF_K = 60
+DEFAULT_CANDIDATES = 20
+
+
+def reciprocal_rank_fusion(rankings: Dict[str, Sequence[Tuple[str, float]]], rrf_k: int = DEFAULT_RRF_K,
+                           weights: Optional[Dict[str, float]] = None) -> List[Tuple[str, float]]:
+    """
+    倒数排名融合：每个阶段中排名为r（从1开始）的文本块得到 weight / (rrf_k + r) 分，各阶段累加
+
+    Args:
+        rankings: 阶段名 -> 按相关度降序的 (文本块ID, 得分)
+        rrf_k: RRF常数，越大则排名靠后的结果影响越大
+        weights: 阶段名 -> 权重，默认均为1
+
+    Returns:
+        按融合得分降序的 (文本块ID, 融合得分)
+    """
+    fused: Dict[str, float] = {}
+    for name, ranking in rankings.items():
+        weight = (weights or {}).get(name, 1.0)
+        for rank, (chunk_id, _) in enumerate(ranking, start=1):
+            fused[chunk_id] = fused.get(chunk_id, 0.0) + weight / (rrf_k + rank)
+    return sorted(fused.items(), key=lambda item: item[1], reverse=True)
+
+
+def weighted_score_fusion(rankings: Dict[str, Sequence[Tuple[str, float]]],
+                          weights: Optional[Dict[str, float]] = None) -> List[Tuple[str, float]]:
+    """
+    加权得分融合：各阶段得分先做 min-max 归一化到[0, 1]，再按权重累加
+
+    Args:
+        rankings: 阶段名 -> (文本块ID, 得分)，得分越大越相关
+        weights: 阶段名 -> 权重，默认均为1
+
+    Returns:
+        按融合得分降序的 (文本块ID, 融合得分)
+    """
+    fused: Dict[str, float] = {}
+    for name, ranking in rankings.items():
+        if not ranking:
+            continue
+        weight = (weights or {}).get(name, 1.0)
+        scores = [score for _, score in ranking]
+        low, high = min(scores), max(scores)
+        for chunk_id, score in ranking:
+            normalized = (score - low) / (high - low) if high > low else 1.0
+            fused[chunk_id] = fused.get(chunk_id, 0.0) + weight * normalized
+    return sorted(fused.items(), key=lambda item: item[1], reverse=True)
+
+
+def vectorstore_stage(vectorstore, id_of: Callable = None) -> Stage:
+    """
+    把LangChain FAISS向量库包装为检索阶段，得分换算为相似度（越大越相关）
+
+    Args:
+        vectorstore: LangChain FAISS向量库
+        id_of: 从Document取文本块ID的函数，默认使用 doc.id
+    """
+    id_of = id_of or (lambda doc: doc.id)
+
+    def search(query: str, k: int) -> List[Tuple[str, float]]:
+        metric = langchain_metric(vectorstore)
+        results = []
+        for doc, score in vectorstore.similarity_search_with_score(query, k=k):
+            # 内积得分本身越大越相关；未归一化的欧氏距离取负值；l2 / cosine 换算为余弦相似度
+            if metric == "ip":
+                similarity = float(score)
+            elif metric == "euclidean":
+                similarity = -float(score)
+            else:
+                similarity = float(similarity_from_distance(score, metric))
+            results.append((id_of(doc), similarity))
+        return results
+
+    return search
+
+
+def bm25_stage(index: BM25Index, ids: Sequence[str], tokenize: Callable[[str], List[str]]) -> Stage:
+    """
+    把BM25索引包装为检索阶段
+
+    Args:
+        index: BM25索引
+        ids: 与索引中文档行号一一对应的文本块ID
+        tokenize: 查询分词函数，须与建索引时的分词方式一致
+    """
+    def search(query: str, k: int) -> List[Tuple[str, float]]:
+        hits = index.top_k([tokenize(query)], k=k)[0]
+        return [(ids[row], score) for row, score in hits]
+
+    return search
+
+
+@dataclass
+class HybridHit:
+    """一条融合后的检索结果"""
+    chunk_id: str
+    score: float
+    # 阶段名 -> 该文本块在此阶段的排名（从1开始）和原始得分，未被该阶段召回时不出现
+    ranks: Dict[str, int] = field(default_factory=dict)
+    stage_scores: Dict[str, float] = field(default_factory=dict)
+
+
+class HybridRetriever:
+    """多个检索阶段并发执行，按文本块ID融合结果"""
+
+    def __init__(self, stages: Dict[str, Stage], candidates: Optional[Dict[str, int]] = None,
+                 timeouts: Optional[Dict[str, float]] = None, fusion: str = "rrf",
+                 weights: Optional[Dict[str, float]] = None, rrf_k: int = DEFAULT_RRF_K):
+        """
+        初始化混合检索器
+
+        Args:
+            stages: 阶段名 -> 检索阶段，如 {"dense": vectorstore_stage(kb), "bm25": bm25_stage(...)}
+            candidates: 阶段名 -> 该阶段召回的候选数，默认20
+            timeouts: 阶段名 -> 等待该阶段的最长秒数，超时的阶段本次不参与融合
+            fusion: rrf（倒数排名融合）或 weighted（归一化加权得分）
+            weights: 阶段名 -> 融合权重
+            rrf_k: RRF常数
+        """
+        if fusion not in ("rrf", "weighted"):
+            raise ValueError(f"不支持的融合方式: {fusion}")
+        self.stages = stages
+        self.candidates = candidates or {}
+        self.timeouts = timeouts or {}
+        self.fusion = fusion
+        self.weights = weights
+        self.rrf_k = rrf_k
+        # 最近一次检索的统计：各阶段耗时、候选数、是否超时
+        self.last_stats: Dict[str, Dict] = {}
+        self._executor = ThreadPoolExecutor(max_workers=max(1, len(stages)) * 2)
+
+    def close(self) -> None:
+        self._executor.shutdown(wait=False)
+
+    def _run_stage(self, name: str, query: str) -> Tuple[List[Tuple[str, float]], float]:
+        start = time.perf_counter()
+        results = self.stages[name](query, self.candidates.get(name, DEFAULT_CANDIDATES))
+        return results, time.perf_counter() - start
+
+    def retrieve(self, query: str, k: int = 3) -> List[HybridHit]:
+        """
+        并发执行全部阶段并融合
+
+        Args:
+            query: 查询
+            k: 返回的结果数
+
+        Returns:
+            按融合得分降序的检索结果
+        """
+        start = time.perf_counter()
+        futures = {name: self._executor.submit(self._run_stage, name, query) for name in self.stages}
+
+        rankings: Dict[str, List[Tuple[str, float]]] = {}
+        stats: Dict[str, Dict] = {}
+        for name, future in futures.items():
+            # 各阶段同时开始，超时从本次检索开始计时；未设置超时的阶段一直等待
+            stage_timeout = self.timeouts.get(name)
+            remaining = None
+            if stage_timeout is not None:
+                remaining = max(0.0, stage_timeout - (time.perf_counter() - start))
+            try:
+                results, latency = future.result(timeout=remaining)
+            except FutureTimeoutError:
+                stats[name] = {"latency": time.perf_counter() - start, "candidates": 0, "timed_out": True}
+                print(f"警告: 检索阶段 {name} 超过 {stage_timeout:.3f} 秒未返回，本次不参与融合")
+                continue
+            except Exception as e:
+                # 单个阶段失败时仍用其余阶段的结果
+                print(f"检索阶段 {name} 失败: {e}")
+                stats[name] = {"latency": time.perf_counter() - start, "candidates": 0, "error": str(e)}
+                continue
+            stats[name] = {"latency": latency, "candidates": len(results), "timed_out": False}
+            rankings[name] = results
+
+        if self.fusion == "rrf":
+            fused = reciprocal_rank_fusion(rankings, rrf_k=self.rrf_k, weights=self.weights)
+        else:
+            fused = weighted_score_fusion(rankings, weights=self.weights)
+
+        hits = []
+        for chunk_id, score in fused[:k]:
+            hit = HybridHit(chunk_id=chunk_id, score=score)
+            for name, ranking in rankings.items():
+                for rank, (stage_id, stage_score) in enumerate(ranking, start=1):
+                    if stage_id == chunk_id:
+                        hit.ranks[name] = rank
+                        hit.stage_scores[name] = stage_score
+                        break
+            hits.append(hit)
+
+        stats["total"] = {"latency": time.perf_counter() - start, "candidates": len(fused)}
+        self.last_stats = stats
+        return hits
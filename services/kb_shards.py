@@ -0,0 +1,56 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+知识库分片模块
+按token预算把知识库切成若干分片，每个分片连同提示词都能放进一次LLM调用的上下文窗口，
+用于对大型知识库做分片并发的健康度检查等整库分析。
+"""
+
+import math
+import re
+from typing import Callable, List, Sequence
+
+# 单个分片中知识内容的默认token预算（不含指令和测试查询）
+DEFAULT_SHARD_TOKENS = 6000
+
+_CJK_PATTERN = re.compile(r"[\u3000-\u303f\u3400-\u9fff\uf900-\ufaff\uff00-\uffef]")
+
+
+def estimate_tokens(text: str) -> int:
+    """
+    粗略估计文本的token数：中日韩字符和全角标点每个按1个token，其余字符按每4个1个token
+
+    与通义千问等模型分词器的实际结果相比偏保守，用于分片时留出余量
+    """
+    if not text:
+        return 0
+    cjk = len(_CJK_PATTERN.findall(text))
+    return cjk + math.ceil((len(text) - cjk) / 4)
+
+
+def shard_by_token_budget(texts: Sequence[str], budget: int = DEFAULT_SHARD_TOKENS,
+                          estimate: Callable[[str], int] = estimate_tokens) -> List[List[int]]:
+    """
+    按原顺序把文本切成token数不超过预算的分片
+
+    Args:
+        texts: 文本列表（通常是每个知识切片在提示词中的一行）
+        budget: 每个分片的token预算
+        estimate: token数估计函数，可替换为模型分词器
+
+    Returns:
+        分片列表，每个分片是文本下标列表；单条超过预算的文本单独成一个分片
+    """
+    shards: List[List[int]] = []
+    current: List[int] = []
+    used = 0
+    for i, text in enumerate(texts):
+        tokens = estimate(text) + 1  # 加上换行符
+        if current and used + tokens > budget:
+            shards.append(current)
+            current, used = [], 0
+        current.append(i)
+        used += tokens
+    if current:
+        shards.append(current)
+    return shards
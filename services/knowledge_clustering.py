@@ -0,0 +1,93 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+近似重复聚类模块
+把知识点向量放进FAISS索引，每条只检索k个近邻，相似度超过阈值的近邻用并查集合并成簇。
+合并时按相似度从高到低进行，并限制簇的大小，保证交给LLM合并的每一组都不会超出上下文长度；
+只有一条的簇（单例）不需要调用LLM。
+"""
+
+from typing import List, Optional
+
+import numpy as np
+
+from services.vector_index import build_index, normalize_vectors, search
+
+DEFAULT_SIMILARITY_THRESHOLD = 0.85
+DEFAULT_NEIGHBORS = 10
+DEFAULT_MAX_CLUSTER_SIZE = 20
+# 超过该数量时改用HNSW近似检索，避免 N^2 的暴力相似度计算
+ANN_MIN_VECTORS = 10_000
+
+
+class UnionFind:
+    """带路径压缩和按大小合并的并查集"""
+
+    def __init__(self, size: int):
+        self.parent = list(range(size))
+        self.size = [1] * size
+
+    def find(self, x: int) -> int:
+        root = x
+        while self.parent[root] != root:
+            root = self.parent[root]
+        while self.parent[x] != root:
+            self.parent[x], x = root, self.parent[x]
+        return root
+
+    def union(self, a: int, b: int, max_size: Optional[int] = None) -> bool:
+        """合并a、b所在的集合；合并后超过max_size时不合并，返回是否合并"""
+        root_a, root_b = self.find(a), self.find(b)
+        if root_a == root_b:
+            return False
+        if max_size is not None and self.size[root_a] + self.size[root_b] > max_size:
+            return False
+        if self.size[root_a] < self.size[root_b]:
+            root_a, root_b = root_b, root_a
+        self.parent[root_b] = root_a
+        self.size[root_a] += self.size[root_b]
+        return True
+
+    def groups(self) -> List[List[int]]:
+        """按每组最小下标排序的分组，组内下标升序"""
+        groups = {}
+        for x in range(len(self.parent)):
+            groups.setdefault(self.find(x), []).append(x)
+        return sorted(groups.values(), key=lambda group: group[0])
+
+
+def cluster_by_similarity(vectors, threshold: float = DEFAULT_SIMILARITY_THRESHOLD,
+                          k: int = DEFAULT_NEIGHBORS, max_cluster_size: Optional[int] = DEFAULT_MAX_CLUSTER_SIZE,
+                          index_type: Optional[str] = None) -> List[List[int]]:
+    """
+    按余弦相似度聚类近似重复的向量
+
+    Args:
+        vectors: 形如 (N, D) 的向量
+        threshold: 余弦相似度不低于该值的近邻视为近似重复
+        k: 每个向量检索的近邻数（含自身）
+        max_cluster_size: 单个簇的最大条数，为None时不限制
+        index_type: FAISS索引类型，默认数据量小时用flat、大时用hnsw
+
+    Returns:
+        簇列表，每个簇是向量下标列表
+    """
+    vectors = normalize_vectors(vectors) if len(vectors) else np.zeros((0, 1), dtype=np.float32)
+    num_vectors = len(vectors)
+    if num_vectors <= 1:
+        return [[i] for i in range(num_vectors)]
+
+    index_type = index_type or ("hnsw" if num_vectors >= ANN_MIN_VECTORS else "flat")
+    index = build_index(vectors, index_type=index_type, metric="ip")
+    similarities, neighbors = search(index, vectors, min(k, num_vectors))
+
+    # 只保留超过阈值的边，按相似度从高到低合并，受大小限制时优先保留最相似的一对
+    rows, cols = np.nonzero((similarities >= threshold) & (neighbors >= 0))
+    edges = [(float(similarities[r, c]), r, int(neighbors[r, c])) for r, c in zip(rows, cols)
+             if int(neighbors[r, c]) != r]
+    edges.sort(key=lambda edge: -edge[0])
+
+    union_find = UnionFind(num_vectors)
+    for _, a, b in edges:
+        union_find.union(a, b, max_size=max_cluster_size)
+    return union_find.groups()
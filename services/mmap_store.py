@@ -0,0 +1,256 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+内存映射知识库存储模块
+不使用pickle保存LangChain FAISS知识库：向量索引用faiss原生格式，文本块内容、
+docstore ID 和元数据按列写入二进制文件。加载时索引与各列都通过mmap读取，
+同一台机器上的多个查询进程共享操作系统的页缓存，启动时无需反序列化docstore。
+每次保存都写入一个新的子目录，全部文件写完后才原子替换 CURRENT 指针文件，
+保存中途失败时旧数据保持完整可用，正在读取旧数据的进程也不受影响。
+"""
+
+import json
+import os
+import shutil
+import time
+from collections.abc import Mapping
+from typing import Any, Dict, Iterator, List, Union
+
+import faiss
+import numpy as np
+from langchain_community.docstore.base import Docstore
+from langchain_community.docstore.in_memory import InMemoryDocstore
+from langchain_community.vectorstores import FAISS
+from langchain_community.vectorstores.utils import DistanceStrategy
+from langchain_core.documents import Document
+from langchain_core.embeddings import Embeddings
+
+FORMAT_FILE = "kb_format.json"
+INDEX_FILE = "index.faiss"
+EXTRA_METADATA_FILE = "extra_metadata.json"
+FORMAT_VERSION = 1
+# 指向当前生效的数据子目录
+CURRENT_FILE = "CURRENT"
+GENERATION_PREFIX = "kb-"
+
+
+def _replace_file(path: str, write) -> None:
+    """
+    先写临时文件再原子替换：其他进程已映射的旧文件保持不变，
+    直接覆盖正在被mmap的文件可能导致这些进程读到截断的数据而崩溃
+    """
+    tmp_path = path + ".tmp"
+    with open(tmp_path, "wb") as f:
+        write(f)
+    os.replace(tmp_path, path)
+
+
+def _save_array(path: str, array: np.ndarray) -> None:
+    _replace_file(path, lambda f: np.save(f, array))
+
+
+def _write_strings(directory: str, name: str, values: List[str]) -> None:
+    """把字符串列写成 <name>.bin（UTF-8拼接）和 <name>.offsets.npy（n+1个字节偏移量）"""
+    encoded = [value.encode("utf-8") for value in values]
+    offsets = np.zeros(len(encoded) + 1, dtype=np.int64)
+    np.cumsum([len(b) for b in encoded], out=offsets[1:])
+    _replace_file(os.path.join(directory, f"{name}.bin"), lambda f: f.writelines(encoded))
+    _save_array(os.path.join(directory, f"{name}.offsets.npy"), offsets)
+
+
+class _StringColumn:
+    """通过mmap按行读取的字符串列"""
+
+    def __init__(self, directory: str, name: str):
+        self._offsets = np.load(os.path.join(directory, f"{name}.offsets.npy"), mmap_mode="r")
+        path = os.path.join(directory, f"{name}.bin")
+        # 长度为0的文件无法映射
+        if os.path.getsize(path):
+            self._data = np.memmap(path, dtype=np.uint8, mode="r")
+        else:
+            self._data = np.zeros(0, dtype=np.uint8)
+
+    def __len__(self) -> int:
+        return len(self._offsets) - 1
+
+    def __getitem__(self, row: int) -> str:
+        start, end = self._offsets[row], self._offsets[row + 1]
+        return self._data[start:end].tobytes().decode("utf-8")
+
+
+class _RowIndex(Mapping):
+    """FAISS行号 -> docstore键 的恒等映射，加载时无需构造字典"""
+
+    def __init__(self, count: int):
+        self._count = count
+
+    def __getitem__(self, i: int) -> int:
+        i = int(i)
+        if 0 <= i < self._count:
+            return i
+        raise KeyError(i)
+
+    def __len__(self) -> int:
+        return self._count
+
+    def __iter__(self) -> Iterator[int]:
+        return iter(range(self._count))
+
+
+class MmapDocstore(Docstore):
+    """只读docstore：以FAISS行号为键，文本和元数据按需从内存映射文件读取"""
+
+    def __init__(self, directory: str, int_columns: List[str]):
+        self.texts = _StringColumn(directory, "texts")
+        self.ids = _StringColumn(directory, "ids")
+        self.int_columns = {
+            name: np.load(os.path.join(directory, f"{name}.npy"), mmap_mode="r") for name in int_columns
+        }
+        extra_path = os.path.join(directory, EXTRA_METADATA_FILE)
+        self.extra: Dict[str, Dict[str, Any]] = {}
+        if os.path.exists(extra_path):
+            with open(extra_path, "r", encoding="utf-8") as f:
+                self.extra = json.load(f)
+
+    def __len__(self) -> int:
+        return len(self.texts)
+
+    def metadata(self, row: int) -> Dict[str, Any]:
+        """读取一行的元数据"""
+        metadata = {name: int(column[row]) for name, column in self.int_columns.items()}
+        for name, values in self.extra.items():
+            if str(row) in values:
+                metadata[name] = values[str(row)]
+        return metadata
+
+    def search(self, search: Union[int, str]) -> Union[str, Document]:
+        try:
+            row = int(search)
+        except (TypeError, ValueError):
+            return f"ID {search} not found."
+        if not 0 <= row < len(self.texts):
+            return f"ID {search} not found."
+        return Document(id=self.ids[row], page_content=self.texts[row], metadata=self.metadata(row))
+
+
+def _data_directory(directory: str) -> str:
+    """返回当前生效的数据子目录；早期版本直接把文件写在目录下，没有 CURRENT 时按该布局读取"""
+    current_path = os.path.join(directory, CURRENT_FILE)
+    if not os.path.exists(current_path):
+        return directory
+    with open(current_path, "r", encoding="utf-8") as f:
+        return os.path.join(directory, f.read().strip())
+
+
+def is_mmap_knowledge_base(directory: str) -> bool:
+    """判断目录中是否为本模块保存的知识库"""
+    return os.path.exists(os.path.join(_data_directory(directory), FORMAT_FILE))
+
+
+def save_knowledge_base(vectorstore: FAISS, directory: str) -> None:
+    """
+    以零pickle的列式格式保存LangChain FAISS知识库
+
+    取值全部为整数、且每个文本块都有的元数据字段（如page、start_index）保存为
+    <字段名>.npy，其余元数据稀疏保存在 extra_metadata.json 中。
+
+    Args:
+        vectorstore: 要保存的知识库
+        directory: 保存目录，数据写在其下的 kb-<时间戳> 子目录中，由 CURRENT 文件指向当前版本
+    """
+    # 先完整写入一个新的子目录，此时它还没有被 CURRENT 引用，读取方看不到写了一半的数据
+    generation = f"{GENERATION_PREFIX}{time.time_ns()}"
+    data_dir = os.path.join(directory, generation)
+    os.makedirs(data_dir)
+    count = vectorstore.index.ntotal
+    doc_ids = [vectorstore.index_to_docstore_id[i] for i in range(count)]
+    documents = [vectorstore.docstore.search(doc_id) for doc_id in doc_ids]
+
+    keys = list(dict.fromkeys(key for doc in documents for key in doc.metadata))
+    int_columns = [
+        key for key in keys
+        if all(type(doc.metadata.get(key)) is int for doc in documents)
+    ]
+    extra = {}
+    for key in keys:
+        if key in int_columns:
+            continue
+        extra[key] = {str(row): doc.metadata[key] for row, doc in enumerate(documents) if key in doc.metadata}
+
+    faiss.write_index(vectorstore.index, os.path.join(data_dir, INDEX_FILE))
+    _write_strings(data_dir, "texts", [doc.page_content for doc in documents])
+    _write_strings(data_dir, "ids", [str(doc_id) for doc_id in doc_ids])
+    for key in int_columns:
+        _save_array(os.path.join(data_dir, f"{key}.npy"),
+                    np.array([doc.metadata[key] for doc in documents], dtype=np.int64))
+    _replace_file(os.path.join(data_dir, EXTRA_METADATA_FILE),
+                  lambda f: f.write(json.dumps(extra, ensure_ascii=False).encode("utf-8")))
+
+    distance_strategy = vectorstore.distance_strategy
+    fmt = {
+        "version": FORMAT_VERSION,
+        "count": count,
+        "int_columns": int_columns,
+        "distance_strategy": getattr(distance_strategy, "value", distance_strategy),
+        "normalize_L2": vectorstore._normalize_L2,
+    }
+    _replace_file(os.path.join(data_dir, FORMAT_FILE),
+                  lambda f: f.write(json.dumps(fmt, ensure_ascii=False, indent=2).encode("utf-8")))
+
+    # 所有文件写完后原子切换 CURRENT，再清理旧的数据子目录（包括之前中途失败留下的）。
+    # 已经mmap旧文件的进程在Linux/macOS上不受删除影响；Windows上文件被占用时删除失败，留待下次保存清理
+    _replace_file(os.path.join(directory, CURRENT_FILE), lambda f: f.write(generation.encode("utf-8")))
+    for name in os.listdir(directory):
+        if name.startswith(GENERATION_PREFIX) and name != generation:
+            shutil.rmtree(os.path.join(directory, name), ignore_errors=True)
+
+
+def _read_index(path: str, mmap: bool) -> faiss.Index:
+    if not mmap:
+        return faiss.read_index(path)
+    # IO_FLAG_MMAP_IFC 让Flat索引的向量数据也走mmap（较新版本faiss才有）
+    flags = faiss.IO_FLAG_MMAP | getattr(faiss, "IO_FLAG_MMAP_IFC", 0)
+    try:
+        return faiss.read_index(path, flags)
+    except RuntimeError as e:
+        print(f"警告: 该索引类型不支持mmap读取，改为完整读入内存: {e}")
+        return faiss.read_index(path)
+
+
+def load_knowledge_base(directory: str, embeddings: Embeddings, mmap: bool = True) -> FAISS:
+    """
+    加载 save_knowledge_base 保存的知识库
+
+    Args:
+        directory: 保存目录
+        embeddings: 查询时使用的嵌入模型
+        mmap: True时索引和docstore都通过mmap只读加载，适合查询进程；
+              False时完整读入内存并使用原始ID，可继续add_texts/delete
+
+    Returns:
+        LangChain FAISS知识库对象
+    """
+    directory = _data_directory(directory)
+    with open(os.path.join(directory, FORMAT_FILE), "r", encoding="utf-8") as f:
+        fmt = json.load(f)
+    if fmt.get("version") != FORMAT_VERSION:
+        raise ValueError(f"不支持的知识库格式版本: {fmt.get('version')}")
+
+    index = _read_index(os.path.join(directory, INDEX_FILE), mmap)
+    mmap_docstore = MmapDocstore(directory, fmt["int_columns"])
+    if mmap:
+        docstore = mmap_docstore
+        index_to_docstore_id = _RowIndex(fmt["count"])
+    else:
+        documents = [mmap_docstore.search(row) for row in range(fmt["count"])]
+        docstore = InMemoryDocstore({doc.id: doc for doc in documents})
+        index_to_docstore_id = {row: doc.id for row, doc in enumerate(documents)}
+
+    return FAISS(
+        embeddings,
+        index,
+        docstore,
+        index_to_docstore_id,
+        normalize_L2=fmt.get("normalize_L2", False),
+        distance_strategy=DistanceStrategy(fmt.get("distance_strategy", DistanceStrategy.EUCLIDEAN_DISTANCE.value)),
+    )
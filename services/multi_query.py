@@ -0,0 +1,148 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+批量多查询检索模块
+用LLM把原始问题改写为多个查询变体（按原始问题缓存），所有变体一次性批量嵌入，
+在FAISS上用一次多行 index.search 检索，再按文本块ID用RRF融合去重。
+相比LangChain的MultiQueryRetriever逐个变体串行检索，只需一次嵌入往返和一次索引检索。
+"""
+
+import hashlib
+import json
+import os
+import re
+import threading
+from typing import Dict, List, Optional, Tuple
+
+import numpy as np
+from langchain_core.documents import Document
+
+from services.hybrid_retrieval import DEFAULT_RRF_K, reciprocal_rank_fusion
+
+DEFAULT_NUM_VARIANTS = 3
+
+MULTI_QUERY_PROMPT = """你是一个AI语言模型助手。你的任务是为给定的用户问题生成{num_variants}个不同版本的问题，
+用于从向量数据库中检索相关文档。通过从多个角度改写用户问题，帮助用户克服基于距离的相似度检索的局限。
+请只输出改写后的问题，每行一个，不要编号，不要输出其他内容。
+原始问题: {question}"""
+
+
+def normalize_query(query: str) -> str:
+    """归一化查询作为缓存键：去除首尾空白并合并连续空白"""
+    return re.sub(r"\s+", " ", query.strip())
+
+
+def _parse_variants(text: str) -> List[str]:
+    variants = []
+    for line in text.splitlines():
+        # 去掉模型可能输出的编号和项目符号
+        line = re.sub(r"^\s*(?:\d+[.、)）]|[-*•])\s*", "", line).strip()
+        if line:
+            variants.append(line)
+    return variants
+
+
+class BatchMultiQueryRetriever:
+    """多查询变体批量嵌入、单次FAISS多行检索、按文本块ID做RRF融合的检索器"""
+
+    def __init__(self, vectorstore, llm, k: int = 4, top_n: Optional[int] = None,
+                 num_variants: int = DEFAULT_NUM_VARIANTS, include_original: bool = True, rrf_k: int = DEFAULT_RRF_K,
+                 cache_path: Optional[str] = None, prompt: str = MULTI_QUERY_PROMPT):
+        """
+        初始化检索器
+
+        Args:
+            vectorstore: LangChain FAISS向量库
+            llm: 生成查询变体的大语言模型
+            k: 每个查询变体检索的文档数
+            top_n: 融合后返回的文档数，默认返回全部去重后的文档（与MultiQueryRetriever一致）
+            num_variants: 生成的查询变体数
+            include_original: 是否把原始问题也作为一个查询参与检索
+            rrf_k: RRF常数
+            cache_path: 查询变体缓存的JSON文件路径，为None时只缓存在内存中
+            prompt: 生成变体的提示词模板，包含 {num_variants} 和 {question}
+        """
+        self.vectorstore = vectorstore
+        self.llm = llm
+        self.k = k
+        self.top_n = top_n
+        self.num_variants = num_variants
+        self.include_original = include_original
+        self.rrf_k = rrf_k
+        self.cache_path = cache_path
+        self.prompt = prompt
+        self._lock = threading.Lock()
+        self._variant_cache: Dict[str, List[str]] = {}
+        if cache_path and os.path.exists(cache_path):
+            with open(cache_path, "r", encoding="utf-8") as f:
+                self._variant_cache = json.load(f)
+
+    def _cache_key(self, query: str) -> str:
+        raw = f"{self.num_variants}\n{self.prompt}\n{normalize_query(query)}"
+        return hashlib.sha256(raw.encode("utf-8")).hexdigest()
+
+    def generate_queries(self, query: str) -> List[str]:
+        """
+        生成查询变体，同一原始问题只调用一次LLM
+
+        Returns:
+            查询变体列表（include_original时第一个为原始问题）
+        """
+        key = self._cache_key(query)
+        with self._lock:
+            variants = self._variant_cache.get(key)
+        if variants is None:
+            response = self.llm.invoke(self.prompt.format(num_variants=self.num_variants, question=query))
+            # 兼容返回字符串的LLM和返回消息对象的聊天模型
+            text = getattr(response, "content", response)
+            variants = _parse_variants(text)[:self.num_variants]
+            with self._lock:
+                self._variant_cache[key] = variants
+                if self.cache_path:
+                    os.makedirs(os.path.dirname(os.path.abspath(self.cache_path)), exist_ok=True)
+                    with open(self.cache_path, "w", encoding="utf-8") as f:
+                        json.dump(self._variant_cache, f, ensure_ascii=False)
+
+        queries = [query] + variants if self.include_original else list(variants)
+        # 去掉与其他变体完全相同的查询
+        return list(dict.fromkeys(queries)) or [query]
+
+    def _embed_queries(self, queries: List[str]) -> np.ndarray:
+        embeddings = self.vectorstore.embedding_function
+        if hasattr(embeddings, "embed_queries"):
+            vectors = embeddings.embed_queries(queries)
+        else:
+            # 没有批量查询接口时用一次文档批量嵌入代替逐条 embed_query
+            vectors = embeddings.embed_documents(queries)
+        vectors = np.asarray(vectors, dtype=np.float32)
+        if getattr(self.vectorstore, "_normalize_L2", False):
+            vectors /= np.maximum(np.linalg.norm(vectors, axis=1, keepdims=True), 1e-12)
+        return vectors
+
+    def retrieve_with_scores(self, query: str, top_n: Optional[int] = None) -> List[Tuple[Document, float]]:
+        """
+        检索并融合
+
+        Args:
+            query: 用户问题
+            top_n: 返回的文档数，默认为初始化时的top_n
+
+        Returns:
+            按RRF得分降序的 (Document, 融合得分)
+        """
+        top_n = top_n or self.top_n
+        queries = self.generate_queries(query)
+        vectors = self._embed_queries(queries)
+        # 所有查询变体一次多行检索
+        _, rows = self.vectorstore.index.search(vectors, self.k)
+
+        rankings = {}
+        for i, variant_rows in enumerate(rows):
+            doc_ids = [self.vectorstore.index_to_docstore_id[int(row)] for row in variant_rows if row >= 0]
+            rankings[f"q{i}"] = [(doc_id, 0.0) for doc_id in doc_ids]
+        fused = reciprocal_rank_fusion(rankings, rrf_k=self.rrf_k)
+        return [(self.vectorstore.docstore.search(doc_id), score) for doc_id, score in fused[:top_n]]
+
+    def invoke(self, query: str) -> List[Document]:
+        """与LangChain检索器相同的调用方式，返回融合去重后的文档列表"""
+        return [doc for doc, _ in self.retrieve_with_scores(query)]
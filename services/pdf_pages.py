@@ -0,0 +1,268 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+PDF 文本提取与页码定位模块
+提取文本时记录每页在全文中的起始字符偏移量，分块时记录每个文本块的起始偏移量，
+文本块的页码通过对偏移量二分查找得到，作为文本块的元数据保存。
+传入PDF路径时按页区间分发到多个进程并行提取，并可按页码顺序流式输出。
+"""
+
+import math
+import os
+import pickle
+from bisect import bisect_right
+from concurrent.futures import ProcessPoolExecutor
+from typing import Dict, Iterable, Iterator, List, Optional, Tuple
+
+from PyPDF2 import PdfReader
+from langchain.text_splitter import RecursiveCharacterTextSplitter
+
+DEFAULT_SEPARATORS = ["\n\n", "\n", ".", " ", ""]
+# 每个进程分到的任务数，任务越多负载越均衡，但每个任务都要重新打开一次PDF
+TASKS_PER_WORKER = 4
+
+
+class PageOffsetIndex:
+    """字符偏移量 -> 页码 的有序索引"""
+
+    def __init__(self):
+        self.starts: List[int] = []
+        self.pages: List[int] = []
+
+    def __len__(self) -> int:
+        return len(self.pages)
+
+    def add_page(self, start: int, page_number: int) -> None:
+        """
+        记录一页文本在全文中的起始偏移量，必须按偏移量递增的顺序添加
+
+        Args:
+            start: 该页第一个字符在全文中的偏移量
+            page_number: 页码（从1开始）
+        """
+        if self.starts and start < self.starts[-1]:
+            raise ValueError("页面必须按偏移量递增的顺序添加")
+        self.starts.append(start)
+        self.pages.append(page_number)
+
+    def page_at(self, offset: int) -> int:
+        """
+        返回偏移量所在的页码，偏移量无效时返回-1
+
+        Args:
+            offset: 全文中的字符偏移量
+        """
+        if offset < 0:
+            return -1
+        i = bisect_right(self.starts, offset) - 1
+        return self.pages[i] if i >= 0 else -1
+
+
+def _extract_page_range(pdf_path: str, start: int, end: int) -> List[Tuple[int, str]]:
+    """在子进程中打开PDF并提取 [start, end) 范围内各页的文本"""
+    reader = PdfReader(pdf_path)
+    return [(i + 1, reader.pages[i].extract_text() or "") for i in range(start, end)]
+
+
+def iter_pdf_pages(pdf_path: str, max_workers: Optional[int] = None) -> Iterator[Tuple[int, str]]:
+    """
+    多进程提取PDF各页文本，按页码顺序逐页产出
+
+    前面的页提取完成即可产出，后面的页仍在其他进程中提取，
+    调用方可以边读边分块、嵌入。由于使用子进程，调用脚本需要有
+    if __name__ == "__main__" 保护。
+
+    Args:
+        pdf_path: PDF文件路径
+        max_workers: 进程数，默认为CPU核数；为1时在当前进程中逐页提取
+
+    Yields:
+        (页码, 文本)，页码从1开始，没有文本的页返回空字符串
+    """
+    num_pages = len(PdfReader(pdf_path).pages)
+    max_workers = min(max_workers or os.cpu_count() or 1, num_pages)
+    if max_workers <= 1:
+        yield from _extract_page_range(pdf_path, 0, num_pages)
+        return
+
+    pages_per_task = max(1, math.ceil(num_pages / (max_workers * TASKS_PER_WORKER)))
+    executor = ProcessPoolExecutor(max_workers=max_workers)
+    try:
+        futures = [
+            executor.submit(_extract_page_range, pdf_path, start, min(start + pages_per_task, num_pages))
+            for start in range(0, num_pages, pages_per_task)
+        ]
+        # 按提交顺序取结果，保证页码有序
+        for future in futures:
+            yield from future.result()
+    finally:
+        # 调用方提前停止迭代时取消尚未开始的任务
+        executor.shutdown(wait=True, cancel_futures=True)
+
+
+def _iter_reader_pages(pdf) -> Iterator[Tuple[int, str]]:
+    for page_number, page in enumerate(pdf.pages, start=1):
+        yield page_number, page.extract_text() or ""
+
+
+def extract_text_with_page_offsets(pdf, max_workers: Optional[int] = None) -> Tuple[str, PageOffsetIndex]:
+    """
+    从PDF中提取文本并记录每页的起始字符偏移量
+
+    Args:
+        pdf: PdfReader对象，或PDF文件路径（传路径时多进程并行提取）
+        max_workers: 传入路径时使用的进程数
+
+    Returns:
+        text: 提取的文本内容
+        page_index: 字符偏移量到页码的索引
+    """
+    if isinstance(pdf, (str, os.PathLike)):
+        pages = iter_pdf_pages(os.fspath(pdf), max_workers=max_workers)
+    else:
+        pages = _iter_reader_pages(pdf)
+
+    parts = []
+    page_index = PageOffsetIndex()
+    offset = 0
+
+    for page_number, extracted_text in pages:
+        if extracted_text:
+            page_index.add_page(offset, page_number)
+            parts.append(extracted_text)
+            offset += len(extracted_text)
+        else:
+            print(f"No text found on page {page_number}.")
+
+    # 一次性拼接，避免逐页 += 带来的重复拷贝
+    return "".join(parts), page_index
+
+
+def _make_splitter(chunk_size: int, chunk_overlap: int,
+                   separators: Optional[List[str]]) -> RecursiveCharacterTextSplitter:
+    # add_start_index=True 时分割器会从上一块附近向后查找当前块的位置，整体为线性复杂度
+    return RecursiveCharacterTextSplitter(
+        separators=separators or DEFAULT_SEPARATORS,
+        chunk_size=chunk_size,
+        chunk_overlap=chunk_overlap,
+        length_function=len,
+        add_start_index=True,
+    )
+
+
+def split_text_with_pages(text: str, page_index: PageOffsetIndex, chunk_size: int = 1000,
+                          chunk_overlap: int = 200,
+                          separators: Optional[List[str]] = None) -> Tuple[List[str], List[Dict[str, int]]]:
+    """
+    分割文本，并为每个文本块生成包含页码和起始偏移量的元数据
+
+    Args:
+        text: 提取的文本内容
+        page_index: 字符偏移量到页码的索引
+        chunk_size: 文本块大小
+        chunk_overlap: 相邻文本块的重叠长度
+        separators: 分隔符列表
+
+    Returns:
+        chunks: 文本块列表
+        metadatas: 与chunks一一对应的元数据，形如 {"page": 3, "start_index": 1024}
+    """
+    documents = _make_splitter(chunk_size, chunk_overlap, separators).create_documents([text])
+
+    chunks = []
+    metadatas = []
+    for document in documents:
+        start_index = document.metadata.get("start_index", -1)
+        chunks.append(document.page_content)
+        metadatas.append({"page": page_index.page_at(start_index), "start_index": start_index})
+    return chunks, metadatas
+
+
+def iter_chunks_with_pages(pages: Iterable[Tuple[int, str]], chunk_size: int = 1000, chunk_overlap: int = 200,
+                           separators: Optional[List[str]] = None,
+                           flush_size: Optional[int] = None) -> Iterator[Tuple[str, Dict[str, int]]]:
+    """
+    流式分块：边读入页面文本边产出文本块，不需要等整份PDF提取完成
+
+    缓冲区超过 flush_size 时对其分块，只产出离缓冲区末尾足够远、
+    不会因后续文本而改变的块，其余部分留待下一页到来后继续分块。
+
+    Args:
+        pages: (页码, 文本) 序列，如 iter_pdf_pages 的输出
+        chunk_size: 文本块大小
+        chunk_overlap: 相邻文本块的重叠长度
+        separators: 分隔符列表
+        flush_size: 缓冲区分块阈值，默认为 chunk_size 的8倍
+
+    Yields:
+        (文本块, 元数据)，元数据形如 {"page": 3, "start_index": 1024}，start_index为全文偏移量
+    """
+    text_splitter = _make_splitter(chunk_size, chunk_overlap, separators)
+    flush_size = flush_size or chunk_size * 8
+    page_index = PageOffsetIndex()
+    parts: List[str] = []
+    buffered = 0
+    base = 0  # 缓冲区首字符在全文中的偏移量
+
+    def split_buffer(final: bool):
+        nonlocal parts, buffered, base
+        buffer = "".join(parts)
+        # 末尾 chunk_size 以内结束的块可能还会与下一页的文本合并，暂不产出
+        safe_end = len(buffer) if final else len(buffer) - chunk_size
+        keep_from = len(buffer)
+        for document in text_splitter.create_documents([buffer]):
+            start = document.metadata.get("start_index", -1)
+            if not final and start >= 0 and start + len(document.page_content) > safe_end:
+                keep_from = start
+                break
+            offset = base + start if start >= 0 else -1
+            yield document.page_content, {"page": page_index.page_at(offset), "start_index": offset}
+        parts = [buffer[keep_from:]] if keep_from < len(buffer) else []
+        buffered = len(buffer) - keep_from
+        base += keep_from
+
+    for page_number, page_text in pages:
+        if not page_text:
+            continue
+        page_index.add_page(base + buffered, page_number)
+        parts.append(page_text)
+        buffered += len(page_text)
+        if buffered >= flush_size:
+            yield from split_buffer(final=False)
+
+    if buffered:
+        yield from split_buffer(final=True)
+
+
+LEGACY_PAGE_INFO_FILE = "page_info.pkl"
+
+
+def backfill_legacy_pages(vectorstore, directory: str) -> int:
+    """
+    为旧版向量数据库补齐页码元数据
+
+    旧版本把 文本块 -> 页码 的映射单独保存在 page_info.pkl 中，docstore 里的文档没有 page 元数据；
+    加载后按文本内容补齐，之后统一从 doc.metadata["page"] 读取页码。
+
+    Args:
+        vectorstore: 已加载的 LangChain FAISS 向量存储
+        directory: 向量数据库目录
+
+    Returns:
+        补齐页码的文档数，没有旧版页码文件时为0
+    """
+    path = os.path.join(directory, LEGACY_PAGE_INFO_FILE)
+    if not os.path.exists(path):
+        return 0
+    with open(path, "rb") as f:
+        page_info = pickle.load(f)
+    filled = 0
+    for doc_id in vectorstore.index_to_docstore_id.values():
+        doc = vectorstore.docstore.search(doc_id)
+        if "page" in doc.metadata:
+            continue
+        page = page_info.get(doc.page_content, page_info.get(doc.page_content.strip()))
+        if page is not None:
+            doc.metadata["page"] = page
+            filled += 1
+    return filled
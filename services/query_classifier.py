@@ -0,0 +1,263 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Query类型规则预分类模块
+用 Aho-Corasick 自动机一次扫描查询，匹配各类型的触发词（"还有"、"哪个"、"它"、"难道"……），
+再结合问句个数等结构特征给出类型和置信度。置信度足够高的查询（尤其是占大多数、无需改写的普通查询）
+直接在本地判定，只有低置信度的查询才交给LLM识别。
+"""
+
+import re
+import time
+from collections import deque
+from dataclasses import dataclass, field
+from typing import Callable, Dict, Iterator, List, Optional, Sequence, Tuple
+
+CONTEXT_DEPENDENT = "上下文依赖型"
+COMPARATIVE = "对比型"
+AMBIGUOUS_REFERENCE = "模糊指代型"
+MULTI_INTENT = "多意图型"
+RHETORICAL = "反问型"
+PLAIN = "普通查询"
+QUERY_TYPES = [CONTEXT_DEPENDENT, COMPARATIVE, AMBIGUOUS_REFERENCE, MULTI_INTENT, RHETORICAL, PLAIN]
+
+# 触发词强度：强触发词单独出现即可判定类型，弱触发词（如"都"、"更"可能出现在"成都"、"更新"中）只作为线索
+STRONG = 1.0
+WEAK = 0.5
+
+DEFAULT_KEYWORDS: Dict[str, Dict[str, float]] = {
+    CONTEXT_DEPENDENT: {"其他": STRONG, "其它": STRONG, "别的": STRONG, "另外": STRONG, "除此之外": STRONG,
+                        "除了": STRONG, "其余": STRONG, "还有哪些": STRONG, "还有什么": STRONG, "还有": WEAK},
+    COMPARATIVE: {"哪个": STRONG, "哪一个": STRONG, "哪家": STRONG, "哪种": STRONG, "比较": STRONG, "对比": STRONG,
+                  "相比": STRONG, "区别": STRONG, "不同": WEAK, "还是": WEAK, "更": WEAK},
+    # 单字代词也常出现在 "吉他"、"他人" 等普通词中，只作为弱线索
+    AMBIGUOUS_REFERENCE: {"它们": STRONG, "他们": STRONG, "她们": STRONG, "它": WEAK, "他": WEAK, "她": WEAK,
+                          "这个": WEAK, "那个": WEAK, "这些": WEAK, "那些": WEAK, "这里": WEAK, "那里": WEAK,
+                          "都": WEAK},
+    RHETORICAL: {"难道": STRONG, "莫非": STRONG, "岂不": STRONG, "怎么可能": STRONG, "凭什么": STRONG,
+                 "不会": WEAK, "不是": WEAK},
+}
+
+# 包含触发词但本身不是触发词的常见词，按最长匹配覆盖其中的 "他" 等单字
+NON_TRIGGER_WORDS = ["吉他", "他人", "他乡", "他国", "利他", "排他"]
+
+# 同时命中多意图型和模糊指代型时，优先判定为多意图型（与LLM提示词中的说明一致）
+DOMINATES = {MULTI_INTENT: {AMBIGUOUS_REFERENCE}}
+
+DEFAULT_THRESHOLD = 0.8
+
+_QUESTION_SPLIT = re.compile(r"[？?；;]")
+# "不会……吧"、"不是……吗" 这类句式是反问语气的强信号
+_RHETORICAL_PATTERN = re.compile(r"(不会|不是).*(吧|吗)[？?！!。]*$")
+# 很短的追问，如 "那周末呢？"，通常依赖上文
+_FOLLOW_UP_PATTERN = re.compile(r"^.{0,6}呢[？?]*$")
+
+
+class AhoCorasick:
+    """Aho-Corasick 多模式匹配自动机，一次扫描找出文本中的全部触发词"""
+
+    def __init__(self):
+        self._goto: List[Dict[str, int]] = [{}]
+        self._fail: List[int] = [0]
+        self._output: List[List[Tuple[str, object]]] = [[]]
+
+    def add(self, word: str, payload: object = None) -> None:
+        """添加模式串，payload 随匹配结果返回"""
+        state = 0
+        for char in word:
+            next_state = self._goto[state].get(char)
+            if next_state is None:
+                next_state = len(self._goto)
+                self._goto[state][char] = next_state
+                self._goto.append({})
+                self._fail.append(0)
+                self._output.append([])
+            state = next_state
+        self._output[state].append((word, payload))
+
+    def build(self) -> "AhoCorasick":
+        """添加完全部模式串后，按广度优先计算失败指针"""
+        queue = deque(self._goto[0].values())
+        while queue:
+            state = queue.popleft()
+            for char, next_state in self._goto[state].items():
+                queue.append(next_state)
+                fail = self._fail[state]
+                while fail and char not in self._goto[fail]:
+                    fail = self._fail[fail]
+                self._fail[next_state] = self._goto[fail].get(char, 0)
+                self._output[next_state] = self._output[next_state] + self._output[self._fail[next_state]]
+        return self
+
+    def iter(self, text: str) -> Iterator[Tuple[int, str, object]]:
+        """
+        扫描文本
+
+        Returns:
+            (起始位置, 模式串, payload) 的迭代器
+        """
+        state = 0
+        for end, char in enumerate(text):
+            while state and char not in self._goto[state]:
+                state = self._fail[state]
+            state = self._goto[state].get(char, 0)
+            for word, payload in self._output[state]:
+                yield end - len(word) + 1, word, payload
+
+
+@dataclass
+class QueryTypePrediction:
+    """一条查询的规则分类结果"""
+    query_type: str
+    confidence: float
+    # 命中的 (触发词或结构特征, 类型)
+    matches: List[Tuple[str, str]] = field(default_factory=list)
+
+
+def canonical_query_type(label: str) -> str:
+    """把LLM返回的类型描述（如 "2. 对比型"、"对比"）归一为 QUERY_TYPES 中的名称"""
+    for query_type in QUERY_TYPES[:-1]:
+        if query_type.rstrip("型") in (label or ""):
+            return query_type
+    return PLAIN
+
+
+class QueryTypeClassifier:
+    """基于触发词和句式结构的Query类型预分类器"""
+
+    def __init__(self, keywords: Optional[Dict[str, Dict[str, float]]] = None,
+                 threshold: float = DEFAULT_THRESHOLD):
+        """
+        初始化分类器
+
+        Args:
+            keywords: 类型 -> {触发词: 强度}，默认使用 DEFAULT_KEYWORDS
+            threshold: 置信度不低于该值时直接采用规则结果，否则应交给LLM判定
+        """
+        self.threshold = threshold
+        self.automaton = AhoCorasick()
+        for query_type, words in (keywords or DEFAULT_KEYWORDS).items():
+            for word, strength in words.items():
+                self.automaton.add(word, (query_type, strength))
+        for word in NON_TRIGGER_WORDS:
+            self.automaton.add(word, (None, 0.0))
+        self.automaton.build()
+
+    def _match_keywords(self, query: str) -> List[Tuple[int, str, str, float]]:
+        matches = [(start, word, query_type, strength)
+                   for start, word, (query_type, strength) in self.automaton.iter(query)]
+        # 只保留最长匹配：如 "其它" 中的 "它"、"吉他" 中的 "他" 不再算作指代词
+        return [m for m in matches
+                if m[2] is not None
+                and not any(o is not m and o[0] <= m[0] and m[0] + len(m[1]) <= o[0] + len(o[1])
+                            and len(o[1]) > len(m[1]) for o in matches)]
+
+    def classify(self, query: str, conversation_history: str = "") -> QueryTypePrediction:
+        """
+        对查询做规则分类
+
+        Args:
+            query: 用户查询
+            conversation_history: 对话历史；有历史时没有触发词的查询也可能省略了上文信息，
+                不再高置信度判为普通查询，而是交给LLM结合历史判断
+
+        Returns:
+            类型、置信度和命中的触发词
+        """
+        text = query.strip()
+        strengths: Dict[str, float] = {}
+        matches = []
+        for _, word, query_type, strength in self._match_keywords(text):
+            strengths[query_type] = max(strengths.get(query_type, 0.0), strength)
+            matches.append((word, query_type))
+
+        questions = [part for part in _QUESTION_SPLIT.split(text) if len(part.strip()) >= 2]
+        if len(questions) >= 2:
+            strengths[MULTI_INTENT] = STRONG
+            matches.append((f"{len(questions)}个问句", MULTI_INTENT))
+        elif "、" in text:
+            strengths[MULTI_INTENT] = max(strengths.get(MULTI_INTENT, 0.0), WEAK)
+            matches.append(("、", MULTI_INTENT))
+        if _RHETORICAL_PATTERN.search(text):
+            strengths[RHETORICAL] = STRONG
+            matches.append(("不会/不是…吧/吗", RHETORICAL))
+        if _FOLLOW_UP_PATTERN.match(text):
+            strengths[CONTEXT_DEPENDENT] = max(strengths.get(CONTEXT_DEPENDENT, 0.0), WEAK)
+            matches.append(("短追问", CONTEXT_DEPENDENT))
+
+        for winner, losers in DOMINATES.items():
+            if strengths.get(winner) == STRONG:
+                for loser in losers:
+                    strengths.pop(loser, None)
+
+        if not strengths:
+            return QueryTypePrediction(PLAIN, 0.6 if conversation_history.strip() else 0.9, matches)
+        strong = [query_type for query_type, strength in strengths.items() if strength >= STRONG]
+        weak = [query_type for query_type, strength in strengths.items() if strength < STRONG]
+        if len(strong) == 1:
+            return QueryTypePrediction(strong[0], 0.7 if weak else 0.95, matches)
+        if len(strong) > 1:
+            return QueryTypePrediction(strong[0], 0.5, matches)
+        # 只有弱线索：给出猜测，但置信度低于阈值，交给LLM
+        return QueryTypePrediction(weak[0], 0.6 if len(weak) == 1 else 0.4, matches)
+
+    def is_confident(self, prediction: QueryTypePrediction) -> bool:
+        return prediction.confidence >= self.threshold
+
+
+def evaluate_against_llm(classifier: QueryTypeClassifier, queries: Sequence[str],
+                         llm_classify: Callable[[str], str]) -> Dict:
+    """
+    以LLM的识别结果为标准答案，评估规则预分类的准确率、覆盖率和延迟
+
+    Args:
+        classifier: 规则分类器
+        queries: 评估用的查询
+        llm_classify: 输入查询、返回LLM识别类型的函数，如 lambda q: rewriter.auto_rewrite_query(q)['query_type']
+
+    Returns:
+        coverage（本地判定比例）、covered_accuracy（本地判定部分与LLM一致的比例）、
+        cascade_accuracy（规则+LLM兜底整体与LLM一致的比例）、rule_ms/llm_ms（平均单条延迟）、
+        cascade_ms（级联后的平均单条延迟估计）、details
+    """
+    details = []
+    rule_seconds = 0.0
+    llm_seconds = 0.0
+    for query in queries:
+        start = time.perf_counter()
+        prediction = classifier.classify(query)
+        rule_elapsed = time.perf_counter() - start
+        start = time.perf_counter()
+        label = canonical_query_type(llm_classify(query))
+        llm_elapsed = time.perf_counter() - start
+        rule_seconds += rule_elapsed
+        llm_seconds += llm_elapsed
+        details.append({"query": query, "rule_type": prediction.query_type, "confidence": prediction.confidence,
+                        "confident": classifier.is_confident(prediction), "llm_type": label,
+                        "rule_ms": rule_elapsed * 1000, "llm_ms": llm_elapsed * 1000})
+
+    total = len(details) or 1
+    covered = [item for item in details if item["confident"]]
+    agree = sum(item["rule_type"] == item["llm_type"] for item in covered)
+    escalated_ms = sum(item["rule_ms"] + item["llm_ms"] for item in details if not item["confident"])
+    return {
+        "queries": len(details),
+        "coverage": len(covered) / total,
+        "covered_accuracy": agree / len(covered) if covered else 0.0,
+        "cascade_accuracy": (agree + len(details) - len(covered)) / total,
+        "rule_ms": rule_seconds * 1000 / total,
+        "llm_ms": llm_seconds * 1000 / total,
+        "cascade_ms": (sum(item["rule_ms"] for item in covered) + escalated_ms) / total,
+        "details": details,
+    }
+
+
+def print_classifier_report(report: Dict) -> None:
+    """打印 evaluate_against_llm 的结果"""
+    print(f"\n=== 规则预分类评估（{report['queries']}条查询，以LLM识别结果为标准）===")
+    print(f"本地判定覆盖率: {report['coverage']:.1%}，其中与LLM一致: {report['covered_accuracy']:.1%}")
+    print(f"级联整体一致率: {report['cascade_accuracy']:.1%}")
+    print(f"平均延迟: 规则 {report['rule_ms']:.3f} ms，LLM {report['llm_ms']:.1f} ms，级联 {report['cascade_ms']:.1f} ms")
+    for item in report["details"]:
+        if item["confident"] and item["rule_type"] != item["llm_type"]:
+            print(f"  不一致: {item['query']} 规则={item['rule_type']} LLM={item['llm_type']}")
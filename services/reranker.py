@@ -0,0 +1,177 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+交叉编码器重排序模块
+在任意检索器（FAISS、BM25、混合检索、MultiQueryRetriever）之后对候选文本块重新打分：
+(查询, 文本) 对只分词一次，按长度分桶组批以减少padding，在 torch.no_grad 下用CPU多线程推理；
+得分按 (查询哈希, 文本块ID) 缓存，并可按候选预算只重排检索结果的前若干条。
+"""
+
+import hashlib
+import os
+import threading
+import time
+from collections import OrderedDict
+from typing import Callable, List, Optional, Sequence, Tuple
+
+import numpy as np
+
+DEFAULT_MAX_LENGTH = 512
+DEFAULT_BATCH_SIZE = 16
+DEFAULT_CACHE_SIZE = 100_000
+
+
+def hash_query(query: str) -> str:
+    """计算查询的SHA256，作为得分缓存键的一部分"""
+    return hashlib.sha256(query.encode("utf-8")).hexdigest()
+
+
+def default_chunk_id(doc) -> str:
+    """LangChain Document的文本块ID：优先使用doc.id，没有时使用内容哈希"""
+    return getattr(doc, "id", None) or hashlib.sha256(doc.page_content.encode("utf-8")).hexdigest()
+
+
+class CrossEncoderReranker:
+    """基于 bge-reranker 等 HuggingFace 交叉编码器的批量重排序器"""
+
+    def __init__(self, model_path: Optional[str] = None, model=None, tokenizer=None,
+                 max_length: int = DEFAULT_MAX_LENGTH, batch_size: int = DEFAULT_BATCH_SIZE,
+                 num_threads: Optional[int] = None, cache_size: int = DEFAULT_CACHE_SIZE,
+                 budget: Optional[int] = None):
+        """
+        初始化重排序器
+
+        Args:
+            model_path: 模型目录，如 /root/autodl-tmp/models/BAAI/bge-reranker-large
+            model: 已加载的模型（如量化后的模型），传入时不再从model_path加载
+            tokenizer: 已加载的分词器
+            max_length: (查询, 文本) 对的最大token数，超出部分截断
+            batch_size: 每批推理的文本对数
+            num_threads: torch CPU推理线程数，默认为CPU核数
+            cache_size: 得分缓存的最大条数，超出后按最近最少使用淘汰
+            budget: 默认候选预算，只重排检索结果的前budget条，为None时全部重排
+        """
+        import torch
+        from transformers import AutoModelForSequenceClassification, AutoTokenizer
+
+        self.torch = torch
+        torch.set_num_threads(num_threads or os.cpu_count() or 1)
+        self.tokenizer = tokenizer or AutoTokenizer.from_pretrained(model_path)
+        self.model = model or AutoModelForSequenceClassification.from_pretrained(model_path)
+        self.model.eval()
+        self.max_length = max_length
+        self.batch_size = batch_size
+        self.budget = budget
+        self.cache_size = cache_size
+        self.hits = 0
+        self.misses = 0
+        self.last_latency = 0.0
+        self._cache: "OrderedDict[Tuple[str, str], float]" = OrderedDict()
+        self._lock = threading.Lock()
+
+    def score_pairs(self, query: str, passages: Sequence[str]) -> np.ndarray:
+        """
+        计算查询与各文本的相关性得分（不使用缓存）
+
+        所有文本对先一次性分词（不padding），再按token长度排序分桶组批，
+        同一批内长度接近，padding带来的无效计算最少。
+
+        Args:
+            query: 查询
+            passages: 文本列表
+
+        Returns:
+            与passages一一对应的得分（模型logits）
+        """
+        if not passages:
+            return np.zeros(0, dtype=np.float32)
+        encoded = self.tokenizer([query] * len(passages), list(passages), truncation=True,
+                                 max_length=self.max_length, padding=False)
+        lengths = [len(input_ids) for input_ids in encoded["input_ids"]]
+        order = np.argsort(lengths, kind="stable")
+
+        scores = np.zeros(len(passages), dtype=np.float32)
+        with self.torch.no_grad():
+            for start in range(0, len(order), self.batch_size):
+                batch_rows = order[start:start + self.batch_size]
+                features = [{key: values[row] for key, values in encoded.items()} for row in batch_rows]
+                inputs = self.tokenizer.pad(features, padding=True, return_tensors="pt")
+                logits = self.model(**inputs).logits.view(-1).float()
+                scores[batch_rows] = logits.cpu().numpy()
+        return scores
+
+    def rerank(self, query: str, candidates: Sequence[Tuple[str, str]], top_n: Optional[int] = None,
+               budget: Optional[int] = None) -> List[Tuple[str, float]]:
+        """
+        对检索候选重排序
+
+        Args:
+            query: 查询
+            candidates: 按检索顺序排列的 (文本块ID, 文本)
+            top_n: 返回的结果数，默认返回全部重排结果
+            budget: 候选预算，只对前budget条候选打分，默认使用初始化时的设置
+
+        Returns:
+            按重排得分降序的 (文本块ID, 得分)，只包含预算内的候选
+        """
+        start = time.perf_counter()
+        budget = budget if budget is not None else self.budget
+        if budget is not None:
+            candidates = candidates[:budget]
+
+        query_hash = hash_query(query)
+        scores = {}
+        missing = []
+        # 同一文本块ID重复出现（如多路检索合并后）时只打分一次
+        seen = set()
+        with self._lock:
+            for chunk_id, text in candidates:
+                if chunk_id in seen:
+                    continue
+                seen.add(chunk_id)
+                key = (query_hash, chunk_id)
+                if key in self._cache:
+                    self._cache.move_to_end(key)
+                    scores[chunk_id] = self._cache[key]
+                else:
+                    missing.append((chunk_id, text))
+        self.hits += len(seen) - len(missing)
+        self.misses += len(missing)
+
+        if missing:
+            new_scores = self.score_pairs(query, [text for _, text in missing])
+            with self._lock:
+                for (chunk_id, _), score in zip(missing, new_scores):
+                    scores[chunk_id] = float(score)
+                    self._cache[(query_hash, chunk_id)] = float(score)
+                while len(self._cache) > self.cache_size:
+                    self._cache.popitem(last=False)
+
+        ranked = sorted(dict.fromkeys(chunk_id for chunk_id, _ in candidates),
+                        key=lambda chunk_id: scores[chunk_id], reverse=True)
+        self.last_latency = time.perf_counter() - start
+        return [(chunk_id, scores[chunk_id]) for chunk_id in ranked[:top_n]]
+
+    def rerank_documents(self, query: str, documents: Sequence, top_n: Optional[int] = None,
+                         budget: Optional[int] = None,
+                         id_of: Callable = default_chunk_id) -> List[Tuple[object, float]]:
+        """
+        对LangChain Document列表重排序，可直接接在任意LangChain检索器之后
+
+        Args:
+            query: 查询
+            documents: 检索得到的Document，或 similarity_search_with_score 返回的 (Document, 得分)
+            top_n: 返回的结果数
+            budget: 候选预算
+            id_of: 从Document取文本块ID的函数
+
+        Returns:
+            按重排得分降序的 (Document, 得分)
+        """
+        documents = [item[0] if isinstance(item, tuple) else item for item in documents]
+        doc_by_id = {}
+        for doc in documents:
+            doc_by_id.setdefault(id_of(doc), doc)
+        ranked = self.rerank(query, [(chunk_id, doc.page_content) for chunk_id, doc in doc_by_id.items()],
+                             top_n=top_n, budget=budget)
+        return [(doc_by_id[chunk_id], score) for chunk_id, score in ranked]
@@ -0,0 +1,185 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+Query改写结果缓存模块
+以 (改写类型, 归一化查询, 对话历史哈希) 为键把LLM改写结果保存在本地SQLite文件中，条目带TTL过期。
+精确键未命中时，可选地用查询向量在同一改写类型、同一对话历史下查找近似重复的查询，
+相似度超过阈值即视为命中，省去分类和改写的多次LLM往返。
+"""
+
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import threading
+import time
+import unicodedata
+from typing import Any, Callable, Dict, List, Optional, Tuple
+
+import numpy as np
+
+# 默认缓存文件位置，可通过环境变量 REWRITE_CACHE_PATH 覆盖
+DEFAULT_CACHE_PATH = os.getenv(
+    "REWRITE_CACHE_PATH",
+    os.path.join(os.path.expanduser("~"), ".cache", "llm-course", "rewrites.sqlite3"),
+)
+# 默认过期时间：价格、营业时间等改写结果可能随日期变化，不宜长期保存
+DEFAULT_TTL = 24 * 3600
+# 近似重复查询的余弦相似度阈值
+DEFAULT_SIMILARITY_THRESHOLD = 0.95
+
+
+def normalize_query(query: str) -> str:
+    """归一化查询：全角转半角、英文小写、合并空白、去掉末尾标点"""
+    query = unicodedata.normalize("NFKC", query).lower()
+    query = re.sub(r"\s+", " ", query).strip()
+    return query.rstrip("?？!！。.~～ ")
+
+
+def hash_history(conversation_history: str) -> str:
+    """对话历史的哈希，历史不同时同一查询的改写结果不能复用"""
+    history = re.sub(r"\s+", " ", conversation_history or "").strip()
+    return hashlib.sha256(history.encode("utf-8")).hexdigest()
+
+
+class RewriteCache:
+    """带TTL和近似重复命中的Query改写结果缓存，线程安全"""
+
+    def __init__(self, path: Optional[str] = DEFAULT_CACHE_PATH, ttl: float = DEFAULT_TTL,
+                 embed: Optional[Callable[[str], List[float]]] = None,
+                 similarity_threshold: float = DEFAULT_SIMILARITY_THRESHOLD):
+        """
+        初始化缓存
+
+        Args:
+            path: 缓存文件路径，为None时只缓存在内存中
+            ttl: 条目有效期（秒）
+            embed: 可选，查询嵌入函数，提供时启用近似重复命中
+            similarity_threshold: 近似重复命中的余弦相似度阈值
+        """
+        self.ttl = ttl
+        self.embed = embed
+        self.similarity_threshold = similarity_threshold
+        self.hits = 0
+        self.semantic_hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+
+        if path:
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._conn = sqlite3.connect(path or ":memory:", check_same_thread=False, timeout=30)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS rewrites (
+                kind TEXT NOT NULL,
+                history_hash TEXT NOT NULL,
+                query TEXT NOT NULL,
+                result TEXT NOT NULL,
+                vector BLOB,
+                created_at REAL NOT NULL,
+                PRIMARY KEY (kind, history_hash, query)
+            )
+            """
+        )
+        self._conn.commit()
+
+    def get(self, kind: str, query: str, conversation_history: str = "") -> Optional[Any]:
+        """
+        查询缓存：先按归一化查询精确匹配，未命中且启用了嵌入时再查找近似重复查询
+
+        Args:
+            kind: 改写类型，如 auto_rewrite、web_search
+            query: 用户查询
+            conversation_history: 对话历史
+
+        Returns:
+            缓存的改写结果，未命中时返回None
+        """
+        result, _ = self._lookup(kind, query, conversation_history)
+        return result
+
+    def _lookup(self, kind: str, query: str, conversation_history: str) -> Tuple[Optional[Any], Optional[np.ndarray]]:
+        normalized = normalize_query(query)
+        history_hash = hash_history(conversation_history)
+        min_created = time.time() - self.ttl
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT result FROM rewrites WHERE kind = ? AND history_hash = ? AND query = ? AND created_at >= ?",
+                (kind, history_hash, normalized, min_created),
+            ).fetchone()
+        if row is not None:
+            self.hits += 1
+            return json.loads(row[0]), None
+        if self.embed is None:
+            self.misses += 1
+            return None, None
+
+        vector = self._embed(normalized)
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT result, vector FROM rewrites "
+                "WHERE kind = ? AND history_hash = ? AND created_at >= ? AND vector IS NOT NULL",
+                (kind, history_hash, min_created),
+            ).fetchall()
+        if rows:
+            matrix = np.stack([np.frombuffer(blob, dtype=np.float32) for _, blob in rows])
+            similarities = matrix @ vector
+            best = int(np.argmax(similarities))
+            if similarities[best] >= self.similarity_threshold:
+                self.semantic_hits += 1
+                return json.loads(rows[best][0]), vector
+        self.misses += 1
+        return None, vector
+
+    def _embed(self, text: str) -> np.ndarray:
+        vector = np.asarray(self.embed(text), dtype=np.float32)
+        return vector / max(float(np.linalg.norm(vector)), 1e-12)
+
+    def put(self, kind: str, query: str, conversation_history: str, result: Any,
+            vector: Optional[np.ndarray] = None) -> None:
+        """写入缓存，启用嵌入时同时保存查询向量供近似重复匹配"""
+        normalized = normalize_query(query)
+        if vector is None and self.embed is not None:
+            vector = self._embed(normalized)
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO rewrites (kind, history_hash, query, result, vector, created_at) "
+                "VALUES (?, ?, ?, ?, ?, ?)",
+                (kind, hash_history(conversation_history), normalized, json.dumps(result, ensure_ascii=False),
+                 vector.tobytes() if vector is not None else None, time.time()),
+            )
+            self._conn.commit()
+
+    def get_or_compute(self, kind: str, query: str, conversation_history: str,
+                       compute: Callable[[], Any],
+                       cacheable: Optional[Callable[[Any], bool]] = None) -> Any:
+        """
+        命中缓存时直接返回，否则调用compute（通常是一次或多次LLM调用）并写入缓存
+
+        Args:
+            kind: 改写类型
+            query: 用户查询
+            conversation_history: 对话历史
+            compute: 无参函数，返回可JSON序列化的改写结果
+            cacheable: 判断结果能否写入缓存，返回False时（如LLM回复解析失败后的兜底结果）只返回不缓存，
+                下次请求会重新调用compute
+        """
+        result, vector = self._lookup(kind, query, conversation_history)
+        if result is not None:
+            return result
+        result = compute()
+        if cacheable is None or cacheable(result):
+            self.put(kind, query, conversation_history, result, vector=vector)
+        return result
+
+    def purge_expired(self) -> int:
+        """删除过期条目，返回删除的条数"""
+        with self._lock:
+            cursor = self._conn.execute("DELETE FROM rewrites WHERE created_at < ?", (time.time() - self.ttl,))
+            self._conn.commit()
+        return cursor.rowcount
+
+    def stats(self) -> Dict[str, int]:
+        return {"hits": self.hits, "semantic_hits": self.semantic_hits, "misses": self.misses}
@@ -0,0 +1,233 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+中文分词服务模块
+统一封装 jieba 分词：用户词典和停用词表只加载一次；批量分词时把文本分发到进程池并行处理；
+每个文本的分词结果以 (分词配置, 文本哈希) 为键保存在本地SQLite文件中，
+重建词法索引（BM25、word2vec语料）时未变化的文本无需重新分词。
+"""
+
+import hashlib
+import json
+import os
+import re
+import sqlite3
+import threading
+from concurrent.futures import ProcessPoolExecutor
+from typing import Iterable, List, Optional, Sequence
+
+import jieba
+
+# 默认缓存文件位置，可通过环境变量 SEGMENT_CACHE_PATH 覆盖
+DEFAULT_CACHE_PATH = os.getenv(
+    "SEGMENT_CACHE_PATH",
+    os.path.join(os.path.expanduser("~"), ".cache", "llm-course", "segments.sqlite3"),
+)
+# 待分词文本总字符数达到该值才启用进程池，少量短文本直接在当前进程分词更快
+PARALLEL_MIN_CHARS = 200_000
+# 每个子进程任务包含的文本数
+TASK_SIZE = 64
+# 进程内内存缓存的最大条数
+MEMORY_CACHE_SIZE = 65536
+
+# SQLite单条语句的参数个数有限，批量查询时分段执行
+_SQL_BATCH = 500
+
+# 子进程中的分词配置，由进程池的 initializer 设置一次
+_worker_config = None
+
+
+def load_stopwords(path: str) -> set:
+    """从文本文件加载停用词，每行一个"""
+    with open(path, "r", encoding="utf-8") as f:
+        return {line.strip() for line in f if line.strip()}
+
+
+def _cut(text: str, config: dict) -> List[str]:
+    if config["strip_pattern"]:
+        text = re.sub(config["strip_pattern"], "", text)
+    stopwords = config["stopwords"]
+    min_len = config["min_word_len"]
+    return [word for word in jieba.cut(text, HMM=config["hmm"])
+            if len(word) >= min_len and word not in stopwords]
+
+
+def _init_worker(user_dict: Optional[str], config: dict) -> None:
+    """子进程初始化：加载用户词典，保存分词配置"""
+    global _worker_config
+    if user_dict:
+        jieba.load_userdict(user_dict)
+    jieba.initialize()
+    _worker_config = config
+
+
+def _cut_batch(texts: List[str]) -> List[List[str]]:
+    return [_cut(text, _worker_config) for text in texts]
+
+
+class SegmentationService:
+    """带磁盘缓存、可多进程并行的 jieba 分词服务"""
+
+    def __init__(self, user_dict: Optional[str] = None, stopwords: Optional[Iterable[str]] = None,
+                 stopwords_path: Optional[str] = None, min_word_len: int = 1,
+                 strip_pattern: Optional[str] = None, hmm: bool = True,
+                 cache_path: Optional[str] = DEFAULT_CACHE_PATH, max_workers: Optional[int] = None):
+        """
+        初始化分词服务
+
+        Args:
+            user_dict: jieba 用户词典路径
+            stopwords: 停用词集合
+            stopwords_path: 停用词文件路径，与 stopwords 合并
+            min_word_len: 保留的最短词长，如2表示过滤单字
+            strip_pattern: 分词前从文本中删除的正则，如 r'[^\\w\\s]' 删除标点
+            hmm: 是否使用HMM识别未登录词
+            cache_path: 磁盘缓存文件路径，为None时只使用内存缓存
+            max_workers: 批量分词的进程数，默认为CPU核数，为1时不使用进程池
+        """
+        stopwords = set(stopwords or ())
+        if stopwords_path:
+            stopwords |= load_stopwords(stopwords_path)
+        self.user_dict = user_dict
+        self.config = {
+            "stopwords": frozenset(stopwords),
+            "min_word_len": min_word_len,
+            "strip_pattern": strip_pattern,
+            "hmm": hmm,
+        }
+        self.max_workers = max_workers or os.cpu_count() or 1
+        self.hits = 0
+        self.misses = 0
+        self._memory = {}
+        self._executor = None
+        self._lock = threading.Lock()
+
+        # 用户词典只在主进程加载一次；子进程在 initializer 中各加载一次
+        if user_dict:
+            jieba.load_userdict(user_dict)
+
+        # 分词配置（含词典文件的修改时间）不同，缓存结果不能混用
+        signature = {
+            "jieba": getattr(jieba, "__version__", ""),
+            "user_dict": user_dict,
+            "user_dict_mtime": os.path.getmtime(user_dict) if user_dict else None,
+            "stopwords": sorted(stopwords),
+            "min_word_len": min_word_len,
+            "strip_pattern": strip_pattern,
+            "hmm": hmm,
+        }
+        self.config_key = hashlib.sha256(
+            json.dumps(signature, ensure_ascii=False, sort_keys=True).encode("utf-8")).hexdigest()[:16]
+
+        self._conn = None
+        if cache_path:
+            os.makedirs(os.path.dirname(os.path.abspath(cache_path)), exist_ok=True)
+            self._conn = sqlite3.connect(cache_path, check_same_thread=False, timeout=30)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.execute(
+                """
+                CREATE TABLE IF NOT EXISTS segments (
+                    config TEXT NOT NULL,
+                    text_hash TEXT NOT NULL,
+                    tokens TEXT NOT NULL,
+                    PRIMARY KEY (config, text_hash)
+                )
+                """
+            )
+            self._conn.commit()
+
+    def __enter__(self) -> "SegmentationService":
+        return self
+
+    def __exit__(self, *exc) -> None:
+        self.close()
+
+    def close(self) -> None:
+        """关闭进程池和缓存连接"""
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+        if self._conn is not None:
+            self._conn.close()
+            self._conn = None
+
+    def segment(self, text: str) -> List[str]:
+        """对单个文本分词，返回新的列表，调用方可以自由修改"""
+        return self.segment_many([text])[0]
+
+    def segment_many(self, texts: Sequence[str]) -> List[List[str]]:
+        """
+        批量分词：先查内存和磁盘缓存，未命中的文本较多时用进程池并行分词
+
+        Args:
+            texts: 文本列表
+
+        Returns:
+            与texts一一对应的词列表
+        """
+        hashes = [hashlib.sha256(text.encode("utf-8")).hexdigest() for text in texts]
+        found = {}
+        with self._lock:
+            for text_hash in hashes:
+                if text_hash in self._memory:
+                    found[text_hash] = self._memory[text_hash]
+        missing = [h for h in dict.fromkeys(hashes) if h not in found]
+        if missing:
+            found.update(self._load(missing))
+
+        pending = {}
+        for text, text_hash in zip(texts, hashes):
+            if text_hash not in found:
+                pending.setdefault(text_hash, text)
+        self.misses += len(pending)
+        self.hits += len(texts) - len(pending)
+        if pending:
+            segmented = dict(zip(pending, self._cut_many(list(pending.values()))))
+            self._store(segmented)
+            found.update(segmented)
+
+        with self._lock:
+            if len(self._memory) > MEMORY_CACHE_SIZE:
+                self._memory.clear()
+            self._memory.update(found)
+        return [list(found[text_hash]) for text_hash in hashes]
+
+    def _cut_many(self, texts: List[str]) -> List[List[str]]:
+        if self.max_workers <= 1 or sum(len(text) for text in texts) < PARALLEL_MIN_CHARS:
+            return [_cut(text, self.config) for text in texts]
+
+        if self._executor is None:
+            # 进程池在多次批量调用间复用，避免每批都重新加载词典
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.max_workers, initializer=_init_worker, initargs=(self.user_dict, self.config))
+        tasks = [texts[i:i + TASK_SIZE] for i in range(0, len(texts), TASK_SIZE)]
+        return [tokens for batch in self._executor.map(_cut_batch, tasks) for tokens in batch]
+
+    def _load(self, hashes: List[str]) -> dict:
+        if self._conn is None:
+            return {}
+        found = {}
+        with self._lock:
+            for start in range(0, len(hashes), _SQL_BATCH):
+                batch = hashes[start:start + _SQL_BATCH]
+                placeholders = ",".join("?" * len(batch))
+                rows = self._conn.execute(
+                    f"SELECT text_hash, tokens FROM segments WHERE config = ? AND text_hash IN ({placeholders})",
+                    [self.config_key, *batch],
+                ).fetchall()
+                for text_hash, tokens in rows:
+                    found[text_hash] = tuple(json.loads(tokens))
+        return found
+
+    def _store(self, segmented: dict) -> None:
+        for text_hash, tokens in segmented.items():
+            segmented[text_hash] = tuple(tokens)
+        if self._conn is None:
+            return
+        with self._lock:
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO segments (config, text_hash, tokens) VALUES (?, ?, ?)",
+                [(self.config_key, h, json.dumps(tokens, ensure_ascii=False)) for h, tokens in segmented.items()],
+            )
+            self._conn.commit()
@@ -0,0 +1,312 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+FAISS 向量索引构建模块
+支持 flat（暴力检索）、ivf_flat、ivf_pq、hnsw 四种索引类型，IVF类索引自动在采样数据上训练；
+检索时可按查询指定 nprobe / efSearch，在召回率与延迟之间取舍；
+并可与 flat 基线对比 recall@k 和检索延迟，生成构建报告。
+cosine 模式在入库时一次性归一化向量并使用内积索引，检索得分即余弦相似度，不同查询间可直接比较。
+"""
+
+import math
+import time
+from typing import Dict, Optional
+
+import faiss
+import numpy as np
+
+INDEX_TYPES = ("flat", "ivf_flat", "ivf_pq", "hnsw")
+# cosine 即归一化向量上的内积
+METRICS = {"l2": faiss.METRIC_L2, "ip": faiss.METRIC_INNER_PRODUCT, "cosine": faiss.METRIC_INNER_PRODUCT}
+
+# faiss 建议每个聚类中心至少有39个训练样本
+MIN_POINTS_PER_CENTROID = 39
+# 训练样本数上限：每个聚类中心256个样本已足够，再多只会拖慢训练
+MAX_POINTS_PER_CENTROID = 256
+DEFAULT_HNSW_M = 32
+DEFAULT_EF_CONSTRUCTION = 200
+DEFAULT_PQ_NBITS = 8
+# 未按查询指定时使用的默认检索参数（faiss自身默认 nprobe=1、efSearch=16，召回率偏低）
+DEFAULT_NPROBE = 16
+DEFAULT_EF_SEARCH = 64
+
+
+def default_nlist(num_vectors: int) -> int:
+    """IVF聚类中心数的经验值：约 4*sqrt(N)，并保证每个中心有足够的训练样本"""
+    return max(1, min(int(4 * math.sqrt(num_vectors)), num_vectors // MIN_POINTS_PER_CENTROID))
+
+
+def default_pq_m(dimension: int) -> int:
+    """PQ子向量个数：取能整除维度、且每个子向量不少于8维的最大候选值"""
+    for m in (64, 48, 32, 24, 16, 12, 8, 4, 2, 1):
+        if dimension % m == 0 and dimension // m >= 8:
+            return m
+    return 1
+
+
+def normalize_vectors(vectors) -> np.ndarray:
+    """返回L2归一化后的float32向量副本（不修改输入）"""
+    vectors = np.array(vectors, dtype=np.float32, copy=True, ndmin=2)
+    faiss.normalize_L2(vectors)
+    return vectors
+
+
+def similarity_from_distance(distances, metric: str = "cosine"):
+    """
+    把faiss返回的距离/得分换算为余弦相似度，取值范围[-1, 1]，不同查询之间可直接比较
+
+    Args:
+        distances: index.search 返回的距离或得分
+        metric: cosine（内积即相似度）或 l2（单位向量上的L2索引，faiss返回平方距离，有 cos = 1 - d/2）
+    """
+    distances = np.asarray(distances, dtype=np.float32)
+    if metric == "cosine":
+        return np.clip(distances, -1.0, 1.0)
+    if metric == "l2":
+        return np.clip(1.0 - distances / 2.0, -1.0, 1.0)
+    raise ValueError(f"无法将 {metric} 得分换算为余弦相似度")
+
+
+def index_metric(index: faiss.Index) -> str:
+    """返回索引实际使用的度量：ip 或 l2"""
+    return "ip" if _base_index(index).metric_type == faiss.METRIC_INNER_PRODUCT else "l2"
+
+
+def saved_index_metric(path: str) -> str:
+    """读取已保存的索引文件的实际度量（ip / l2），加载LangChain向量库前据此选择距离策略"""
+    try:
+        index = faiss.read_index(path, faiss.IO_FLAG_MMAP)
+    except RuntimeError:
+        index = faiss.read_index(path)
+    return index_metric(index)
+
+
+def index_vectors_normalized(index: faiss.Index, sample_size: int = 256, tolerance: float = 1e-3) -> Optional[bool]:
+    """
+    抽取索引中的前sample_size个向量检查是否为单位向量
+
+    Returns:
+        是否为单位向量；索引不支持取回原始向量（如IVF、PQ）时返回None
+    """
+    count = min(sample_size, index.ntotal)
+    if count == 0:
+        return None
+    try:
+        vectors = index.reconstruct_n(0, count)
+    except RuntimeError:
+        return None
+    return bool(np.all(np.abs(np.linalg.norm(vectors, axis=1) - 1.0) <= tolerance))
+
+
+def langchain_metric(vectorstore) -> str:
+    """
+    返回LangChain FAISS向量库对应的度量名称，以索引实际的 metric_type 为准（不信任加载时指定的距离策略）
+
+    Returns:
+        cosine（单位向量上的内积索引）、ip（未归一化的内积索引）、
+        l2（单位向量上的L2索引）或 euclidean（未归一化的L2索引，距离无法换算为余弦相似度）
+    """
+    # 查询向量由FAISS(normalize_L2=True)或嵌入模型（如 CachedEmbeddings(normalize=True)）归一化，
+    # 且索引中存的也是单位向量（无法取回向量时按嵌入模型的设置推断）时，得分才能换算为余弦相似度
+    if getattr(vectorstore, "_normalize_L2", False):
+        normalized = True
+    else:
+        normalized = (getattr(vectorstore.embedding_function, "normalize", False)
+                      and index_vectors_normalized(vectorstore.index) is not False)
+    if index_metric(vectorstore.index) == "ip":
+        return "cosine" if normalized else "ip"
+    return "l2" if normalized else "euclidean"
+
+
+def langchain_similarity(vectorstore, score) -> Optional[float]:
+    """把LangChain FAISS检索得分按索引实际度量换算为余弦相似度，无法换算（向量未归一化）时返回None"""
+    metric = langchain_metric(vectorstore)
+    if metric not in ("cosine", "l2"):
+        return None
+    return float(similarity_from_distance(score, metric))
+
+
+def _create_index(dimension: int, index_type: str, metric: int, nlist: int, pq_m: int,
+                  pq_nbits: int, hnsw_m: int, ef_construction: int) -> faiss.Index:
+    if index_type == "flat":
+        return faiss.IndexFlatIP(dimension) if metric == faiss.METRIC_INNER_PRODUCT else faiss.IndexFlatL2(dimension)
+    if index_type == "ivf_flat":
+        return faiss.index_factory(dimension, f"IVF{nlist},Flat", metric)
+    if index_type == "ivf_pq":
+        return faiss.index_factory(dimension, f"IVF{nlist},PQ{pq_m}x{pq_nbits}", metric)
+    if index_type == "hnsw":
+        index = faiss.IndexHNSWFlat(dimension, hnsw_m, metric)
+        index.hnsw.efConstruction = ef_construction
+        return index
+    raise ValueError(f"不支持的索引类型: {index_type}，可选: {', '.join(INDEX_TYPES)}")
+
+
+def build_index(vectors, ids=None, index_type: str = "flat", metric: str = "l2",
+                nlist: Optional[int] = None, pq_m: Optional[int] = None, pq_nbits: int = DEFAULT_PQ_NBITS,
+                hnsw_m: int = DEFAULT_HNSW_M, ef_construction: int = DEFAULT_EF_CONSTRUCTION,
+                train_size: Optional[int] = None, nprobe: int = DEFAULT_NPROBE,
+                ef_search: int = DEFAULT_EF_SEARCH, seed: int = 42) -> faiss.Index:
+    """
+    构建并填充向量索引
+
+    Args:
+        vectors: 形如 (N, D) 的向量
+        ids: 可选，自定义ID（如元数据存储中的ID），传入时用IndexIDMap包装
+        index_type: flat / ivf_flat / ivf_pq / hnsw
+        metric: l2（欧氏距离）、ip（内积）或 cosine（入库时归一化，使用内积索引）
+        nlist: IVF聚类中心数，默认按数据量自动选择
+        pq_m: PQ子向量个数，默认按维度自动选择
+        pq_nbits: PQ每个子向量的编码位数
+        hnsw_m: HNSW每个节点的邻居数
+        ef_construction: HNSW构建时的搜索宽度
+        train_size: IVF训练采样数，默认为 nlist*256（不超过N）
+        nprobe: IVF索引的默认nprobe，可在查询时覆盖
+        ef_search: HNSW索引的默认efSearch，可在查询时覆盖
+        seed: 训练采样的随机种子
+
+    Returns:
+        填充好的faiss索引
+    """
+    if metric not in METRICS:
+        raise ValueError(f"不支持的距离度量: {metric}，可选: {', '.join(METRICS)}")
+    if metric == "cosine":
+        vectors = normalize_vectors(vectors)
+    vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+    num_vectors, dimension = vectors.shape
+
+    nlist = nlist or default_nlist(num_vectors)
+    pq_m = pq_m or default_pq_m(dimension)
+    # 数据量太少时无法训练，退回可用的索引类型
+    if index_type == "ivf_pq" and num_vectors < max(2 ** pq_nbits, nlist):
+        print(f"向量数 {num_vectors} 不足以训练PQ码本，改用 ivf_flat。")
+        index_type = "ivf_flat"
+    if index_type == "ivf_flat" and num_vectors < MIN_POINTS_PER_CENTROID * 2:
+        print(f"向量数 {num_vectors} 过少，不适合IVF，改用 flat。")
+        index_type = "flat"
+
+    index = _create_index(dimension, index_type, METRICS[metric], nlist, pq_m, pq_nbits, hnsw_m, ef_construction)
+
+    if not index.is_trained:
+        train_size = min(num_vectors, train_size or nlist * MAX_POINTS_PER_CENTROID)
+        rng = np.random.default_rng(seed)
+        sample = vectors[rng.choice(num_vectors, train_size, replace=False)] if train_size < num_vectors else vectors
+        start = time.time()
+        index.train(sample)
+        print(f"{index_type} 索引已在 {train_size} 个样本上完成训练，耗时 {time.time() - start:.2f} 秒。")
+
+    if isinstance(index, faiss.IndexIVF):
+        index.nprobe = min(nprobe, index.nlist)
+    elif isinstance(index, faiss.IndexHNSW):
+        index.hnsw.efSearch = ef_search
+
+    if ids is not None:
+        index = faiss.IndexIDMap(index)
+        index.add_with_ids(vectors, np.asarray(ids, dtype=np.int64))
+    else:
+        index.add(vectors)
+    return index
+
+
+def _base_index(index: faiss.Index) -> faiss.Index:
+    """去掉IndexIDMap包装，返回实际执行检索的索引"""
+    if isinstance(index, (faiss.IndexIDMap, faiss.IndexIDMap2)):
+        return faiss.downcast_index(index.index)
+    return faiss.downcast_index(index)
+
+
+def search_params(index: faiss.Index, nprobe: Optional[int] = None,
+                  ef_search: Optional[int] = None) -> Optional[faiss.SearchParameters]:
+    """
+    按索引类型构造单次查询的检索参数，不修改索引本身，多线程并发查询时互不影响
+
+    Args:
+        index: faiss索引
+        nprobe: IVF类索引每次查询访问的聚类数，越大召回越高、越慢
+        ef_search: HNSW查询时的候选队列长度，越大召回越高、越慢
+    """
+    base = _base_index(index)
+    if nprobe is not None and isinstance(base, faiss.IndexIVF):
+        return faiss.SearchParametersIVF(nprobe=nprobe)
+    if ef_search is not None and isinstance(base, faiss.IndexHNSW):
+        return faiss.SearchParametersHNSW(efSearch=ef_search)
+    return None
+
+
+def search(index: faiss.Index, query_vectors, k: int, nprobe: Optional[int] = None,
+           ef_search: Optional[int] = None, metric: Optional[str] = None):
+    """
+    执行检索，nprobe / ef_search 只对本次查询生效，对不适用的索引类型忽略
+
+    Args:
+        metric: 构建索引时使用的度量，为cosine时先归一化查询向量
+
+    Returns:
+        (distances, ids)，与 index.search 相同；cosine 模式下distances即余弦相似度
+    """
+    if metric == "cosine":
+        query_vectors = normalize_vectors(query_vectors)
+    query_vectors = np.ascontiguousarray(query_vectors, dtype=np.float32)
+    params = search_params(index, nprobe=nprobe, ef_search=ef_search)
+    if params is None:
+        return index.search(query_vectors, k)
+    return index.search(query_vectors, k, params=params)
+
+
+def compare_with_flat(index: faiss.Index, vectors, ids=None, query_vectors=None, k: int = 10,
+                      num_queries: int = 100, nprobe: Optional[int] = None, ef_search: Optional[int] = None,
+                      metric: Optional[str] = None, seed: int = 0) -> Dict[str, float]:
+    """
+    以flat暴力检索为基线，评估索引的 recall@k 和单次查询延迟
+
+    Args:
+        index: 待评估的索引
+        vectors: 构建索引时使用的全部向量
+        ids: 构建索引时使用的自定义ID
+        query_vectors: 评估用的查询向量，默认从vectors中随机采样
+        k: 取前k个结果计算召回率
+        num_queries: 未提供查询向量时的采样数量
+        nprobe / ef_search: 评估时使用的检索参数
+        metric: 构建索引时使用的度量，默认按索引类型推断为 l2 或 ip
+
+    Returns:
+        包含 recall、延迟（毫秒）等字段的报告
+    """
+    vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+    if query_vectors is None:
+        rng = np.random.default_rng(seed)
+        query_vectors = vectors[rng.choice(len(vectors), min(num_queries, len(vectors)), replace=False)]
+    query_vectors = np.ascontiguousarray(query_vectors, dtype=np.float32)
+    k = min(k, len(vectors))
+
+    if metric is None:
+        metric = "ip" if _base_index(index).metric_type == faiss.METRIC_INNER_PRODUCT else "l2"
+    flat = build_index(vectors, ids=ids, index_type="flat", metric=metric)
+
+    start = time.perf_counter()
+    _, expected = search(flat, query_vectors, k, metric=metric)
+    flat_ms = (time.perf_counter() - start) * 1000 / len(query_vectors)
+
+    start = time.perf_counter()
+    _, actual = search(index, query_vectors, k, nprobe=nprobe, ef_search=ef_search, metric=metric)
+    index_ms = (time.perf_counter() - start) * 1000 / len(query_vectors)
+
+    hits = sum(len(set(a[a != -1]) & set(e[e != -1])) for a, e in zip(actual, expected))
+    return {
+        "index_type": type(_base_index(index)).__name__,
+        "k": k,
+        "num_queries": len(query_vectors),
+        "nprobe": nprobe,
+        "ef_search": ef_search,
+        f"recall@{k}": hits / (k * len(query_vectors)),
+        "flat_latency_ms": flat_ms,
+        "index_latency_ms": index_ms,
+    }
+
+
+def print_index_report(report: Dict[str, float]) -> None:
+    """打印 compare_with_flat 生成的报告"""
+    k = report["k"]
+    knobs = ", ".join(f"{name}={report[name]}" for name in ("nprobe", "ef_search") if report.get(name) is not None)
+    print(f"\n--- 索引构建报告: {report['index_type']}{f' ({knobs})' if knobs else ''} ---")
+    print(f"  recall@{k}: {report[f'recall@{k}']:.4f}（基于 {report['num_queries']} 个查询，以flat检索为基准）")
+    print(f"  单次查询延迟: {report['index_latency_ms']:.3f} ms（flat: {report['flat_latency_ms']:.3f} ms）")
@@ -0,0 +1,177 @@
+#!/usr/bin/env python3
+# -*- coding: utf-8 -*-
+"""
+内容寻址的知识库版本存储模块
+切片内容和向量按内容哈希在本地SQLite中只保存一份，每个版本只是一份清单（切片ID + 内容哈希 + 其余字段），
+多个版本共享未变化切片的文本和向量。保留十个历史版本时，存储和Embedding调用量只随实际变化的切片增长。
+"""
+
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+from typing import Dict, Iterable, List, Optional, Sequence
+
+import numpy as np
+
+DEFAULT_STORE_PATH = os.getenv(
+    "KB_VERSION_STORE_PATH",
+    os.path.join(os.path.expanduser("~"), ".cache", "llm-course", "kb_versions.sqlite3"),
+)
+
+# SQLite单条语句的参数个数有限，批量查询时分段执行
+_SQL_BATCH = 500
+
+
+def hash_content(text: str) -> str:
+    return hashlib.sha256(text.encode("utf-8")).hexdigest()
+
+
+def vector_id(content_hash: str) -> int:
+    """由内容哈希的前8字节得到非负int64，作为FAISS中的向量ID，同一内容在所有版本中ID相同"""
+    return int(content_hash[:16], 16) & 0x7FFF_FFFF_FFFF_FFFF
+
+
+class VersionStore:
+    """切片内容、向量和版本清单的持久化存储，线程安全"""
+
+    def __init__(self, path: Optional[str] = DEFAULT_STORE_PATH):
+        """
+        初始化存储
+
+        Args:
+            path: SQLite文件路径，为None时只保存在内存中
+        """
+        if path:
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self._conn = sqlite3.connect(path or ":memory:", check_same_thread=False, timeout=30)
+        self._lock = threading.Lock()
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS chunks (
+                content_hash TEXT PRIMARY KEY,
+                content TEXT NOT NULL,
+                vector BLOB
+            )
+            """
+        )
+        self._conn.execute(
+            """
+            CREATE TABLE IF NOT EXISTS versions (
+                name TEXT PRIMARY KEY,
+                created_date TEXT NOT NULL,
+                manifest TEXT NOT NULL
+            )
+            """
+        )
+        self._conn.commit()
+
+    def put_chunks(self, contents: Iterable[str]) -> List[str]:
+        """
+        保存切片内容，已存在的内容不重复写入
+
+        Returns:
+            与contents一一对应的内容哈希
+        """
+        contents = list(contents)
+        hashes = [hash_content(content) for content in contents]
+        with self._lock:
+            self._conn.executemany("INSERT OR IGNORE INTO chunks (content_hash, content) VALUES (?, ?)",
+                                   list(zip(hashes, contents)))
+            self._conn.commit()
+        return hashes
+
+    def _select(self, column: str, hashes: Sequence[str], condition: str = "") -> Dict[str, object]:
+        found = {}
+        unique_hashes = list(dict.fromkeys(hashes))
+        with self._lock:
+            for start in range(0, len(unique_hashes), _SQL_BATCH):
+                batch = unique_hashes[start:start + _SQL_BATCH]
+                placeholders = ",".join("?" * len(batch))
+                rows = self._conn.execute(
+                    f"SELECT content_hash, {column} FROM chunks WHERE content_hash IN ({placeholders}){condition}",
+                    batch).fetchall()
+                found.update(rows)
+        return found
+
+    def get_contents(self, hashes: Sequence[str]) -> Dict[str, str]:
+        """内容哈希 -> 切片内容"""
+        return self._select("content", hashes)
+
+    def missing_vectors(self, hashes: Sequence[str]) -> List[str]:
+        """返回还没有保存向量的内容哈希（去重，保持顺序）"""
+        stored = self._select("1", hashes, " AND vector IS NOT NULL")
+        return [h for h in dict.fromkeys(hashes) if h not in stored]
+
+    def put_vectors(self, vectors: Dict[str, Sequence[float]]) -> None:
+        """保存内容哈希对应的向量，对应的切片内容须已通过 put_chunks 写入"""
+        with self._lock:
+            self._conn.executemany("UPDATE chunks SET vector = ? WHERE content_hash = ?",
+                                   [(np.asarray(vector, dtype=np.float32).tobytes(), h)
+                                    for h, vector in vectors.items()])
+            self._conn.commit()
+
+    def get_vectors(self, hashes: Sequence[str]) -> Dict[str, np.ndarray]:
+        """
+        取回已保存的向量
+
+        Returns:
+            内容哈希 -> float32向量，没有向量的哈希（如空白切片）不在结果中
+        """
+        return {h: np.frombuffer(blob, dtype=np.float32)
+                for h, blob in self._select("vector", hashes, " AND vector IS NOT NULL").items()}
+
+    def save_manifest(self, manifest: Dict) -> None:
+        """保存版本清单，同名版本会被覆盖"""
+        with self._lock:
+            self._conn.execute("INSERT OR REPLACE INTO versions (name, created_date, manifest) VALUES (?, ?, ?)",
+                               (manifest["version_name"], manifest["created_date"],
+                                json.dumps(manifest, ensure_ascii=False)))
+            self._conn.commit()
+
+    def load_manifests(self) -> Dict[str, Dict]:
+        """按创建时间顺序返回全部版本清单：版本名 -> 清单"""
+        with self._lock:
+            rows = self._conn.execute("SELECT name, manifest FROM versions ORDER BY created_date").fetchall()
+        return {name: json.loads(manifest) for name, manifest in rows}
+
+    def delete_manifest(self, name: str) -> None:
+        with self._lock:
+            self._conn.execute("DELETE FROM versions WHERE name = ?", (name,))
+            self._conn.commit()
+
+    def prune(self) -> int:
+        """
+        删除不再被任何版本清单引用的切片内容和向量
+
+        Returns:
+            删除的切片数
+        """
+        referenced = set()
+        for manifest in self.load_manifests().values():
+            referenced.update(entry["hash"] for entry in manifest["chunks"])
+        with self._lock:
+            stored = [row[0] for row in self._conn.execute("SELECT content_hash FROM chunks")]
+            orphaned = [(h,) for h in stored if h not in referenced]
+            self._conn.executemany("DELETE FROM chunks WHERE content_hash = ?", orphaned)
+            self._conn.commit()
+        return len(orphaned)
+
+    def stats(self) -> Dict[str, int]:
+        """返回存储统计：版本数、各版本引用的切片总数、实际保存的切片数和向量数"""
+        manifests = self.load_manifests()
+        with self._lock:
+            chunk_count, vector_count, vector_bytes = self._conn.execute(
+                "SELECT COUNT(*), COUNT(vector), COALESCE(SUM(LENGTH(vector)), 0) FROM chunks").fetchone()
+        return {
+            "versions": len(manifests),
+            "chunk_references": sum(len(manifest["chunks"]) for manifest in manifests.values()),
+            "stored_chunks": chunk_count,
+            "stored_vectors": vector_count,
+            "vector_bytes": vector_bytes,
+        }
+
+    def close(self) -> None:
+        self._conn.close()